@@ -0,0 +1,56 @@
+""" Parse throughput of `--parse-processes`: inline (threads only) vs a process pool.
+
+Simulates the content stage: every thread "downloads" a ?do=revisions page (sleep) and parses it.
+
+    python benchmarks/parse_pool.py [--pages 400] [--latency 0.02]
+"""
+import argparse
+import concurrent.futures
+import os
+import time
+
+from dokuWikiDumper.dump.content.revisions import parse_revisions_page
+from dokuWikiDumper.utils.parse_pool import parse_pool
+
+
+def revisions_page(revs: int = 100) -> str:
+    lis = ''.join(
+        f'<li><div class="li"><input type="checkbox" name="rev2[]" value="{1700000000 + i}"/>'
+        f'<span class="date">2024-01-01 10:{i % 60:02d}</span> <a href="?id=ns:page&amp;rev={1700000000 + i}">ns:page</a> '
+        f'<span class="sum">– edit {i}</span> <span class="user"><bdi>user{i}</bdi></span> '
+        f'<span class="sizechange">+{i} B</span></div></li>' for i in range(revs))
+    return f'<html><body><form id="page__revisions"><ul>{lis}</ul></form></body></html>'
+
+
+def run(text: str, pages: int, threads: int, latency: float) -> float:
+    def task(_):
+        time.sleep(latency)
+        parse_pool.run(parse_revisions_page, text, 'http://wiki.example/doku.php')
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        list(executor.map(task, range(pages)))
+    return pages / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, default=400)
+    parser.add_argument('--latency', type=float, default=0.02, help='simulated download time (s)')
+    args = parser.parse_args()
+
+    text = revisions_page()
+    print(f'{os.cpu_count()} CPUs, {len(text)} bytes per page, {args.latency}s latency')
+    print('threads  inline  ' + '  '.join(f'pool={n}' for n in (1, 2, 4)) + '   (pages/s)')
+    for threads in (1, 2, 4, 8):
+        row = []
+        for processes in (0, 1, 2, 4):
+            parse_pool.configure(processes)
+            run(text, processes * 2, threads, 0)  # warm up the workers
+            row.append(run(text, args.pages, threads, args.latency))
+        parse_pool.shutdown()
+        print(f'{threads:7d}  ' + '  '.join(f'{rate:6.1f}' for rate in row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict, dataclass, fields
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+from slugify import slugify
+
+from dokuWikiDumper.utils.util import print_with_lock as print
+from dokuWikiDumper.utils.util import uopen
+from dokuWikiDumper.version_check import dokuWikiDumper_outdated_check
+
+FINAL_STATUS = ('done', 'skipped')
+""" not dumped again when the batch is resumed """
+SKIP_EXIT_CODES = {
+    88: 'recent dump on IA',
+    33: 'disallowed by robots.txt',
+}
+
+
+@dataclass
+class WikiResult:
+    url: str
+    status: str = 'pending'
+    """ pending | running | done | skipped | failed """
+    reason: str = ''
+    dump_dir: str = ''
+    log: str = ''
+    attempts: int = 0
+    duration: float = 0.0
+    files: int = 0
+    bytes: int = 0
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'WikiResult':
+        known = {f.name for f in fields(cls)}
+        return cls(**{k: v for k, v in d.items() if k in known})
+
+
+class BatchState:
+    """ Persistent state of a batch (JSON), rewritten atomically after every change.
+
+    Re-running the same batch resumes it: wikis already `done`/`skipped` are not dumped again.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.wikis: Dict[str, WikiResult] = {}
+        if os.path.exists(path):
+            with uopen(path, 'r') as f:
+                state = json.load(f)
+            for d in state.get('wikis', []):
+                self.wikis[d['url']] = WikiResult.from_dict(d)
+
+    def get(self, url: str) -> WikiResult:
+        with self.lock:
+            if url not in self.wikis:
+                self.wikis[url] = WikiResult(url=url)
+            return self.wikis[url]
+
+    def update(self, result: WikiResult):
+        with self.lock:
+            self.wikis[result.url] = result
+            self._save()
+
+    def _save(self):
+        tmp = self.path + '.tmp'
+        with uopen(tmp, 'w') as f:
+            json.dump({'updated': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()),
+                       'wikis': [asdict(r) for r in self.wikis.values()]},
+                      f, indent=2, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+
+def read_urls(path: str) -> List[str]:
+    """ One URL per line, blank lines and `#` comments are ignored, duplicates are dropped """
+    urls = []
+    with uopen(path, 'r') as f:
+        for line in f:
+            url = line.strip()
+            if url and not url.startswith('#') and url not in urls:
+                urls.append(url)
+    return urls
+
+
+def host_of(url: str) -> str:
+    return urlparse(url if '://' in url else 'http://' + url).netloc.lower()
+
+
+def _dir_size(path: str):
+    files = size = 0
+    for root, _, filenames in os.walk(path):
+        for filename in filenames:
+            with contextlib.suppress(OSError):
+                size += os.path.getsize(os.path.join(root, filename))
+                files += 1
+    return files, size
+
+
+def _init_worker(output_dir: str):
+    # the dumps must never wait for a keypress
+    sys.stdin = open(os.devnull, 'r')
+    os.chdir(output_dir)
+
+
+def _dump_one(url: str, dump_args: List[str], log_path: str) -> WikiResult:
+    """ Runs in a worker process, the output of the dump goes to `log_path` """
+    from dokuWikiDumper.dump.doku_dumper import dump
+
+    result = WikiResult(url=url, log=log_path, status='failed')
+    started = time.monotonic()
+    with uopen(log_path, 'a') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            dump_dir = dump([url] + dump_args)
+            if dump_dir is None:
+                result.status, result.reason = 'skipped', 'dump directory already exists (--no-resume)'
+            else:
+                result.status, result.dump_dir = 'done', dump_dir
+        except SystemExit as e:
+            if e.code in SKIP_EXIT_CODES:
+                result.status, result.reason = 'skipped', SKIP_EXIT_CODES[e.code]  # type: ignore
+            else:
+                result.reason = f'exit code {e.code}'
+        except Exception as e:
+            traceback.print_exc()
+            result.reason = f'{type(e).__name__}: {e}'
+    result.duration = time.monotonic() - started
+    if result.dump_dir:
+        result.files, result.bytes = _dir_size(result.dump_dir)
+    return result
+
+
+def getArgumentParser():
+    parser = argparse.ArgumentParser(
+        prog='dokuWikiDumper batch',
+        description='Dump many wikis, several at a time. '
+                    'Options not listed here are passed to every dump (e.g. --content --media --threads 3).')
+    parser.add_argument('urls_file', help='text file, one wiki URL per line (# comments allowed)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of wikis dumped at the same time (worker processes) (default: 4)')
+    parser.add_argument('--per-host', type=int, default=1,
+                        help='max wikis of the same host dumped at the same time (default: 1). '
+                        'Each dump has its own --delay, so N wikis on one host means N times the load.')
+    parser.add_argument('--state', type=str, default=None,
+                        help='batch state file, used to resume an interrupted batch (default: <urls_file>.state.json)')
+    parser.add_argument('--output-dir', type=str, default='.',
+                        help='directory the dumps (and their logs, in batch-logs/) are written to (default: .)')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='also dump again the wikis that failed in a previous run of this batch')
+    return parser
+
+
+def print_summary(results: List[WikiResult], elapsed: float):
+    print('\n\n--Batch summary--')
+    for r in results:
+        rate = r.bytes / r.duration / 1024 / 1024 if r.duration > 0 else 0.0
+        line = f'{r.status:>8} {r.duration:8.1f}s {r.bytes / 1024 / 1024:9.2f} MB {rate:6.2f} MB/s  {r.url}'
+        print(line + (f'  ({r.reason})' if r.reason else ''))
+    counter = collections.Counter(r.status for r in results)
+    total_bytes = sum(r.bytes for r in results)
+    # durations and sizes include the previous runs of a resumed batch
+    dump_time = sum(r.duration for r in results)
+    print(', '.join(f'{n} {status}' for status, n in sorted(counter.items())),
+          f'(this run: {elapsed:.1f}s), {total_bytes / 1024 / 1024:.2f} MB in {dump_time:.1f}s of dumping '
+          f'({total_bytes / dump_time / 1024 / 1024 if dump_time > 0 else 0:.2f} MB/s per wiki)')
+
+
+def batch(params: List[str]):
+    parser = getArgumentParser()
+    args, dump_args = parser.parse_known_args(params)
+    if args.workers < 1 or args.per_host < 1:
+        print('--workers and --per-host must be >= 1')
+        sys.exit(1)
+
+    # fail early on typos, instead of once per wiki
+    from dokuWikiDumper.dump.doku_dumper import getArgumentParser as getDumpArgumentParser
+    getDumpArgumentParser().parse_args(['https://example.com/doku.php'] + dump_args)
+
+    if '--i-love-retro' not in dump_args:
+        dokuWikiDumper_outdated_check()
+        dump_args.append('--i-love-retro')  # checked once for the whole batch
+
+    output_dir = os.path.abspath(args.output_dir)
+    log_dir = os.path.join(output_dir, 'batch-logs')
+    os.makedirs(log_dir, exist_ok=True)
+    state = BatchState(args.state or args.urls_file + '.state.json')
+
+    urls = read_urls(args.urls_file)
+    skip_status = FINAL_STATUS if args.retry_failed else FINAL_STATUS + ('failed',)
+    pending = collections.deque(url for url in urls if state.get(url).status not in skip_status)
+    print(f'Batch: {len(urls)} wikis, {len(urls) - len(pending)} already finished, '
+          f'{args.workers} workers, {args.per_host} per host')
+
+    started = time.monotonic()
+    running: Dict[concurrent.futures.Future, WikiResult] = {}
+    per_host = collections.Counter()
+
+    def new_executor():
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=args.workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker, initargs=(output_dir,))
+
+    executor = new_executor()
+    try:
+        while pending or running:
+            # dispatch, skipping (not reordering) wikis whose host is already busy
+            for url in list(pending):
+                if len(running) >= args.workers:
+                    break
+                host = host_of(url)
+                if per_host[host] >= args.per_host:
+                    continue
+                pending.remove(url)
+                per_host[host] += 1
+                result = state.get(url)
+                result.status = 'running'
+                result.attempts += 1
+                result.log = os.path.join(log_dir, slugify(url, max_length=120) + '.log')
+                state.update(result)
+                print(f'Batch: ({len(urls) - len(pending) - len(running)}/{len(urls)}) {url} ...')
+                running[executor.submit(_dump_one, url, dump_args, result.log)] = result
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            broken = False
+            for f in done:
+                result = running.pop(f)
+                per_host[host_of(result.url)] -= 1
+                try:
+                    finished: WikiResult = f.result()
+                    finished.attempts = result.attempts
+                except BrokenProcessPool:
+                    # a dump killed its worker (e.g. os._exit()), every in-flight dump of the pool is lost
+                    broken = True
+                    finished = result
+                    finished.status, finished.reason = 'failed', 'worker process died'
+                state.update(finished)
+                print(f'Batch: {finished.status} {finished.url} in {finished.duration:.1f}s'
+                      + (f' ({finished.reason})' if finished.reason else ''))
+            if broken:
+                executor.shutdown(wait=True)
+                executor = new_executor()
+    except KeyboardInterrupt:
+        print('Batch: interrupted, running dumps are resumed next time')
+        for f in running:
+            f.cancel()
+        raise
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    results = [state.get(url) for url in urls]
+    print_summary(results, time.monotonic() - started)
+    if any(r.status == 'failed' for r in results):
+        sys.exit(1)
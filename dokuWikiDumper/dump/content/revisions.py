@@ -6,7 +6,7 @@ import time
 import urllib.parse as urlparse
 from datetime import datetime
 from ipaddress import IPv4Address, IPv6Address, ip_address
-from typing import List, Optional, TypedDict
+from typing import Iterable, List, Optional, Tuple, TypedDict
 
 import requests
 from bs4 import BeautifulSoup, Tag
@@ -20,9 +20,12 @@ from dokuWikiDumper.exceptions import (
     RevisionListNotFound,
     show_edge_case_warning,
 )
+from dokuWikiDumper.utils.compression import write_history
 from dokuWikiDumper.utils.config import runtime_config
+from dokuWikiDumper.utils.parse_pool import parse_pool
 from dokuWikiDumper.utils.util import check_int, smkdirs, uopen
 from dokuWikiDumper.utils.util import print_with_lock as print
+from dokuWikiDumper.utils.write_behind import write_behind
 
 logger = logging.getLogger(__name__)
 
@@ -42,24 +45,81 @@ def get_source_export(url: str, title: str, rev: str = '', *, session: requests.
     raise DispositionHeaderMissingError(r)
 
 
+# args must be same as save_source_edit()
+def save_source_export(url: str, title: str, rev: str = '', *, session: requests.Session, path: str):
+    """Like `get_source_export()`, but the source is decoded and written to `path` as it arrives
+    (an old revision: compressed with --compress-history, see `write_history()`)"""
+
+    with session.get(url, params={'id': title, 'rev': rev, 'do': 'export_raw'}, stream=True) as r:
+        if r.status_code != 200:
+            raise HTTPStatusError(r)
+
+        disposition_ok = 'Content-Disposition' in r.headers
+        content_type_ok = 'text/plain' in r.headers.get('content-type', '')
+        if not (disposition_ok or content_type_ok):
+            raise DispositionHeaderMissingError(r)
+        (write_history if rev else write_behind.write)(path, r.iter_text())
+
+
 # args must be same as get_source_export(), even if not used
 def get_source_edit(url: str, title: str, rev: str = '', *, session: requests.Session):
     """Export the raw source of a page by scraping the edit box content. Yuck."""
 
-    r = session.get(url, params={'id': title, 'rev': rev, 'do': 'edit'})
-    soup = BeautifulSoup(r.text, runtime_config.html_parser)
-    source = None
+    # the rest of the page (and the connection) is dropped as soon as the edit box is complete
+    with session.get(url, params={'id': title, 'rev': rev, 'do': 'edit'}, stream=True) as r:
+        source, text = extract_edit_textarea(r.iter_text())
 
-    textarea = soup.find('textarea', {'name': 'wikitext'})
-    if textarea:
-        source = ''.join(textarea.text).strip()
-    elif 'Action disabled: source' in r.text:
-        raise ActionEditDisabled(title)
-    else:
+    if source is None:
+        # unusual markup, the whole page has been read anyway
+        source = parse_pool.run(parse_edit_textarea, text)
+
+    if source is None:
+        if 'Action disabled: source' in text:
+            raise ActionEditDisabled(title)
         raise ActionEditTextareaNotFound(title)
 
     return source
 
+
+TEXTAREA_START = re.compile(r'<textarea\b[^>]*?\sname\s*=\s*(["\']?)wikitext\1(?=[\s/>])[^>]*>', re.IGNORECASE)
+TEXTAREA_END = re.compile(r'</textarea\s*>', re.IGNORECASE)
+
+
+def extract_edit_textarea(chunks: Iterable[str]) -> Tuple[Optional[str], str]:
+    """ Read the ?do=edit page until the end of the edit box.
+
+    Returns `(wikitext, the text read so far)`, `wikitext` is `None` if no complete edit box was found.
+    Same result as `parse_edit_textarea()`: entities decoded, newlines normalized, stripped.
+    """
+    text = ''
+    start = None
+    for chunk in chunks:
+        # a tag can be split between two chunks
+        scan_from = max(len(text) - 256, 0)
+        text += chunk
+        if start is None:
+            if match := TEXTAREA_START.search(text, scan_from):
+                start = match.end()
+                scan_from = start
+            else:
+                continue
+        if match := TEXTAREA_END.search(text, max(scan_from, start)):
+            source = html.unescape(text[start:match.start()])
+            return source.replace('\r\n', '\n').replace('\r', '\n').strip(), text
+    return None, text
+
+
+# args must be same as save_source_export()
+def save_source_edit(url: str, title: str, rev: str = '', *, session: requests.Session, path: str):
+    (write_history if rev else write_behind.write)(path, [get_source_edit(url, title, rev, session=session)])
+
+
+def parse_edit_textarea(text: str) -> Optional[str]:
+    """ The wikitext of the edit box of ?do=edit, `None` if there is no edit box (runs in the `parse_pool`) """
+    soup = BeautifulSoup(text, runtime_config.html_parser)
+    textarea = soup.find('textarea', {'name': 'wikitext'})
+    return ''.join(textarea.text).strip() if textarea else None
+
 class Revision(TypedDict):
     """ (None if not found or failed) """
     id: Optional[str]
@@ -78,16 +138,6 @@ def get_revisions(doku_url, title: str, session: requests.Session, msg_header: s
     """
 
     revs: List[Revision] = []
-    rev_tmplate: Revision = {
-        'id': None, # str(int)
-        'user': None, # str
-        'sum': None, # str
-        'date': None, # str
-        'minor': False, # bool
-        'sizechange': 0,
-    }
-
-    i = 0
     continue_index = -1
     cont = True
 
@@ -99,140 +149,12 @@ def get_revisions(doku_url, title: str, session: requests.Session, msg_header: s
                 'do': 'revisions',
                 'first': str(continue_index)})
 
-        soup = BeautifulSoup(r.text, runtime_config.html_parser)
-
-        lis = None
-
-        # check if form#page__revisions exists
-        if page__revisions := soup.find('form', {'id': 'page__revisions'}):
-            logger.debug('page__revisions: %s', page__revisions)
-            if ul := page__revisions.find('ul'):
-                assert isinstance(ul, Tag)
-                lis = ul.find_all('li')
-
-        # outdate dokuwiki version? try another way.
-        if div_page := soup.find('div', {'class': 'page'}):
-            logger.debug('div.page: %s', div_page)
-            if ul := div_page.find('ul'):
-                assert isinstance(ul, Tag)
-                lis = ul.find_all('li')
-
-        if lis is None:
-            if err_msg := soup.find('div', {'class': 'error'}):
-                if 'Action disabled: revisions' in err_msg.text:
-                    raise ActionRevisionsDisabled(title)
-
+        page_revs, continue_index, cont, error = parse_pool.run(parse_revisions_page, r.text, r.url, msg_header)
+        if error == 'revisions_disabled':
+            raise ActionRevisionsDisabled(title)
+        if error == 'not_found':
             raise RevisionListNotFound(title)
-
-        assert lis is not None
-
-        for li in lis:
-            li: Tag
-            rev = {}
-
-            checkbox = li.find('input', {'type': 'checkbox'})
-            rev_hrefs = li.find_all(
-                'a', href=lambda href: isinstance(href, str) and (
-                    '&rev=' in href or '?rev=' in href))
-
-            # id: optional(str(id)): rev_id, not title name.
-            if checkbox:
-                rev['id'] = check_int(checkbox.get('value', None))
-
-            if rev_hrefs and rev.get('id', None) is None:
-                obj1 = rev_hrefs[0]['href']
-                obj2 = urlparse.urlparse(obj1).query
-                obj3 = urlparse.parse_qs(obj2)
-                if 'rev' in obj3:
-                    rev['id'] = check_int(obj3['rev'][0])
-                else:
-                    rev['id'] = None
-                del (obj1, obj2, obj3)
-
-            # use_hidden_rev
-            if rev.get('id', None) is None:
-                obj1 = li.find('input', {'type': 'hidden'})
-                if obj1 is not None and 'value' in obj1:
-                    rev['id'] = check_int(obj1['value'])
-                del (obj1)
-
-            # minor: bool
-            rev['minor'] = li.has_attr('class') and 'minor' in li['class']
-
-            # summary: optional(str)
-            sum_span = li.find_all('span', {'class': 'sum'})
-            if sum_span:
-                sum_span = sum_span[0]
-                sum_text = sum_span.text.split(' ')[1:]
-                if sum_span.find_all('bdi'):
-                    rev['sum'] = html.unescape(
-                        sum_span.find('bdi').text).strip()
-                else:
-                    rev['sum'] = html.unescape(' '.join(sum_text)).strip()
-            else:
-                print(msg_header, '    ', repr(
-                    li.text).replace('\\n', ' ').strip())
-                wikilink1 = li.find('a', {'class': 'wikilink1'})
-                text_node = wikilink1 and wikilink1.next and wikilink1.next.next or '' # I have no idea what's the propose of this legacy code
-                if text_node.strip():
-                    rev['sum'] = html.unescape(text_node).strip(u'\u2013 \n')
-                    show_edge_case_warning(reason='sum_span not found and text_node found', r_url=r.url, rev_sum=rev['sum'],
-                    wikilink1=wikilink1.decode(),
-                    next1=wikilink1.next.decode() if wikilink1.next else None,
-                    next2=wikilink1.next.next.decode() if (wikilink1.next and wikilink1.next.next) else None)
-
-            # date: optional(str)
-            date_span = li.find('span', {'class': 'date'})
-            if date_span:
-                rev['date'] = date_span.text.strip()
-            else:
-                rev['date'] = ' '.join(li.text.strip().split(' ')[:2])
-                matches = re.findall(
-                    r'([0-9./]+ [0-9]{1,2}:[0-9]{1,2})',
-                    rev['date'])
-                if matches:
-                    rev['date'] = matches[0]
-
-            # sizechange: optional(int)
-            sizechange_span = li.find('span', {'class': 'sizechange'})
-
-            if sizechange_span:
-                sizechange_text = sizechange_span.text.replace('\xC2\xA0', ' ').strip()
-                units = ['B', 'KB', 'MB', 'GB']
-                positive = '−' not in sizechange_text
-                size_change = re.sub(r'[^0-9.]', '', sizechange_text)
-                try:
-                    size_change = float(size_change)
-                except ValueError:
-                    size_change = 0.0
-
-                for unit in units[1:]:
-                    if unit in sizechange_text:
-                        size_change *= 1024
-                rev['sizechange'] = positive and int(size_change) or int(-size_change)
-
-            # user: optional(str)
-            # legacy
-            # if not (select_revs and len(revs) > i and revs[i]['user']):
-            user_span = li.find('span', {'class': 'user'})
-            if user_span and user_span.text is not None:
-                rev['user'] = html.unescape(user_span.text).strip()
-
-            # if select_revs and len(revs) > i:
-            #     revs[i].update(rev)
-            # else:
-            #     revs.append(rev)
-
-            _rev: Revision = {**rev_tmplate,**rev}  # merge dicts # type: ignore
-            revs.append(_rev)
-
-            i += 1
-
-        # next page
-        first = soup.find_all('input', {'name': 'first', 'value': True})
-        continue_index = first and max(map(lambda x: int(x['value']), first))
-        cont = soup.find('input', {'class': 'button', 'accesskey': 'n'})
-        # time.sleep(1.5)
+        revs += page_revs
 
     # if revs and use_hidden_rev and not select_revs:
     #     soup2 = BeautifulSoup(session.get(url, params={'id': title}).text)
@@ -243,6 +165,159 @@ def get_revisions(doku_url, title: str, session: requests.Session, msg_header: s
     return revs
 
 
+def parse_revisions_page(text: str, url: str, msg_header: str = ''):
+    """ Parse one page of ?do=revisions (runs in the `parse_pool`).
+
+    Returns `(revs, continue_index, cont, error)`, `error`: `None`, `'revisions_disabled'` or `'not_found'`
+    """
+
+    revs: List[Revision] = []
+    rev_tmplate: Revision = {
+        'id': None, # str(int)
+        'user': None, # str
+        'sum': None, # str
+        'date': None, # str
+        'minor': False, # bool
+        'sizechange': 0,
+    }
+
+    soup = BeautifulSoup(text, runtime_config.html_parser)
+
+    lis = None
+
+    # check if form#page__revisions exists
+    if page__revisions := soup.find('form', {'id': 'page__revisions'}):
+        logger.debug('page__revisions: %s', page__revisions)
+        if ul := page__revisions.find('ul'):
+            assert isinstance(ul, Tag)
+            lis = ul.find_all('li')
+
+    # outdate dokuwiki version? try another way.
+    if div_page := soup.find('div', {'class': 'page'}):
+        logger.debug('div.page: %s', div_page)
+        if ul := div_page.find('ul'):
+            assert isinstance(ul, Tag)
+            lis = ul.find_all('li')
+
+    if lis is None:
+        if err_msg := soup.find('div', {'class': 'error'}):
+            if 'Action disabled: revisions' in err_msg.text:
+                return [], None, None, 'revisions_disabled'
+
+        return [], None, None, 'not_found'
+
+    assert lis is not None
+
+    for li in lis:
+        li: Tag
+        rev = {}
+
+        checkbox = li.find('input', {'type': 'checkbox'})
+        rev_hrefs = li.find_all(
+            'a', href=lambda href: isinstance(href, str) and (
+                '&rev=' in href or '?rev=' in href))
+
+        # id: optional(str(id)): rev_id, not title name.
+        if checkbox:
+            rev['id'] = check_int(checkbox.get('value', None))
+
+        if rev_hrefs and rev.get('id', None) is None:
+            obj1 = rev_hrefs[0]['href']
+            obj2 = urlparse.urlparse(obj1).query
+            obj3 = urlparse.parse_qs(obj2)
+            if 'rev' in obj3:
+                rev['id'] = check_int(obj3['rev'][0])
+            else:
+                rev['id'] = None
+            del (obj1, obj2, obj3)
+
+        # use_hidden_rev
+        if rev.get('id', None) is None:
+            obj1 = li.find('input', {'type': 'hidden'})
+            if obj1 is not None and 'value' in obj1:
+                rev['id'] = check_int(obj1['value'])
+            del (obj1)
+
+        # minor: bool
+        rev['minor'] = li.has_attr('class') and 'minor' in li['class']
+
+        # summary: optional(str)
+        sum_span = li.find_all('span', {'class': 'sum'})
+        if sum_span:
+            sum_span = sum_span[0]
+            sum_text = sum_span.text.split(' ')[1:]
+            if sum_span.find_all('bdi'):
+                rev['sum'] = html.unescape(
+                    sum_span.find('bdi').text).strip()
+            else:
+                rev['sum'] = html.unescape(' '.join(sum_text)).strip()
+        else:
+            print(msg_header, '    ', repr(
+                li.text).replace('\\n', ' ').strip())
+            wikilink1 = li.find('a', {'class': 'wikilink1'})
+            text_node = wikilink1 and wikilink1.next and wikilink1.next.next or '' # I have no idea what's the propose of this legacy code
+            if text_node.strip():
+                rev['sum'] = html.unescape(text_node).strip(u'\u2013 \n')
+                show_edge_case_warning(reason='sum_span not found and text_node found', r_url=url, rev_sum=rev['sum'],
+                wikilink1=wikilink1.decode(),
+                next1=wikilink1.next.decode() if wikilink1.next else None,
+                next2=wikilink1.next.next.decode() if (wikilink1.next and wikilink1.next.next) else None)
+
+        # date: optional(str)
+        date_span = li.find('span', {'class': 'date'})
+        if date_span:
+            rev['date'] = date_span.text.strip()
+        else:
+            rev['date'] = ' '.join(li.text.strip().split(' ')[:2])
+            matches = re.findall(
+                r'([0-9./]+ [0-9]{1,2}:[0-9]{1,2})',
+                rev['date'])
+            if matches:
+                rev['date'] = matches[0]
+
+        # sizechange: optional(int)
+        sizechange_span = li.find('span', {'class': 'sizechange'})
+
+        if sizechange_span:
+            sizechange_text = sizechange_span.text.replace('\xC2\xA0', ' ').strip()
+            units = ['B', 'KB', 'MB', 'GB']
+            positive = '−' not in sizechange_text
+            size_change = re.sub(r'[^0-9.]', '', sizechange_text)
+            try:
+                size_change = float(size_change)
+            except ValueError:
+                size_change = 0.0
+
+            for unit in units[1:]:
+                if unit in sizechange_text:
+                    size_change *= 1024
+            rev['sizechange'] = positive and int(size_change) or int(-size_change)
+
+        # user: optional(str)
+        # legacy
+        # if not (select_revs and len(revs) > i and revs[i]['user']):
+        user_span = li.find('span', {'class': 'user'})
+        if user_span and user_span.text is not None:
+            rev['user'] = html.unescape(user_span.text).strip()
+
+        # if select_revs and len(revs) > i:
+        #     revs[i].update(rev)
+        # else:
+        #     revs.append(rev)
+
+        _rev: Revision = {**rev_tmplate,**rev}  # merge dicts # type: ignore
+        revs.append(_rev)
+
+
+    # next page
+    first = soup.find_all('input', {'name': 'first', 'value': True})
+    continue_index = first and max(map(lambda x: int(x['value']), first))
+    cont = soup.find('input', {'class': 'button', 'accesskey': 'n'}) is not None
+    # time.sleep(1.5)
+
+    return revs, continue_index, cont, None
+
+
 DATE_FORMATS = ["%Y-%m-%d %H:%M", # <https://www.dokuwiki.org/dokuwiki?do=revisions>
                 "%Y-%m-%d", # <http://neff.family.name/unwiki/doku.php>
                 "%Y/%m/%d", # <https://tjgrant.com/wiki/news?do=revisions>
@@ -272,6 +347,7 @@ def save_page_changes(dumpDir, title: str, revs: List[Revision], child_path, msg
 
     revidOfPage: set[str] = set()
     rows2write = []
+    fields = []
     # Loop through revisions in reverse.
     for rev in revs[::-1]:
         print(msg_header, '    meta change saving:', rev)
@@ -335,11 +411,14 @@ def save_page_changes(dumpDir, title: str, revs: List[Revision], child_path, msg
         summary = summary[:255]
         row = '\t'.join([rev_id, ip, 'e' if minor else 'E',
                         title, user, summary, extra, str(sizechange)])
+        fields.append((rev_id, ip, 'e' if minor else 'E', user, summary, str(sizechange)))
         row = row.replace('\n', ' ')
         row = row.replace('\r', ' ')
         rows2write.append(row)
 
 
     smkdirs(dumpDir, '/meta/' + child_path)
-    with uopen(changes_file, 'w') as f:
-        f.write('\n'.join(rows2write)+'\n')
+    # an interrupted write would be taken for a complete file by the next run
+    write_behind.write(changes_file, ['\n'.join(rows2write)+'\n'])
+    if runtime_config.state_db is not None:
+        runtime_config.state_db.add_revisions(title, fields[::-1])
@@ -0,0 +1,31 @@
+from dokuWikiDumper.dump.content.revisions import extract_edit_textarea, parse_edit_textarea
+
+EDIT_PAGE = ('<html><body><form id="dw__editform">\r\n'
+             '<textarea class="edit" id="wiki__text" rows="10" cols="80" name="wikitext" tabindex="1">\r\n'
+             '====== Title ======\r\n'
+             'a &lt;tag&gt; &amp; &quot;quotes&quot; &#233;t&eacute;\r\n'
+             '  indented line\r\n'
+             '</textarea>\r\n'
+             '<input type="submit" value="Save" /></form>' + 'x' * 1000 + '</body></html>')
+
+
+def _chunks(text: str, size: int):
+    return (text[i:i + size] for i in range(0, len(text), size))
+
+
+def test_extract_edit_textarea_matches_parse_edit_textarea():
+    expected = parse_edit_textarea(EDIT_PAGE)
+    assert expected is not None and 'a <tag> & "quotes" été' in expected and '\r' not in expected
+    # 7: the <textarea ...name="wikitext"> tag and the entities are split between chunks
+    for size in (1, 7, 64, len(EDIT_PAGE)):
+        source, text = extract_edit_textarea(_chunks(EDIT_PAGE, size))
+        assert source == expected
+        # the rest of the page isn't read
+        assert size == len(EDIT_PAGE) or len(text) < len(EDIT_PAGE)
+
+
+def test_extract_edit_textarea_without_edit_box():
+    page = '<html><body><div class="error">Action disabled: source</div>' + 'y' * 500 + '</body></html>'
+    source, text = extract_edit_textarea(_chunks(page, 16))
+    assert source is None and parse_edit_textarea(page) is None
+    assert text == page
@@ -1,10 +1,12 @@
 import urllib.parse as urlparse
+from typing import List, Tuple
 
 import requests
 from bs4 import BeautifulSoup
 
 from dokuWikiDumper.exceptions import ActionIndexDisabled
 from dokuWikiDumper.utils.config import runtime_config
+from dokuWikiDumper.utils.parse_pool import parse_pool
 from dokuWikiDumper.utils.util import load_titles, uopen
 from dokuWikiDumper.utils.util import print_with_lock as print
 
@@ -53,7 +55,21 @@ def get_titles(url, ns=None, session: requests.Session=None, use_legacy_method=N
     
     assert use_legacy_method is False
     r = session.post(ajax, data=params) if r is None else r # reuse the previous Response if possible
-    soup = BeautifulSoup(r.text, runtime_config.html_parser)
+    for title, is_dir in parse_pool.run(parse_ajax_index, r.text):
+        if is_dir:
+            titles += get_titles(url=url, ns=title, session=session, use_legacy_method=use_legacy_method)
+        else:
+            titles.append(title)
+    # time.sleep(1.5)
+    print('%sFound %d title(s) in namespace %s' %
+          (' ' * depth, len(titles), ns or '(all)'))
+    return titles
+
+
+def parse_ajax_index(text: str) -> List[Tuple[str, bool]]:
+    """ [(title or namespace, is namespace)] of a `call=index` AJAX response (runs in the `parse_pool`) """
+    entries = []
+    soup = BeautifulSoup(text, runtime_config.html_parser)
     for a in soup.find_all('a', href=True):
         if a.has_attr('title'):
             title = a['title']
@@ -64,14 +80,8 @@ def get_titles(url, ns=None, session: requests.Session=None, use_legacy_method=N
         else:
             query = urlparse.parse_qs(urlparse.urlparse(a['href']).query)
             title = (query['idx' if 'idx' in query else 'id'])[0]
-        if 'idx_dir' in a['class']:
-            titles += get_titles(url=url, ns=title, session=session, use_legacy_method=use_legacy_method)
-        else:
-            titles.append(title)
-    # time.sleep(1.5)
-    print('%sFound %d title(s) in namespace %s' %
-          (' ' * depth, len(titles), ns or '(all)'))
-    return titles
+        entries.append((str(title), 'idx_dir' in a['class']))
+    return entries
 
 
 def get_titles_legacy(url, ns=None, session:requests.Session=None):
@@ -86,11 +96,30 @@ def get_titles_legacy(url, ns=None, session:requests.Session=None):
     depth = len(ns.split(':'))
 
     r = session.get(url, params=params)
-    soup = BeautifulSoup(r.text, runtime_config.html_parser).find_all('ul', {'class': 'idx'})[0]
 
     if ns:
         print('%sSearching in namespace %s' % (' ' * depth, ns))
+    else:
+        print('Finding titles (?do=index)')
+
+    for name, is_dir in parse_pool.run(parse_legacy_index, r.text, ns):
+        if is_dir:
+            titles += get_titles_legacy(url, name, session=session)
+        else:
+            titles.append(name)
+
+    print('%sFound %d title(s) in namespace %s' %
+          (' ' * depth, len(titles), ns or '(all)'))
+
+    return titles
 
+
+def parse_legacy_index(text: str, ns: str) -> List[Tuple[str, bool]]:
+    """ [(title or namespace, is namespace)] of a ?do=index page (runs in the `parse_pool`) """
+    entries = []
+    soup = BeautifulSoup(text, runtime_config.html_parser).find_all('ul', {'class': 'idx'})[0]
+
+    if ns:
         def match(href):
             if not href:
                 return False
@@ -104,13 +133,12 @@ def get_titles_legacy(url, ns=None, session:requests.Session=None):
             'a', {
                 'href': lambda x: x and not match(x)})
         except:
-            if 'Command disabled: index' in r.text:
+            if 'Command disabled: index' in text:
                 raise ActionIndexDisabled
             
             raise
 
     else:
-        print('Finding titles (?do=index)')
         result = soup.find_all('a')
 
     for a in result:
@@ -119,20 +147,19 @@ def get_titles_legacy(url, ns=None, session:requests.Session=None):
             a.has_attr('class')
             and ('idx_dir' in a['class'])
         ):
-            titles += get_titles_legacy(url, query['idx'][0], session=session)
+            entries.append((query['idx'][0], True))
         else:
-            titles.append(query['id'][0])
+            entries.append((query['id'][0], False))
 
-    print('%sFound %d title(s) in namespace %s' %
-          (' ' * depth, len(titles), ns or '(all)'))
-
-    return titles
+    return entries
 
 
 def save_titles(titles: list, dump_dir: str):
     with uopen(dump_dir + '/dumpMeta/titles.txt', 'w') as f:
         f.write('\n'.join(titles))
         f.write('\n--END--\n')
+    if runtime_config.state_db is not None:
+        runtime_config.state_db.set_titles(titles)
 
 def load_get_save_titles(dump_dir: str, url: str, session: requests.Session):
     """Load titles from dumpMeta/titles.txt, if not exists, get titles from url and save to dumpMeta/titles.txt"""
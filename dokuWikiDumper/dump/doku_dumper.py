@@ -12,35 +12,90 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import concurrent.futures
+import importlib.util
 import os
 import sys
 import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
 
 import requests
 
 from dokuWikiDumper.dump.content.content import dump_content
+from dokuWikiDumper.dump.content.titles import load_get_save_titles
 from dokuWikiDumper.dump.html.html import dump_HTML
 from dokuWikiDumper.dump.info.info import update_info
-from dokuWikiDumper.dump.media.media import dump_media
+from dokuWikiDumper.dump.media.media import dump_media, getFiles
 from dokuWikiDumper.dump.pdf.pdf import dump_PDF
-from dokuWikiDumper.utils.config import runtime_config, update_config
+from dokuWikiDumper.utils.async_session import AsyncSession
+from dokuWikiDumper.utils.compression import LEVEL_RANGES, zstd_available
+from dokuWikiDumper.utils.concurrency import DEFAULT_TIMEOUT, host_controllers, retry_budget
+from dokuWikiDumper.utils.config import get_config, runtime_config, update_config
+from dokuWikiDumper.utils.dead_letters import MISSING_FILE, DeadLetters
 from dokuWikiDumper.utils.dump_lock import DumpLock
+from dokuWikiDumper.utils.hedging import hedging
 from dokuWikiDumper.utils.ia_checker import any_recent_ia_item_exists
+from dokuWikiDumper.utils.journal import ProgressJournal
+from dokuWikiDumper.utils.parse_pool import parse_pool
 from dokuWikiDumper.utils.patch import SessionMonkeyPatch
+from dokuWikiDumper.utils.rate_limit import (BANDWIDTH_FILE, TokenBucket, bandwidth_limiter, parse_bandwidth,
+                                             request_limiter)
+from dokuWikiDumper.utils.scheduler import SharedBudget, set_current_stage
 from dokuWikiDumper.utils.session import create_session, load_cookies, login_dokuwiki
+from dokuWikiDumper.utils.shard import parse_shard
+from dokuWikiDumper.utils.state_db import STATE_DB_FILE, StateDB
+from dokuWikiDumper.utils.shutdown import DEFAULT_SHUTDOWN_TIMEOUT, EXIT_INTERRUPTED, ShutdownRequested, shutdown
+from dokuWikiDumper.utils.transport import (
+    DEFAULT_DNS_TTL,
+    DEFAULT_POOL_MAXSIZE,
+    connection_stats,
+    http2_available,
+    track_connections,
+    track_transfers,
+    transfer_stats,
+    untrack_connections,
+)
 from dokuWikiDumper.utils.util import (
     avoidSites,
     build_base_url,
     get_doku_url,
+    press_enter_to_continue,
     smkdirs,
     standardize_url,
     url2prefix,
 )
 from dokuWikiDumper.utils.util import print_with_lock as print
+from dokuWikiDumper.utils.watchdog import DEFAULT_STALL_TIMEOUT, watchdog
+from dokuWikiDumper.utils.write_behind import DEFAULT_IO_QUEUE, write_behind
 from dokuWikiDumper.version import get_version
 from dokuWikiDumper.version_check import dokuWikiDumper_outdated_check
 
 DEFAULT_THREADS = -1 # magic number, -1 means use 1 thread.
+STAGES = ('content', 'html', 'media', 'pdf')
+STAGE_MARKS = {
+    'content': 'content_dumped.mark',
+    'html': 'html_dumped.mark',
+    'media': 'media_dumped.mark',
+    'pdf': 'pdf_dumped.mark',
+}
+
+
+def parse_stage_weights(value: str) -> Dict[str, float]:
+    """ 'media=2,content=1' -> {'media': 2.0, 'content': 1.0} """
+    weights = {}
+    for pair in value.split(','):
+        stage, _, weight = pair.partition('=')
+        stage = stage.strip().lower()
+        if stage not in STAGES:
+            raise argparse.ArgumentTypeError(f'unknown stage: {stage!r} (choose from {", ".join(STAGES)})')
+        try:
+            weights[stage] = float(weight)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f'invalid weight for {stage}: {weight!r}')
+        if weights[stage] <= 0:
+            raise argparse.ArgumentTypeError(f'weight of {stage} must be > 0')
+    return weights
 
 def getArgumentParser():
     parser = argparse.ArgumentParser(description='dokuWikiDumper Version: '+ get_version())
@@ -66,6 +121,40 @@ def getArgumentParser():
         '--no-resume', help='Do not resume a previous dump [default: resume]', action='store_true')
     parser.add_argument(
         '--threads', help='Number of sub threads to use [default: 1], not recommended to set > 5', type=int, default=DEFAULT_THREADS)
+    parser.add_argument(
+        '--adaptive', action='store_true',
+        help='Adapt the number of concurrent requests per host (AIMD): start from --threads, '
+        'grow while the host is healthy, halve on 429/503/timeouts/latency spikes [default: False]')
+    parser.add_argument(
+        '--max-threads', dest='max_threads', type=int, default=20,
+        help='Upper bound of concurrent requests for --adaptive [default: 20]')
+    parser.add_argument(
+        '--parallel-stages', dest='parallel_stages', action='store_true',
+        help='Run the enabled stages (content, html, media, pdf) at the same time, sharing --threads '
+        '(and --delay) between them [default: False]')
+    parser.add_argument(
+        '--stage-weights', dest='stage_weights', type=parse_stage_weights, default=None,
+        help='Share of the threads for each stage with --parallel-stages, e.g. "media=2,content=1" [default: equal]')
+    parser.add_argument(
+        '--engine', choices=['threads', 'asyncio'], default='threads',
+        help='Download engine for --media, --html and --pdf. asyncio keeps many requests in flight '
+        'on a single thread (requires aiohttp) [default: threads]')
+    parser.add_argument(
+        '--async-connections', dest='async_connections', type=int, default=32,
+        help='Max connections (and in-flight requests) per host for --engine asyncio [default: 32]')
+    parser.add_argument(
+        '--processes', type=int, default=1,
+        help='Number of worker processes sharing the dump (each one with --threads threads and its share of '
+        'the items), for when parsing pages is the bottleneck. --delay is shared by all processes [default: 1]')
+    parser.add_argument(
+        '--parse-processes', dest='parse_processes', type=int, default=0,
+        help='Parse the revision lists, edit pages and indexes in a pool of N processes, the downloads stay in the '
+        'threads. Only helps on multi-core machines when the parsing, not the network, is the bottleneck '
+        '(see benchmarks/parse_pool.py) [default: 0 (parse in the threads)]')
+    parser.add_argument(
+        '--shard', type=parse_shard, default=None, metavar='INDEX/COUNT',
+        help='Only dump the titles and media files of one shard (e.g. 0/4), to split a dump between several '
+        'machines. Merge the shards with "dokuWikiDumper merge" [default: not sharded]')
     parser.add_argument(
         '--i-love-retro',  action='store_true', dest='user_love_retro',
         help='Do not check the latest version of dokuWikiDumper (from pypi.org) before running [default: False]')
@@ -73,7 +162,9 @@ def getArgumentParser():
     parser.add_argument('--insecure', action='store_true',
                         help='Disable SSL certificate verification')
     parser.add_argument('--ignore-errors', action='store_true',
-                        help='!DANGEROUS! ignore errors in the sub threads. This may cause incomplete dumps.')
+                        help='!DANGEROUS! ignore errors in the sub threads. This may cause incomplete dumps. '
+                        '(Failed items are always retried at the end of the stage, with this option the ones still '
+                        'failing are listed in dumpMeta/<stage>_missing.txt instead of stopping the dump.)')
     parser.add_argument('--ignore-action-disabled-edit', action='store_true',
                         help='Some sites disable edit action for anonymous users and some core pages. '+
                         'This option will ignore this error and textarea not found error.'+
@@ -85,10 +176,61 @@ def getArgumentParser():
     parser.add_argument('--export-xhtml-action', type=str, choices=['export_html', 'export_xhtml'], dest='export_xhtml_action',
                         help='HTML export action [default: export_xhtml]', default='export_xhtml')
 
-    parser.add_argument('--delay', help='Delay between requests [default: 0.0]', type=float, default=0.0)
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='Delay between requests, shared by all threads (i.e. 1/delay requests per second) [default: 0.0]')
+    parser.add_argument('--burst', type=int, default=1,
+                        help='Max number of requests that can be sent back-to-back before --delay kicks in [default: 1]')
     parser.add_argument('--retry', help='Maximum number of retries [default: 5]', type=int, default=5)
     parser.add_argument('--hard-retry', type=int, default=3, dest='hard_retry',
                         help='Maximum number of retries for hard errors [default: 3]')
+    parser.add_argument('--retry-budget', dest='retry_budget', type=float, default=0.2,
+                        help='Max share of the requests that may be retries (all retry layers together, over the '
+                        'last minute), beyond it requests fail fast. 0 to disable [default: 0.2]')
+    parser.add_argument('--breaker-threshold', dest='breaker_threshold', type=int, default=10,
+                        help='Pause a host after N failed requests in a row (connection errors, timeouts, 5xx), '
+                        'probe it and resume when it responds. 0 to disable [default: 10]')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='Ceiling of the per-host read timeout in seconds (connect: a quarter of it). The timeouts '
+                        'start there and follow 4x the p99 latency of the host once known. They apply to each read, '
+                        'not the whole download. 0 to disable [default: %(default)g]')
+    parser.add_argument('--stall-timeout', dest='stall_timeout', type=float, default=DEFAULT_STALL_TIMEOUT,
+                        help='Watchdog: dump the stack of a worker that received nothing for N seconds, cancel its '
+                        'connection and requeue its task; report when the whole dump makes no progress. '
+                        '0 to disable [default: %(default)g]')
+    parser.add_argument('--hedge', type=float, default=0.0,
+                        help='Opt-in: send a duplicate of a GET that takes longer than the p95 latency of its host '
+                        'and use whichever answers first, hedging at most this share of the requests (e.g. 0.05) '
+                        '[default: 0 (disabled)]')
+    parser.add_argument('--shutdown-timeout', dest='shutdown_timeout', type=float, default=DEFAULT_SHUTDOWN_TIMEOUT,
+                        help='On Ctrl-C/SIGTERM, stop starting new items and give the ones in progress N seconds to '
+                        'finish before cancelling them; the next run resumes from there. A second signal aborts at '
+                        'once [default: %(default)g]')
+    parser.add_argument('--state-db', dest='state_db', action='store_true',
+                        help='Also keep the state of the dump (titles, media files, revisions, status of every item) in '
+                        '%s, used to resume instead of the progress journal. See "dokuWikiDumper status"' % STATE_DB_FILE)
+    parser.add_argument('--compress-history', dest='compress_history', choices=['none', 'gzip', 'zstd'],
+                        default='none',
+                        help='Write the old revisions (attic/ and html/attic/) compressed while downloading them: '
+                        '<page>.<rev>.txt.gz like DokuWiki\'s own attic, or .zst (requires zstandard). The latest '
+                        'revisions stay uncompressed [default: none]')
+    parser.add_argument('--compress-level', dest='compress_level', type=int, default=None,
+                        help='Level of --compress-history, gzip: 0-9, zstd: 1-22 [default: 6 (gzip), 3 (zstd)]')
+    parser.add_argument('--io-threads', dest='io_threads', type=int, default=0,
+                        help='Write the pages, revisions and HTML on N I/O threads (fsync\'ed in batches), so the '
+                        'downloads don\'t wait on slow storage such as NFS or HDDs [default: 0 (written by the '
+                        'download threads)]')
+    parser.add_argument('--io-queue', dest='io_queue', type=int, default=DEFAULT_IO_QUEUE,
+                        help='Max files (and 64 MB) waiting for the I/O threads, the downloads wait beyond it '
+                        '[default: %(default)d]')
+    parser.add_argument('--bandwidth', type=parse_bandwidth, default='0',
+                        help='Cap the download rate of media files and PDFs, shared by all threads and processes, '
+                        'e.g. 500K, 2M. Writing a new cap to <dump_dir>/%s changes it while the dump runs '
+                        '[default: 0 (unlimited)]' % BANDWIDTH_FILE)
+    parser.add_argument('--http2', action='store_true',
+                        help='Multiplex the requests over one HTTP/2 connection on the hosts that support it '
+                        '(requires httpx[http2], no proxy support)')
+    parser.add_argument('--dns-cache-ttl', dest='dns_cache_ttl', type=float, default=DEFAULT_DNS_TTL,
+                        help=f'Cache DNS lookups for N seconds, 0 to disable [default: {DEFAULT_DNS_TTL}]')
 
     parser.add_argument('--parser', help='HTML parser [default: lxml]', type=str, default='lxml')
 
@@ -121,15 +263,18 @@ def checkArgs(args):
     if args.threads < 1:
         print('Number of threads must be >= 1.')
         return False
-    if args.threads > 5:
+    if args.adaptive and args.max_threads < args.threads:
+        print('--max-threads must be >= --threads.')
+        return False
+    if args.threads > 5 and not args.adaptive:
         print('Warning: threads > 5 , will bring a lot of pressure to the server.')
         print('Original site may deny your request, even ban our UA.')
         time.sleep(3)
-        input('Press Enter to continue...')
+        press_enter_to_continue()
     if args.ignore_errors:
         print('Warning: You have chosen to ignore errors in the sub threads. This may cause incomplete dumps.')
         time.sleep(3)
-        input('Press Enter to continue...')
+        press_enter_to_continue()
     if args.username and not args.password:
         print('Warning: You have specified a username but no password.')
         return False
@@ -139,11 +284,53 @@ def checkArgs(args):
     if args.delay < 0:
         print('Delay must be >= 0.')
         return False
-    if args.delay > 0.0 and args.threads > 1:
-        print(f"Warning: You have specified a delay and more than one thread ({args.threads}).")
-        print("!!! Delay will be applied to each thread separately !!!")
-        time.sleep(3)
-        input('Press Enter to continue...')
+    if args.engine == 'asyncio':
+        from dokuWikiDumper.utils.async_session import aiohttp_available
+        if not aiohttp_available():
+            print('--engine asyncio requires aiohttp. Please install it first: pip install aiohttp')
+            return False
+        if args.async_connections < 1:
+            print('--async-connections must be >= 1.')
+            return False
+    if args.burst < 1:
+        print('Burst must be >= 1.')
+        return False
+    if args.retry_budget < 0 or args.breaker_threshold < 0:
+        print('--retry-budget and --breaker-threshold must be >= 0.')
+        return False
+    if not 0 <= args.hedge < 1:
+        print('--hedge must be >= 0 and < 1.')
+        return False
+    if args.timeout < 0 or args.stall_timeout < 0:
+        print('--timeout and --stall-timeout must be >= 0.')
+        return False
+    if args.dns_cache_ttl < 0:
+        print('--dns-cache-ttl must be >= 0.')
+        return False
+    if args.http2 and not http2_available():
+        print('--http2 requires httpx and h2. Please install them first: pip install "httpx[http2]"')
+        return False
+    if args.compress_history == 'zstd' and not zstd_available():
+        print('--compress-history zstd requires zstandard. Please install it first: pip install zstandard')
+        return False
+    if args.compress_level is not None and args.compress_history in LEVEL_RANGES:
+        low, high = LEVEL_RANGES[args.compress_history]
+        if not low <= args.compress_level <= high:
+            print(f'--compress-level must be between {low} and {high} for {args.compress_history}.')
+            return False
+    if args.processes < 1:
+        print('--processes must be >= 1.')
+        return False
+    if args.parse_processes < 0:
+        print('--parse-processes must be >= 0.')
+        return False
+    if args.processes > 1:
+        if importlib.util.find_spec('fcntl') is None:
+            print('--processes is not supported on this platform (requires fcntl).')
+            return False
+        if args.engine == 'asyncio':
+            print('--processes and --engine asyncio cannot be used together.')
+            return False
     if args.retry < 0:
         print('Retry must be >= 0.')
         return False
@@ -161,12 +348,15 @@ def checkArgs(args):
             return False
     if args.export_xhtml_action:
         runtime_config.export_xhtml_action = args.export_xhtml_action
+    runtime_config.shard = args.shard
+    runtime_config.compress_history = args.compress_history
+    runtime_config.compress_level = args.compress_level
     return True
 
 
-def getParameters():
+def getParameters(params: Optional[List[str]] = None):
     parser = getArgumentParser()
-    args = parser.parse_args()
+    args = parser.parse_args(params)
 
     if args.auto:
         args.content = True
@@ -185,13 +375,13 @@ def getParameters():
     return args
 
 
-def dump():
-    args = getParameters()
-    if not args.user_love_retro:
-        dokuWikiDumper_outdated_check()
-    url_input = args.url
-
-    session = create_session(retries=args.retry, user_agent=args.user_agent)
+def new_session(args) -> requests.Session:
+    # one kept-alive connection per worker, with --adaptive up to the ceiling
+    workers = args.max_threads if args.adaptive else args.threads
+    session = create_session(retries=args.retry, user_agent=args.user_agent,
+                             pool_maxsize=max(DEFAULT_POOL_MAXSIZE, workers), http2=args.http2)
+    track_connections(session, dns_ttl=args.dns_cache_ttl)
+    track_transfers(session, http2=args.http2)
 
     if args.verbose:
         def print_request(r: requests.Response, *args, **kwargs):
@@ -208,15 +398,179 @@ def dump():
         session.verify = False
         requests.packages.urllib3.disable_warnings() # type: ignore
         print("Warning: SSL certificate verification disabled.")
-    session_monkey = SessionMonkeyPatch(session=session, delay=args.delay, msg='',
-                                        hard_retries=args.hard_retry,
-                                        trim_PHP_warnings=args.trim_php_warnings)
-    session_monkey.hijack()
 
     if args.cookies:
         load_cookies(session, args.cookies)
         print("Cookies loaded:", session.cookies.get_dict().keys())
+    return session
+
+
+def hijack_session(args, session: requests.Session, rate_limiter: TokenBucket) -> SessionMonkeyPatch:
+    host_controllers.configure(initial=args.threads, max_limit=args.max_threads, adaptive=args.adaptive,
+                               breaker_threshold=args.breaker_threshold, max_timeout=args.timeout)
+    retry_budget.configure(args.retry_budget)
+    watchdog.configure(args.stall_timeout)
+    hedging.configure(args.hedge, workers=args.max_threads if args.adaptive else args.threads)
+    if args.adaptive:
+        print(f'Adaptive concurrency: {args.threads} -> (1..{args.max_threads}) per host')
+    session_monkey = SessionMonkeyPatch(session=session, rate_limiter=rate_limiter, controllers=host_controllers,
+                                        hard_retries=args.hard_retry,
+                                        trim_PHP_warnings=args.trim_php_warnings)
+    session_monkey.hijack()
+    return session_monkey
+
+
+def release_dump(args, session_monkey: SessionMonkeyPatch, prefix: str = '') -> Optional[BaseException]:
+    """ Close the journal, stop the I/O threads, the watchdog..., print the stats, undo the process-wide patches
+    (`batch`, library callers). Every step runs even if an earlier one raises (a write error re-raised by
+    `journal.close()`), returns the first error. """
+    def close_journal():
+        if runtime_config.journal is not None:
+            runtime_config.journal.close()
+
+    def print_stats():
+        print(f'{prefix}Connections:', connection_stats.summary())
+        for line in transfer_stats.summary():
+            print(f'{prefix}Transfer', line)
+        if hedging.enabled:
+            print(f'{prefix}Hedging:', hedging.summary())
+        if args.io_threads > 0:
+            print(f'{prefix}Write-behind:', write_behind.summary())
+
+    steps: List[Callable[[], None]] = [close_journal, write_behind.shutdown, session_monkey.release,
+                                       parse_pool.shutdown, watchdog.stop, print_stats, hedging.shutdown,
+                                       untrack_connections]
+    error = None
+    for step in steps:
+        try:
+            step()
+        except BaseException as e:
+            if error is None:
+                error = e
+            else:
+                print(f'{prefix}Teardown: {type(e).__name__}: {e}')
+    return error
+
+
+@contextmanager
+def released(args, session_monkey: SessionMonkeyPatch, prefix: str = ''):
+    """ `release_dump()` on the way out, whatever happens (`batch` runs its next dump in the same process).
+    An error of the dump goes on, a teardown error is then only printed. """
+    try:
+        yield
+    except BaseException:
+        error = release_dump(args, session_monkey, prefix)
+        if error is not None:
+            print(f'{prefix}Teardown: {type(error).__name__}: {error}')
+        raise
+    error = release_dump(args, session_monkey, prefix)
+    if error is not None:
+        raise error
+
+
+def build_stages(args, *, doku_url: str, base_url: str, dump_dir: str, session: requests.Session,
+                 rate_limiter: TokenBucket) -> list:
+    """ [(name, label, mark file, dump function)] of the enabled stages """
+    # with --adaptive, the pool is sized for the ceiling and the controller decides how many requests are in flight
+    workers = args.max_threads if args.adaptive else args.threads
+
+    def new_async_session() -> Optional[AsyncSession]:
+        if args.engine != 'asyncio':
+            return None
+        # created per stage, each stage runs its own event loop
+        return AsyncSession(session, retries=args.retry, hard_retries=args.hard_retry,
+                            connections_per_host=args.async_connections, rate_limiter=rate_limiter)
+
+    stages = []
+    if args.content:
+        stages.append(('content', 'Content', STAGE_MARKS['content'],
+                       lambda budget: dump_content(doku_url=doku_url, dump_dir=dump_dir,
+                            session=session, threads=workers,
+                            ignore_errors=args.ignore_errors,
+                            ignore_action_disabled_edit=args.ignore_action_disabled_edit,
+                            current_only=args.current_only, budget=budget)))
+    if args.html:
+        stages.append(('html', 'HTML', STAGE_MARKS['html'],
+                       lambda budget: dump_HTML(doku_url=doku_url, dump_dir=dump_dir,
+                            session=session, threads=workers,
+                            ignore_errors=args.ignore_errors, current_only=args.current_only,
+                            asession=new_async_session(), budget=budget)))
+    if args.media: # last, so that we can know the dump is complete.
+        stages.append(('media', 'Media', STAGE_MARKS['media'],
+                       lambda budget: dump_media(base_url=base_url, dumpDir=dump_dir,
+                            session=session, threads=workers,
+                            ignore_errors=args.ignore_errors, asession=new_async_session(), budget=budget)))
+    if args.pdf:
+        # to avoid overload the server, we only dump the current revision of the PDF.
+        stages.append(('pdf', 'PDF', STAGE_MARKS['pdf'],
+                       lambda budget: dump_PDF(doku_url=base_url, dump_dir=dump_dir,
+                            session=session, threads=workers,
+                            ignore_errors=args.ignore_errors, current_only=True,
+                            asession=new_async_session(), budget=budget)))
+    return stages
+
+
+def write_mark(dump_dir: str, name: str, mark: str):
+    """ The stage is done, the items still failing (`DeadLetters`) are listed in `dumpMeta/<name>_missing.txt` """
+    missing = DeadLetters(dump_dir, name).write_missing()
+    with open(os.path.join(dump_dir, mark), 'w') as f:
+        f.write('done')
+        if missing:
+            f.write(f'\n{len(missing)} missing, see {MISSING_FILE.format(stage=name)}\n')
+    if missing:
+        print(f'{name}: marked as dumped with {len(missing)} items missing, see {MISSING_FILE.format(stage=name)}')
+
+
+def run_stages(args, stages: list, *, dump_dir: str, marks: bool = True):
+    """ Run the stages one after another, or at the same time with --parallel-stages.
+
+    `marks`: skip the stages already marked as dumped and mark them when done (the worker processes of
+    `--processes` don't, their parent does once all of them succeeded)
+    """
+    workers = args.max_threads if args.adaptive else args.threads
+
+    def run_stage(name: str, label: str, mark: str, dump_func, budget: Optional[SharedBudget]):
+        if marks and os.path.exists(os.path.join(dump_dir, mark)):
+            print(f'{label} already dumped.')
+            return
+        print(f'\nDumping {label if label.isupper() else name}...\n')
+        set_current_stage(label)
+        since = write_behind.seq
+        try:
+            dump_func(budget)
+        finally:
+            set_current_stage(None)
+        write_behind.sync(since)  # a file that could not be written: the stage is not complete
+        if budget is not None and budget.cancelled:
+            return  # another stage failed, this one is not complete
+        if marks:
+            write_mark(dump_dir, name, mark)
+        elif runtime_config.leases is not None:
+            runtime_config.leases.finish(name)
+
+    if args.parallel_stages and len(stages) > 1:
+        budget = SharedBudget(workers, weights=args.stage_weights)
+        weights = ', '.join(f'{k}={v:g}' for k, v in (args.stage_weights or {}).items()) or 'equal'
+        print(f'Running {", ".join(s[1] for s in stages)} concurrently, sharing {workers} threads (weights: {weights})')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(stages), thread_name_prefix='stage') as executor:
+            futures = [executor.submit(run_stage, *stage, budget) for stage in stages]
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+            failed = next((f for f in futures if f in done and f.exception() is not None), None)
+            if failed is not None:
+                print(f'A stage failed, cancelling the others: {failed.exception()}')
+                budget.cancel()  # their in-flight items finish
+                concurrent.futures.wait(futures)
+                failed.result()
+            for f in futures:
+                f.result()
+    else:
+        for stage in stages:
+            run_stage(*stage, None)
+
 
+def dump_wiki(args, session: requests.Session) -> Optional[str]:
+    """ The dump itself, `dump()` sets up the session and tears everything down, return: dump dir """
+    url_input = args.url
     std_url = standardize_url(url_input)
     # use #force to skip 30X redirection detection
     doku_url = get_doku_url(std_url, session=session) if not std_url.endswith('#force') else std_url[:-len('#force')]
@@ -243,9 +597,13 @@ def dump():
         if os.path.exists(dump_dir):
             print(
                 'Dump directory already exists. (You can use --path to specify a different directory.)')
-            return 1
+            return None
 
     smkdirs(dump_dir, '/dumpMeta')
+    bandwidth_limiter.configure(args.bandwidth, control_file=os.path.join(dump_dir, BANDWIDTH_FILE))
+    write_behind.configure(args.io_threads, args.io_queue)
+    runtime_config.state_db = StateDB(dump_dir) if args.state_db else None
+    runtime_config.journal = runtime_config.state_db or ProgressJournal(dump_dir)
     print('Dumping to ', dump_dir,
           '\nBase URL: ', base_url,
           '\nDokuPHP URL: ', doku_url)
@@ -256,56 +614,92 @@ def dump():
                'base_url': base_url,  # type: str
                'dokuWikiDumper_version': get_version(),  # type: str
                }
+    # the old revisions written by an earlier run with another --compress-history are replaced when redone
+    previous_config = get_config(dump_dir)
+    runtime_config.compress_changed = bool(previous_config) and \
+        previous_config.get('compress_history', 'none') != args.compress_history
+    _config['compress_history'] = args.compress_history  # type: str
+    if args.shard:
+        # used by "dokuWikiDumper merge" to check that the shards add up to a complete dump
+        _config['shard'] = list(args.shard)  # type: list[int]
+        _config['current_only'] = args.current_only  # type: bool
     update_config(dump_dir=dump_dir, config=_config)
     update_info(dump_dir, doku_url=doku_url, session=session)
 
-    with DumpLock(dump_dir):
-        if args.content:
-            if os.path.exists(os.path.join(dump_dir, 'content_dumped.mark')):
-                print('Content already dumped.')
-            else:
-                print('\nDumping content...\n')
-                dump_content(doku_url=doku_url, dump_dir=dump_dir,
-                            session=session, threads=args.threads,
-                            ignore_errors=args.ignore_errors,
-                            ignore_action_disabled_edit=args.ignore_action_disabled_edit,
-                            current_only=args.current_only)
-                with open(os.path.join(dump_dir, 'content_dumped.mark'), 'w') as f:
-                    f.write('done')
-        if args.html:
-            if os.path.exists(os.path.join(dump_dir, 'html_dumped.mark')):
-                print('HTML already dumped.')
-            else:
-                print('\nDumping HTML...\n')
-                dump_HTML(doku_url=doku_url, dump_dir=dump_dir,
-                        session=session, threads=args.threads,
-                        ignore_errors=args.ignore_errors, current_only=args.current_only)
-                with open(os.path.join(dump_dir, 'html_dumped.mark'), 'w') as f:
-                    f.write('done')
-        if args.media: # last, so that we can know the dump is complete.
-            if os.path.exists(os.path.join(dump_dir, 'media_dumped.mark')):
-                print('Media already dumped.')
+    stages = build_stages(args, doku_url=doku_url, base_url=base_url, dump_dir=dump_dir, session=session,
+                          rate_limiter=request_limiter)
+
+    shutdown.install(args.shutdown_timeout)
+    try:
+        with DumpLock(dump_dir):
+            if args.processes > 1:
+                from dokuWikiDumper.dump.processes import run_worker_processes
+                pending = [stage for stage in stages if not os.path.exists(os.path.join(dump_dir, stage[2]))]
+                if pending:
+                    # lists are fetched once here, not raced for by the workers
+                    if args.content or args.html or args.pdf:
+                        load_get_save_titles(dump_dir=dump_dir, url=doku_url, session=session)
+                    if args.media:
+                        getFiles(base_url, dumpDir=dump_dir, session=session)
+                    if run_worker_processes(args, [stage[0] for stage in pending], dump_dir=dump_dir,
+                                            doku_url=doku_url, base_url=base_url, cookies=session.cookies.get_dict()):
+                        for name, label, mark, _ in pending:
+                            write_mark(dump_dir, name, mark)
+                    else:
+                        raise RuntimeError('Some worker processes failed, run the same command again to resume.')
             else:
-                print('\nDumping media...\n')
-                dump_media(base_url=base_url, dumpDir=dump_dir,
-                        session=session, threads=args.threads,
-                        ignore_errors=args.ignore_errors)
-                with open(os.path.join(dump_dir, 'media_dumped.mark'), 'w') as f:
-                    f.write('done')
-        if args.pdf:
-            if os.path.exists(os.path.join(dump_dir, 'pdf_dumped.mark')):
-                print('PDF already dumped.')
-            else:
-                print('\nDumping PDF...\n')
-                dump_PDF(doku_url=base_url, dump_dir=dump_dir,
-                        session=session, threads=args.threads,
-                        ignore_errors=args.ignore_errors, current_only=True)
-                        # to avoid overload the server, we only dump the current revision of the PDF.
-                with open(os.path.join(dump_dir, 'pdf_dumped.mark'), 'w') as f:
-                    f.write('done')
-
+                if args.parallel_stages and len(stages) > 1 and (args.content or args.html or args.pdf):
+                    # titles.txt is shared by content/html/pdf, get it once before the stages race for it
+                    load_get_save_titles(dump_dir=dump_dir, url=doku_url, session=session)
+                run_stages(args, stages, dump_dir=dump_dir, marks=True)
+    finally:
+        shutdown.uninstall()
+    return dump_dir
+
+
+def dump(params: Optional[List[str]] = None) -> Optional[str]:
+    """ `params`: command line arguments (default: `sys.argv[1:]`), return: dump dir """
+    params = sys.argv[1:] if params is None else params
+    if params and params[0] == 'batch':
+        from dokuWikiDumper.dump.batch.batch import batch
+        batch(params[1:])
+        return None
+    if params and params[0] == 'merge':
+        from dokuWikiDumper.dump.merge.merge import merge
+        merge(params[1:])
+        return None
+    if params and params[0] == 'status':
+        from dokuWikiDumper.dump.status.status import status
+        status(params[1:])
+        return None
+
+    args = getParameters(params)
+    if not args.user_love_retro:
+        dokuWikiDumper_outdated_check()
 
-    session_monkey.release()
+    parse_pool.configure(args.parse_processes)
+    session = new_session(args)
+    # (re)configured on every call, `batch` runs several dumps in the same process
+    request_limiter.set_rate(1 / args.delay if args.delay > 0 else 0.0, burst=args.burst)
+    if args.delay > 0:
+        print(f'Rate limit: {1 / args.delay:.2f} req/s (burst: {args.burst}), shared by all threads'
+              + (' and processes' if args.processes > 1 else ''))
+    session_monkey = hijack_session(args, session, request_limiter)
+    runtime_config.journal = runtime_config.state_db = None
+
+    dump_dir = None
+    interrupted = False
+    with released(args, session_monkey):
+        try:
+            dump_dir = dump_wiki(args, session)
+        except ShutdownRequested as e:
+            # the stages in progress are not marked as dumped, DumpLock is released on the way out
+            print(f'{e}, run the same command again to resume.')
+            interrupted = True
+    if interrupted:
+        sys.exit(EXIT_INTERRUPTED)
+    if dump_dir is None:
+        return None
     print('\n\n--Done--')
 
     if args.upload and args.auto:
@@ -319,3 +713,5 @@ def dump():
         else:
             print('dokuWikiUploader: --upload: [red] Failed [/red]!!!')
             raise RuntimeError('dokuWikiUploader: --upload: Failed!!!')
+
+    return dump_dir
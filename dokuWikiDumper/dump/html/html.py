@@ -1,24 +1,29 @@
-import concurrent.futures
-import copy
+import asyncio
 import os
-import queue
-import threading
 from dataclasses import dataclass
+from typing import Iterable, Iterator, List, Optional
 
 import requests
 
 from dokuWikiDumper.dump.content.revisions import get_revisions, save_page_changes
 from dokuWikiDumper.dump.content.titles import load_get_save_titles
+from dokuWikiDumper.utils.async_session import AsyncSession, run_bounded
+from dokuWikiDumper.utils.compression import write_history
+from dokuWikiDumper.utils.concurrency import host_controllers
 from dokuWikiDumper.utils.config import runtime_config
+from dokuWikiDumper.utils.dead_letters import DeadLetters
+from dokuWikiDumper.utils.journal import journal_done, journal_filter, journal_record
+from dokuWikiDumper.utils.leases import lease_filter
+from dokuWikiDumper.utils.scheduler import Scheduler, SharedBudget
+from dokuWikiDumper.utils.shard import shard_filter
 from dokuWikiDumper.utils.util import print_with_lock as print
-from dokuWikiDumper.utils.util import smkdirs, uopen
+from dokuWikiDumper.utils.util import smkdirs
+from dokuWikiDumper.utils.write_behind import write_behind
 
 HTML_DIR = 'html/'
 HTML_PAGR_DIR = HTML_DIR + 'pages/'
 HTML_OLDPAGE_DIR = HTML_DIR + 'attic/'
 
-exit_event = threading.Event()
-
 @dataclass
 class DumpHTMLParams:
     dump_dir: str
@@ -31,7 +36,8 @@ class DumpHTMLParams:
 
 def dump_HTML(doku_url, dump_dir,
                 session: requests.Session, threads: int = 1,
-                ignore_errors: bool = False, current_only: bool = False):
+                ignore_errors: bool = False, current_only: bool = False,
+                asession: Optional[AsyncSession] = None, budget: Optional[SharedBudget] = None):
     smkdirs(dump_dir, HTML_PAGR_DIR)
 
     titles = load_get_save_titles(dump_dir=dump_dir, url=doku_url, session=session)
@@ -39,104 +45,149 @@ def dump_HTML(doku_url, dump_dir,
     if not len(titles):
         print('Empty wiki')
         return False
+    titles = journal_filter('html', shard_filter(titles))
 
-    task_templ = DumpHTMLParams(dump_dir=dump_dir, title_index=-999, title='', doku_url=doku_url, session=session, current_only=current_only)
+    if asession is not None:
+        asyncio.run(dump_HTML_async(titles, doku_url=doku_url, dump_dir=dump_dir, session=session,
+                                    asession=asession, ignore_errors=ignore_errors, current_only=current_only))
+        return
 
-    tasks_queue: queue.Queue[DumpHTMLParams] = queue.Queue(maxsize=threads)
+    def tasks():
+        for index, title in enumerate(lease_filter('html', titles)):
+            yield DumpHTMLParams(dump_dir=dump_dir, title_index=index, title=title, doku_url=doku_url,
+                                 session=session, current_only=current_only)
 
-    def task_generator():
-        for index, title in enumerate(titles):
-            task = copy.copy(task_templ)
-            task.title_index = index
-            task.title = title
-            tasks_queue.put(task)
-            print('HTML: (%d/%d): [[%s]] ...' % (index+1, len(titles), title))
+    scheduler = Scheduler('HTML', lambda task: dump_html_page(task.payload), threads=threads, ignore_errors=ignore_errors, budget=budget,
+                          gate=host_controllers.dispatch_gate(doku_url),
+                          dead_letters=DeadLetters(dump_dir, 'html'), key=lambda payload: payload.title,
+                          describe=lambda task: 'HTML: (%d/%d): [[%s]] ...%s' % (
+                              task.index+1, len(titles), task.payload.title, host_controllers.status()))
+    scheduler.run(tasks(), total=len(titles))
 
-            if exit_event.is_set():
-                print('task generator exit (exit event set)')
-                return
 
-        tasks_queue.join()
-        print('All tasks done, terminating workers...')
-        exit_event.set()
+def _check_html_response(r: requests.Response):
+    # export_html is a alias of export_xhtml, but not exist in older versions of dokuwiki
+    r.raise_for_status()
+    if r.text is None or r.text == '':
+        raise Exception('Empty response (r.text)')
 
-    tg_thread = threading.Thread(target=task_generator, name='task-generator')
-    tg_thread.daemon = True
-    tg_thread.start()
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
-        futures = set()
-        while not exit_event.is_set():
-            try:
-                task = tasks_queue.get(timeout=1)
-            except queue.Empty:
-                continue
-            f = executor.submit(_dump_html_action, task, ignore_errors)
-            f.add_done_callback(lambda f: tasks_queue.task_done())
-            futures.add(f)
+def _non_empty(chunks: Iterable[str]) -> Iterator[str]:
+    empty = True
+    for chunk in chunks:
+        empty = empty and not chunk
+        yield chunk
+    if empty:
+        raise Exception('Empty response (r.text)')
+
+
+def _save_html(task: DumpHTMLParams, html: Iterable[str], rev: str = ''):
+    """ `html`: the page in pieces (`r.iter_text()`), written to a temporary file first (by an I/O thread with
+    `--io-threads`) """
+    title2path = task.title.replace(':', '/')
+    child_path = os.path.dirname(title2path)
+    if rev:
+        smkdirs(task.dump_dir, HTML_OLDPAGE_DIR, child_path)
+        path = task.dump_dir + '/' + HTML_OLDPAGE_DIR + title2path + '.' + rev + '.html'
+        write_history(path, _non_empty(html))
+    else:
+        smkdirs(task.dump_dir, HTML_PAGR_DIR, child_path)
+        path = task.dump_dir + '/' + HTML_PAGR_DIR + title2path + '.html'
+        write_behind.write(path, _non_empty(html))
+
 
-            if len(futures) >= threads:
-                _done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
-                for f in _done:
-                    f.result()
+def dump_html_page(task: DumpHTMLParams):
+    with task.session.get(task.doku_url, params={'do': runtime_config.export_xhtml_action, 'id': task.title},
+                          stream=True) as r:
+        r.raise_for_status()
+        _save_html(task, r.iter_text())
 
-        while futures:
-            _done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
-            for f in _done:
-                f.result()
+    msg_header = '['+str(task.title_index + 1)+']: '
 
-    tg_thread.join()
+    child_path = os.path.dirname(task.title.replace(':', '/'))
+    print(msg_header, '[[%s]]' % task.title, 'saved')
 
+    if task.current_only:
+        journal_record('html', task.title)
+        return True
 
-def _dump_html_action(task: DumpHTMLParams, ignore_errors: bool):
-    try:
-        dump_html_page(task)
-    except Exception as e:
-        if not ignore_errors:
-            raise e
+    revs = get_revisions(doku_url=task.doku_url, session=task.session, title=task.title, msg_header=msg_header)
+
+    for rev in revs[1:]:
+        if 'id' in rev and rev['id']:
+            if journal_done('html', f'{task.title}@{rev["id"]}'):
+                continue
+            try:
+                with task.session.get(task.doku_url, params={'do': runtime_config.export_xhtml_action, 'id': task.title, 'rev': rev['id']},
+                                      stream=True) as r:
+                    r.raise_for_status()
+                    _save_html(task, r.iter_text(), rev['id'])
+                print(msg_header, '    Revision %s of [[%s]] saved.' % (rev['id'], task.title))
+                journal_record('html', f'{task.title}@{rev["id"]}')
+            except requests.HTTPError as e:
+                print(msg_header, '    Revision %s of [[%s]] failed: %s' % (rev['id'], task.title, e))
         else:
-            print('[',task.title_index+1,'] Error in sub thread: (', e, ') ignored')
+            print(msg_header, '    Revision %s of [[%s]] failed: %s' % (rev['id'], task.title, 'Rev id not found (please check ?do=revisions of this page)'))
 
+    save_page_changes(dumpDir=task.dump_dir, child_path=child_path, title=task.title, 
+                       revs=revs, msg_header=msg_header)
+    journal_record('html', task.title)
 
-def dump_html_page(task: DumpHTMLParams):
-    r = task.session.get(task.doku_url, params={'do': runtime_config.export_xhtml_action, 'id': task.title})
-    # export_html is a alias of export_xhtml, but not exist in older versions of dokuwiki
-    r.raise_for_status()
-    if r.text is None or r.text == '':
-        raise Exception('Empty response (r.text)')
+
+async def dump_HTML_async(titles: List[str], *, doku_url: str, dump_dir: str, session: requests.Session,
+                          asession: AsyncSession, ignore_errors: bool = False, current_only: bool = False):
+    """ `--engine asyncio`: pages are fetched by coroutines, revision lists are still parsed by `get_revisions()`
+    (in a thread, through the `requests` session) """
+    async def _dump_html_action(index: int, title: str):
+        task = DumpHTMLParams(dump_dir=dump_dir, title_index=index, title=title, doku_url=doku_url,
+                              session=session, current_only=current_only)
+        await dump_html_page_async(asession, task)
+
+    async with asession:
+        await run_bounded(titles, _dump_html_action, label='HTML', limit=asession.connections_per_host,
+                          ignore_errors=ignore_errors, dead_letters=DeadLetters(dump_dir, 'html'))
+
+
+async def _get_html_async(asession: AsyncSession, task: DumpHTMLParams, rev: str = '') -> requests.Response:
+    params = {'do': runtime_config.export_xhtml_action, 'id': task.title}
+    if rev:
+        params['rev'] = rev
+    async with asession.get(task.doku_url, params=params) as resp:
+        r = await asession.to_requests_response(resp)
+    _check_html_response(r)
+    return r
+
+
+async def dump_html_page_async(asession: AsyncSession, task: DumpHTMLParams):
+    r = await _get_html_async(asession, task)
 
     msg_header = '['+str(task.title_index + 1)+']: '
 
-    title2path = task.title.replace(':', '/')
-    child_path = os.path.dirname(title2path)
-    html_path = task.dump_dir + '/' + HTML_PAGR_DIR + title2path + '.html'
-    smkdirs(task.dump_dir, HTML_PAGR_DIR, child_path)
-    with uopen(html_path, 'w') as f:
-        f.write(r.text)
-        print(msg_header, '[[%s]]' % task.title, 'saved')
+    child_path = os.path.dirname(task.title.replace(':', '/'))
+    await asyncio.to_thread(_save_html, task, [r.text])
+    print(msg_header, '[[%s]]' % task.title, 'saved')
 
     if task.current_only:
+        await asyncio.to_thread(journal_record, 'html', task.title)
         return True
 
-    revs = get_revisions(doku_url=task.doku_url, session=task.session, title=task.title, msg_header=msg_header)
+    revs = await asyncio.to_thread(get_revisions, doku_url=task.doku_url, session=task.session,
+                                   title=task.title, msg_header=msg_header)
 
     for rev in revs[1:]:
         if 'id' in rev and rev['id']:
+            if journal_done('html', f'{task.title}@{rev["id"]}'):
+                continue
             try:
-                r = task.session.get(task.doku_url, params={'do': runtime_config.export_xhtml_action, 'id': task.title, 'rev': rev['id']})
-                r.raise_for_status()
-                if r.text is None or r.text == '':
-                    raise Exception('Empty response (r.text)')
-                smkdirs(task.dump_dir, HTML_OLDPAGE_DIR, child_path)
-                old_html_path = task.dump_dir + '/' + HTML_OLDPAGE_DIR + title2path + '.' + rev['id'] + '.html'
-
-                with uopen(old_html_path, 'w') as f:
-                    f.write(r.text)
+                r = await _get_html_async(asession, task, rev['id'])
+                await asyncio.to_thread(_save_html, task, [r.text], rev['id'])
                 print(msg_header, '    Revision %s of [[%s]] saved.' % (rev['id'], task.title))
+                await asyncio.to_thread(journal_record, 'html', f'{task.title}@{rev["id"]}')
             except requests.HTTPError as e:
                 print(msg_header, '    Revision %s of [[%s]] failed: %s' % (rev['id'], task.title, e))
         else:
             print(msg_header, '    Revision %s of [[%s]] failed: %s' % (rev['id'], task.title, 'Rev id not found (please check ?do=revisions of this page)'))
 
-    save_page_changes(dumpDir=task.dump_dir, child_path=child_path, title=task.title, 
-                       revs=revs, msg_header=msg_header)
\ No newline at end of file
+    await asyncio.to_thread(save_page_changes, dumpDir=task.dump_dir, child_path=child_path, title=task.title,
+                            revs=revs, msg_header=msg_header)
+    await asyncio.to_thread(journal_record, 'html', task.title)
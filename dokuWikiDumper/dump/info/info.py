@@ -10,6 +10,7 @@ from bs4 import BeautifulSoup
 from bs4.element import Tag
 
 from dokuWikiDumper.utils.config import runtime_config
+from dokuWikiDumper.utils.parse_pool import parse_pool
 from dokuWikiDumper.utils.util import print_with_lock as print
 from dokuWikiDumper.utils.util import uopen
 
@@ -145,6 +146,12 @@ def save_icon(dumpDir: str, url_or_dataUrl: str, session: requests.Session):
 
 
 
+def parse_homepage(html: str):
+    '''(wiki_name, raw_title, lang, icon_href, license_url) of the homepage (runs in the `parse_pool`)'''
+    wiki_name, raw_title = get_wiki_name(html)
+    return wiki_name, raw_title, get_html_lang(html), get_raw_icon_href(html), get_license_url(html)
+
+
 def update_info(dumpDir: str, doku_url: str, session: requests.Session):
     '''Saves the info of the wiki.'''
     homepage_html = session.get(doku_url).text
@@ -157,9 +164,7 @@ def update_info(dumpDir: str, doku_url: str, session: requests.Session):
         f.write(checkpage_html)
         print('Saved checkpage to', CHECKPAGE_FILEPATH)
 
-    wiki_name, raw_title = get_wiki_name(homepage_html)
-    lang = get_html_lang(homepage_html)
-    icon_href = get_raw_icon_href(homepage_html)
+    wiki_name, raw_title, lang, icon_href, license_url = parse_pool.run(parse_homepage, homepage_html)
     icon_url = None
     if icon_href is not None and icon_href.startswith('data:image'):
         # base64 encoded data url
@@ -170,8 +175,6 @@ def update_info(dumpDir: str, doku_url: str, session: requests.Session):
 
     save_icon(dumpDir=dumpDir, url_or_dataUrl=icon_url, session=session)
 
-    license_url = get_license_url(homepage_html)
-
     info = {
         INFO_WIKI_NAME: wiki_name,
         INFO_RAW_TITLE: raw_title,
@@ -1,22 +1,26 @@
-import concurrent.futures
-import copy
+import asyncio
+import hashlib
 import os
-import queue
 import re
-import threading
 import time
 import urllib.parse as urlparse
 from dataclasses import dataclass
-from typing import Optional
+from typing import Iterable, Iterator, List, Optional
 
 import requests
 from bs4 import BeautifulSoup
 
+from dokuWikiDumper.utils.async_session import CHUNK_SIZE, AsyncSession, run_bounded, write_chunks
+from dokuWikiDumper.utils.concurrency import host_controllers
 from dokuWikiDumper.utils.config import runtime_config
+from dokuWikiDumper.utils.dead_letters import DeadLetters
+from dokuWikiDumper.utils.journal import journal_filter, journal_record
+from dokuWikiDumper.utils.leases import lease_filter
+from dokuWikiDumper.utils.rate_limit import bandwidth_limiter
+from dokuWikiDumper.utils.scheduler import Scheduler, SharedBudget
+from dokuWikiDumper.utils.shard import shard_filter
 from dokuWikiDumper.utils.util import print_with_lock as print
-from dokuWikiDumper.utils.util import smkdirs, uopen
-
-exit_event = threading.Event()
+from dokuWikiDumper.utils.util import open_atomic, smkdirs, uopen, write_atomic
 
 @dataclass
 class DumpMediaParams:
@@ -74,82 +78,73 @@ def getFiles(url, ns: str = '',  dumpDir: str = '', session: requests.Session=No
         with uopen(dumpDir + '/dumpMeta/files.txt', 'w') as f:
             f.write('\n'.join(files))
             f.write('\n--END--\n')
+        if runtime_config.state_db is not None:
+            runtime_config.state_db.set_files(files)
 
     return files
 
 
-def dump_media(*, base_url: str, dumpDir: str, session: requests.Session, threads: int = 1, ignore_errors: bool = False):
+def dump_media(*, base_url: str, dumpDir: str, session: requests.Session, threads: int = 1, ignore_errors: bool = False,
+               asession: Optional[AsyncSession] = None, budget: Optional[SharedBudget] = None):
 
     smkdirs(dumpDir + '/media')
 
     fetch = urlparse.urljoin(base_url, 'lib/exe/fetch.php')
     # media_repo = urlparse.urljoin(base_url, '_media')
 
-    files = getFiles(base_url, dumpDir=dumpDir, session=session)
-    tasks_queue: queue.Queue[DumpMediaParams] = queue.Queue(maxsize=threads)
-
-    task_templ = DumpMediaParams(dump_dir=dumpDir, base_url=base_url, session=session, fetch_url=fetch,
-                                title_index=-999, title="dokuwikidumper_placehold")
-
-    def task_generator():
-        for index, title in enumerate(files):
-            task = copy.copy(task_templ)
-            task.title_index = index
-            task.title = title
-            tasks_queue.put(task)
-            print('Media: (%d/%d): [[%s]] ...' % (index+1, len(files), title))
-
-            if exit_event.is_set():
-                print('task generator exit (exit event set)')
-                return
-
-        tasks_queue.join()
-        print('All tasks done, terminating workers...')
-        exit_event.set()
-
-    tg_thread = threading.Thread(target=task_generator, name='task-generator')
-    tg_thread.daemon = True
-    tg_thread.start()
-
-    def _dump_media_action(task: DumpMediaParams, ignore_errors: bool):
-        try:
-            download_media_file(task)
-        except Exception as e:
-            if not ignore_errors:
-                raise e
-            else:
-                print('[',task.title_index+1,'] Error in sub thread: (', e, ') ignored')
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
-        futures = set()
-        while not exit_event.is_set():
-            try:
-                task = tasks_queue.get(timeout=1)
-            except queue.Empty:
-                continue
-            f = executor.submit(_dump_media_action, task, ignore_errors)
-            f.add_done_callback(lambda f: tasks_queue.task_done())
-            futures.add(f)
+    files = journal_filter('media', shard_filter(getFiles(base_url, dumpDir=dumpDir, session=session)))
 
-            if len(futures) >= threads:
-                _done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
-                for f in _done:
-                    f.result()
+    if asession is not None:
+        asyncio.run(dump_media_async(files, base_url=base_url, fetch_url=fetch, dumpDir=dumpDir,
+                                     asession=asession, ignore_errors=ignore_errors))
+        return
 
-        while futures:
-            _done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
-            for f in _done:
-                f.result()
+    def tasks():
+        for index, title in enumerate(lease_filter('media', files)):
+            yield DumpMediaParams(dump_dir=dumpDir, base_url=base_url, session=session, fetch_url=fetch,
+                                  title_index=index, title=title)
 
-    tg_thread.join()
+    scheduler = Scheduler('Media', lambda task: download_media_file(task.payload), threads=threads, ignore_errors=ignore_errors, budget=budget,
+                          gate=host_controllers.dispatch_gate(base_url),
+                          dead_letters=DeadLetters(dumpDir, 'media'), key=lambda payload: payload.title,
+                          describe=lambda task: 'Media: (%d/%d): [[%s]] ...%s' % (
+                              task.index+1, len(files), task.payload.title, host_controllers.status()))
+    scheduler.run(tasks(), total=len(files))
 
 
-def download_media_file(task: DumpMediaParams):
-    child_path = task.title.replace(':', '/')
+def _media_file_path(dump_dir: str, title: str) -> str:
+    child_path = title.replace(':', '/')
     child_path = child_path.lstrip('/')
     child_path = '/'.join(child_path.split('/')[:-1])
-    smkdirs(task.dump_dir + '/media/' + child_path)
-    file = task.dump_dir + '/media/' + task.title.replace(':', '/')
+    smkdirs(dump_dir + '/media/' + child_path)
+    return dump_dir + '/media/' + title.replace(':', '/')
+
+
+def _set_mtime(file: str, last_modified: Optional[str]):
+    """ modify mtime based on Last-Modified header """
+    if last_modified:
+        mtime = time.mktime(time.strptime(
+            last_modified, '%a, %d %b %Y %H:%M:%S %Z'))
+        atime = os.stat(file).st_atime
+        # atime is not modified
+        os.utime(file, times=(atime, mtime))
+
+
+def _hashing(chunks: Iterable[bytes], sha1) -> Iterator[bytes]:
+    for chunk in chunks:
+        sha1.update(chunk)
+        yield chunk
+
+
+def _record_media(file: str, title: str, sha1=None):
+    """ `--state-db`: size, mtime and sha1 (of the files downloaded by this run) """
+    if runtime_config.state_db is not None:
+        st = os.stat(file)
+        runtime_config.state_db.set_media(title, st.st_size, st.st_mtime, sha1.hexdigest() if sha1 else None)
+
+
+def download_media_file(task: DumpMediaParams):
+    file = _media_file_path(task.dump_dir, task.title)
     local_size = -1
     if os.path.exists(file):
         local_size = os.path.getsize(file)
@@ -172,19 +167,51 @@ def download_media_file(task: DumpMediaParams):
             else:
                 to_download = True  # file exists but is incomplete
 
+        sha1 = None
         if to_download:
-            with open(file, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-                print('[%d] File [[%s]] Done' % (task.title_index+1, task.title))
+            sha1 = hashlib.sha1() if runtime_config.state_db is not None else None
+            chunks = bandwidth_limiter.throttle(r.iter_content(chunk_size=8192))
+            write_atomic(file, _hashing(chunks, sha1) if sha1 else chunks, binary=True)
+            print('[%d] File [[%s]] Done' % (task.title_index+1, task.title))
         else:
             r.close()
 
-        # modify mtime based on Last-Modified header
-        last_modified = r.headers.get('Last-Modified', None)
-        if last_modified:
-            mtime = time.mktime(time.strptime(
-                last_modified, '%a, %d %b %Y %H:%M:%S %Z'))
-            atime = os.stat(file).st_atime
-            # atime is not modified
-            os.utime(file, times=(atime, mtime))
+        _set_mtime(file, r.headers.get('Last-Modified', None))
+    _record_media(file, task.title, sha1)
+    journal_record('media', task.title)
+
+
+async def dump_media_async(files: List[str], *, base_url: str, fetch_url: str, dumpDir: str,
+                           asession: AsyncSession, ignore_errors: bool = False):
+    """ `--engine asyncio`: keep up to `asession.connections_per_host` downloads in flight on one thread """
+    async def _dump_media_action(index: int, title: str):
+        await download_media_file_async(asession, dumpDir, base_url, fetch_url, index, title)
+
+    async with asession:
+        await run_bounded(files, _dump_media_action, label='Media', limit=asession.connections_per_host,
+                          ignore_errors=ignore_errors, dead_letters=DeadLetters(dumpDir, 'media'))
+
+
+async def download_media_file_async(asession: AsyncSession, dump_dir: str, base_url: str, fetch_url: str,
+                                    index: int, title: str):
+    file = _media_file_path(dump_dir, title)
+    local_size = os.path.getsize(file) if os.path.exists(file) else -1
+    async with asession.get(fetch_url, params={'media': title}, headers={'Referer': base_url}) as r:
+        r.raise_for_status()
+
+        remote_size = r.content_length if r.content_length is not None else -2
+        sha1 = None
+        if local_size == remote_size:  # file exists and is complete
+            print('[%d] File [[%s]] exists (%d bytes)' % (index+1, title, local_size))
+        else:
+            if local_size != -1 and remote_size == -2:
+                print('[%d] File [[%s]] cannot get remote size ("Content-Length" missing), ' % (index+1, title) +
+                      'will re-download anyway')
+            sha1 = hashlib.sha1() if runtime_config.state_db is not None else None
+            with open_atomic(file, binary=True) as f:
+                await write_chunks(f, bandwidth_limiter.athrottle(r.content.iter_chunked(CHUNK_SIZE)), sha1)
+            print('[%d] File [[%s]] Done' % (index+1, title))
+
+        _set_mtime(file, r.headers.get('Last-Modified', None))
+    await asyncio.to_thread(_record_media, file, title, sha1)
+    await asyncio.to_thread(journal_record, 'media', title)
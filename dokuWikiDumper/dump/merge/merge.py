@@ -0,0 +1,180 @@
+import argparse
+import filecmp
+import json
+import os
+import shutil
+import sys
+from typing import Dict, List, Optional
+
+from dokuWikiDumper.dump.doku_dumper import STAGE_MARKS
+from dokuWikiDumper.dump.html.html import HTML_OLDPAGE_DIR, HTML_PAGR_DIR
+from dokuWikiDumper.dump.pdf.pdf import PDF_PAGR_DIR
+from dokuWikiDumper.utils.compression import COMPRESSED_SUFFIXES, history_exists
+from dokuWikiDumper.utils.config import get_config
+from dokuWikiDumper.utils.dump_lock import LOCK_FILENAME
+from dokuWikiDumper.utils.util import load_titles, smkdirs, uopen
+from dokuWikiDumper.utils.util import print_with_lock as print
+
+MISSING_FILE = 'dumpMeta/merge_missing.txt'
+
+
+def getArgumentParser():
+    parser = argparse.ArgumentParser(
+        prog='dokuWikiDumper merge',
+        description='Merge the shards of a dump (made with --shard INDEX/COUNT) into one dump directory. '
+                    'Stage marks are only written when every title/file of the stage is present.')
+    parser.add_argument('output', help='merged dump directory (created if needed)')
+    parser.add_argument('shards', nargs='+', help='shard dump directories, in any order')
+    parser.add_argument('--allow-missing', action='store_true',
+                        help='write the marks even if some items are missing (e.g. pages with "Action disabled: edit"). '
+                        'The missing items are listed in ' + MISSING_FILE)
+    return parser
+
+
+def expected_files(stage: str, name: str, current_only: bool) -> List[str]:
+    """ Files a finished stage has written for a title (or a media file), relative to the dump dir """
+    path = name.replace(':', '/')
+    changes = [] if current_only else ['meta/' + path + '.changes']
+    if stage == 'content':
+        return ['pages/' + path + '.txt'] + changes
+    if stage == 'html':
+        return [HTML_PAGR_DIR + path + '.html'] + changes
+    if stage == 'pdf':
+        return [PDF_PAGR_DIR + path + '.pdf']
+    if stage == 'media':
+        return ['media/' + path]
+    raise ValueError(f'unknown stage: {stage}')
+
+
+def is_history(rel_path: str) -> bool:
+    """ an old revision (`attic/`, `html/attic/`), plain or compressed (--compress-history) """
+    rel_path = rel_path.replace(os.sep, '/')
+    return rel_path.startswith('attic/') or rel_path.startswith(HTML_OLDPAGE_DIR)
+
+
+def strip_compressed(path: str) -> str:
+    for suffix in COMPRESSED_SUFFIXES:
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+def check_shards(shard_dirs: List[str]) -> Dict[int, str]:
+    """ Every shard of the same wiki and the same split, exactly once: {index: dir} """
+    by_index: Dict[int, str] = {}
+    counts, urls = set(), set()
+    for shard_dir in shard_dirs:
+        config = get_config(shard_dir)
+        if 'shard' not in config:
+            raise ValueError(f'{shard_dir} is not a shard (no "shard" in dumpMeta/config.json)')
+        index, count = config['shard']
+        if index in by_index:
+            raise ValueError(f'shard {index}/{count} given twice: {by_index[index]} and {shard_dir}')
+        by_index[index] = shard_dir
+        counts.add(count)
+        urls.add(config.get('doku_url'))
+    if len(counts) != 1:
+        raise ValueError(f'shards of different splits: {sorted(counts)}')
+    if len(urls) != 1:
+        raise ValueError(f'shards of different wikis: {sorted(map(str, urls))}')
+    missing = set(range(counts.pop())) - set(by_index)
+    if missing:
+        raise ValueError(f'missing shards: {sorted(missing)}')
+    return dict(sorted(by_index.items()))
+
+
+def check_lists(shards: Dict[int, str], filename: str) -> Optional[List[str]]:
+    """ The shards must have split the same list, otherwise items can fall between them """
+    lists = {index: load_titles(os.path.join(shard_dir, 'dumpMeta', filename)) for index, shard_dir in shards.items()}
+    present = {index: items for index, items in lists.items() if items is not None}
+    if not present:
+        return None
+    reference_index, reference = next(iter(present.items()))
+    for index, items in present.items():
+        if set(items) != set(reference):
+            raise ValueError(f'dumpMeta/{filename} of shard {index} differs from shard {reference_index}, '
+                             f'copy the same dumpMeta/{filename} to every shard before dumping')
+    return reference
+
+
+def copy_tree(src: str, dst: str, include_meta: bool) -> List[str]:
+    """ Copy the files of a shard, return the conflicts (same path, different content) """
+    conflicts = []
+    for root, dirs, files in os.walk(src):
+        rel_root = os.path.relpath(root, src)
+        if rel_root == '.' and not include_meta:
+            dirs[:] = [d for d in dirs if d != 'dumpMeta']
+        for filename in files:
+            rel_path = os.path.normpath(os.path.join(rel_root, filename))
+            if rel_path in STAGE_MARKS.values() or rel_path == LOCK_FILENAME:
+                continue
+            target = os.path.join(dst, rel_path)
+            if os.path.exists(target):
+                if not filecmp.cmp(os.path.join(root, filename), target, shallow=False):
+                    conflicts.append(rel_path)
+                continue
+            if is_history(rel_path) and history_exists(strip_compressed(target)):
+                # the same old revision, written with another --compress-history
+                continue
+            smkdirs(dst, os.path.dirname(rel_path))
+            shutil.copy2(os.path.join(root, filename), target)
+    return conflicts
+
+
+def merge(params: List[str]):
+    args = getArgumentParser().parse_args(params)
+    try:
+        shards = check_shards(args.shards)
+        lists = {'titles.txt': check_lists(shards, 'titles.txt'), 'files.txt': check_lists(shards, 'files.txt')}
+    except ValueError as e:
+        print('Cannot merge:', e)
+        sys.exit(1)
+
+    output = args.output.rstrip('/')
+    smkdirs(output, '/dumpMeta')
+    for index, shard_dir in shards.items():
+        print(f'Merging shard {index}/{len(shards)}: {shard_dir}')
+        # dumpMeta (info, titles.txt, files.txt...) is the same in every shard, take the first one's
+        conflicts = copy_tree(shard_dir, output, include_meta=(index == 0))
+        for conflict in conflicts:
+            print(f'    conflict: {conflict} differs from an earlier shard, kept the earlier one')
+
+    config = get_config(shards[0])
+    current_only = config.pop('current_only', False)
+    config.pop('shard', None)
+    config['merged_shards'] = len(shards)
+    with uopen(os.path.join(output, 'dumpMeta', 'config.json'), 'w') as f:
+        json.dump(config, f, indent=4, ensure_ascii=False)
+
+    all_missing: List[str] = []
+    complete = True
+    for stage, mark in STAGE_MARKS.items():
+        finished = [os.path.exists(os.path.join(shard_dir, mark)) for shard_dir in shards.values()]
+        if not any(finished):
+            continue
+        if not all(finished):
+            unfinished = [index for index, done in zip(shards, finished) if not done]
+            print(f'{stage}: not finished in shards {unfinished}, no mark written')
+            complete = False
+            continue
+        names = lists['files.txt' if stage == 'media' else 'titles.txt'] or []
+        missing = [path for name in names for path in expected_files(stage, name, current_only)
+                   if not os.path.exists(os.path.join(output, path))]
+        all_missing += missing
+        print(f'{stage}: {len(names)} items, {len(missing)} files missing')
+        for path in missing[:20]:
+            print('    missing:', path)
+        if missing and not args.allow_missing:
+            complete = False
+            continue
+        with open(os.path.join(output, mark), 'w') as f:
+            f.write('done')
+
+    if all_missing:
+        with uopen(os.path.join(output, MISSING_FILE), 'w') as f:
+            f.write('\n'.join(all_missing) + '\n')
+    elif os.path.exists(os.path.join(output, MISSING_FILE)):
+        os.remove(os.path.join(output, MISSING_FILE))
+    print('\n\n--Done--' if complete else '\n\nMerged, but the dump is incomplete (see above)')
+    if not complete:
+        sys.exit(1)
@@ -1,23 +1,28 @@
-import concurrent.futures
-import copy
+import asyncio
 import os
-import queue
-import threading
 from dataclasses import dataclass
+from typing import List, Optional
 
 import requests
 
 from dokuWikiDumper.dump.content.revisions import get_revisions
 from dokuWikiDumper.dump.content.titles import load_get_save_titles
 from dokuWikiDumper.exceptions import DispositionHeaderMissingError
+from dokuWikiDumper.utils.async_session import CHUNK_SIZE, AsyncSession, run_bounded, write_chunks
+from dokuWikiDumper.utils.concurrency import host_controllers
+from dokuWikiDumper.utils.dead_letters import DeadLetters
+from dokuWikiDumper.utils.journal import journal_filter, journal_record
+from dokuWikiDumper.utils.leases import lease_filter
+from dokuWikiDumper.utils.rate_limit import bandwidth_limiter
+from dokuWikiDumper.utils.scheduler import Scheduler, SharedBudget
+from dokuWikiDumper.utils.shard import shard_filter
 from dokuWikiDumper.utils.util import print_with_lock as print
-from dokuWikiDumper.utils.util import smkdirs
+from dokuWikiDumper.utils.util import open_atomic, smkdirs, write_atomic
 
 PDF_DIR = 'pdf/'
 PDF_PAGR_DIR = PDF_DIR + 'pages/'
 PDF_OLDPAGE_DIR = PDF_DIR + 'attic/'
-
-exit_event = threading.Event()
+PDF_CHUNK_SIZE = 64 * 1024
 
 
 @dataclass
@@ -32,69 +37,31 @@ class DumpPDFParams:
 
 def dump_PDF(doku_url, dump_dir,
                   session: requests.Session, threads: int = 1,
-                  ignore_errors: bool = False, current_only: bool = False):
+                  ignore_errors: bool = False, current_only: bool = False,
+                  asession: Optional[AsyncSession] = None, budget: Optional[SharedBudget] = None):
     titles = load_get_save_titles(dump_dir=dump_dir, url=doku_url, session=session)
     
     if not len(titles):
         print('Empty wiki')
         return False
-    
-    task_templ = DumpPDFParams(dump_dir=dump_dir, doku_url=doku_url, session=session, current_only=current_only,
-                              title_index=-999, title="dokuwikidumper_placehold")
-
-    tasks_queue: queue.Queue[DumpPDFParams] = queue.Queue(maxsize=threads)
-
-    def task_generator():
-        for index, title in enumerate(titles):
-            task = copy.copy(task_templ)
-            task.title_index = index
-            task.title = title
-            tasks_queue.put(task)
-            print('PDF: (%d/%d): [[%s]] ...' % (index+1, len(titles), title))
-
-            if exit_event.is_set():
-                print('task generator exit (exit event set)')
-                return
-
-        tasks_queue.join()
-        print('All tasks done, terminating workers...')
-        exit_event.set()
-
-    tg_thread = threading.Thread(target=task_generator, name='task-generator')
-    tg_thread.daemon = True
-    tg_thread.start()
-
-    def _dump_pdf_action(task: DumpPDFParams, ignore_errors: bool):
-        try:
-            dump_pdf_page(task)
-        except Exception as e:
-            if not ignore_errors:
-                raise e
-            else:
-                print('[',task.title_index+1,'] Error in sub thread: (', e, ') ignored')
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
-        futures = set()
-        while not exit_event.is_set():
-            try:
-                task = tasks_queue.get(timeout=1)
-            except queue.Empty:
-                continue
-            f = executor.submit(_dump_pdf_action, task, ignore_errors)
-            f.add_done_callback(lambda f: tasks_queue.task_done())
-            futures.add(f)
+    titles = journal_filter('pdf', shard_filter(titles))
 
-            if len(futures) >= threads:
-                _done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
-                for f in _done:
-                    f.result()
-
-        while futures:
-            _done, futures = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
-            for f in _done:
-                f.result()
+    if asession is not None:
+        asyncio.run(dump_PDF_async(titles, doku_url=doku_url, dump_dir=dump_dir, session=session,
+                                   asession=asession, ignore_errors=ignore_errors, current_only=current_only))
+        return
+    
+    def tasks():
+        for index, title in enumerate(lease_filter('pdf', titles)):
+            yield DumpPDFParams(dump_dir=dump_dir, doku_url=doku_url, session=session, current_only=current_only,
+                                title_index=index, title=title)
 
-    tg_thread.join()
+    scheduler = Scheduler('PDF', lambda task: dump_pdf_page(task.payload), threads=threads, ignore_errors=ignore_errors, budget=budget,
+                          gate=host_controllers.dispatch_gate(doku_url),
+                          dead_letters=DeadLetters(dump_dir, 'pdf'), key=lambda payload: payload.title,
+                          describe=lambda task: 'PDF: (%d/%d): [[%s]] ...%s' % (
+                              task.index+1, len(titles), task.payload.title, host_controllers.status()))
+    scheduler.run(tasks(), total=len(titles))
 
 
 def dump_pdf_page(task: DumpPDFParams):
@@ -104,6 +71,8 @@ def dump_pdf_page(task: DumpPDFParams):
     local_size = -1
     if os.path.isfile(file):
         local_size = os.path.getsize(file)
+    child_path = task.title.replace(':', '/')
+    child_dir = os.path.dirname(child_path)
     with task.session.get(task.doku_url, params={'do': 'export_pdf', 'id': task.title}, stream=True) as r:
         r.raise_for_status()
         if 'Content-Disposition' not in r.headers:
@@ -113,15 +82,13 @@ def dump_pdf_page(task: DumpPDFParams):
         if local_size == remote_size:
             print(msg_header, '[[%s]]' % task.title, 'already exists')
         else:
-            child_path = task.title.replace(':', '/')
-            child_dir = os.path.dirname(child_path)
             smkdirs(task.dump_dir, PDF_PAGR_DIR, child_dir)
-            with open(file, 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
+            write_atomic(file, bandwidth_limiter.throttle(r.iter_content(chunk_size=PDF_CHUNK_SIZE)),
+                         binary=True)
             print(msg_header, '[[%s]]' % task.title, 'saved')
 
     if task.current_only:
+        journal_record('pdf', task.title)
         return True
 
     revs = get_revisions(doku_url=task.doku_url, session=task.session, title=task.title, msg_header=msg_header)
@@ -129,14 +96,69 @@ def dump_pdf_page(task: DumpPDFParams):
     for rev in revs[1:]:
         if 'id' in rev and rev['id']:
             try:
-                r = task.session.get(task.doku_url, params={'do': 'export_pdf', 'id': task.title, 'rev': rev['id']})
-                r.raise_for_status()
-                content = r.content
-                smkdirs(task.dump_dir, PDF_OLDPAGE_DIR, child_dir)
-                old_pdf_path = task.dump_dir + '/' + PDF_OLDPAGE_DIR + child_path + '.' + rev['id'] + '.pdf'
-
-                with open(old_pdf_path, 'bw') as f:
-                    f.write(content)
+                with task.session.get(task.doku_url, params={'do': 'export_pdf', 'id': task.title, 'rev': rev['id']},
+                                      stream=True) as r:
+                    r.raise_for_status()
+                    smkdirs(task.dump_dir, PDF_OLDPAGE_DIR, child_dir)
+                    old_pdf_path = task.dump_dir + '/' + PDF_OLDPAGE_DIR + child_path + '.' + rev['id'] + '.pdf'
+                    write_atomic(old_pdf_path, bandwidth_limiter.throttle(r.iter_content(chunk_size=PDF_CHUNK_SIZE)),
+                                 binary=True)
                 print(msg_header, '    Revision %s of [[%s]] saved.' % (rev['id'], task.title))
             except requests.HTTPError as e:
-                print(msg_header, '    Revision %s of [[%s]] failed: %s' % (rev['id'], task.title, e))
\ No newline at end of file
+                print(msg_header, '    Revision %s of [[%s]] failed: %s' % (rev['id'], task.title, e))
+    journal_record('pdf', task.title)
+
+
+async def dump_PDF_async(titles: List[str], *, doku_url: str, dump_dir: str, session: requests.Session,
+                         asession: AsyncSession, ignore_errors: bool = False, current_only: bool = False):
+    """ `--engine asyncio`, see `dump_HTML_async()` """
+    async def _dump_pdf_action(index: int, title: str):
+        task = DumpPDFParams(dump_dir=dump_dir, title=title, title_index=index, doku_url=doku_url,
+                             session=session, current_only=current_only)
+        await dump_pdf_page_async(asession, task)
+
+    async with asession:
+        await run_bounded(titles, _dump_pdf_action, label='PDF', limit=asession.connections_per_host,
+                          ignore_errors=ignore_errors, dead_letters=DeadLetters(dump_dir, 'pdf'))
+
+
+async def dump_pdf_page_async(asession: AsyncSession, task: DumpPDFParams):
+    msg_header = '['+str(task.title_index + 1)+']: '
+
+    child_path = task.title.replace(':', '/')
+    child_dir = os.path.dirname(child_path)
+    file = task.dump_dir + '/' + PDF_PAGR_DIR + child_path + '.pdf'
+    local_size = os.path.getsize(file) if os.path.isfile(file) else -1
+    async with asession.get(task.doku_url, params={'do': 'export_pdf', 'id': task.title}) as r:
+        r.raise_for_status()
+        if 'Content-Disposition' not in r.headers:
+            raise DispositionHeaderMissingError(r)
+        remote_size = r.content_length if r.content_length is not None else -2
+
+        if local_size == remote_size:
+            print(msg_header, '[[%s]]' % task.title, 'already exists')
+        else:
+            smkdirs(task.dump_dir, PDF_PAGR_DIR, child_dir)
+            with open_atomic(file, binary=True) as f:
+                await write_chunks(f, bandwidth_limiter.athrottle(r.content.iter_chunked(CHUNK_SIZE)))
+            print(msg_header, '[[%s]]' % task.title, 'saved')
+
+    if task.current_only:
+        await asyncio.to_thread(journal_record, 'pdf', task.title)
+        return True
+
+    revs = await asyncio.to_thread(get_revisions, doku_url=task.doku_url, session=task.session,
+                                   title=task.title, msg_header=msg_header)
+
+    for rev in revs[1:]:
+        if 'id' in rev and rev['id']:
+            async with asession.get(task.doku_url, params={'do': 'export_pdf', 'id': task.title, 'rev': rev['id']}) as r:
+                if not r.ok:
+                    print(msg_header, '    Revision %s of [[%s]] failed: HTTP %s' % (rev['id'], task.title, r.status))
+                    continue
+                smkdirs(task.dump_dir, PDF_OLDPAGE_DIR, child_dir)
+                old_pdf_path = task.dump_dir + '/' + PDF_OLDPAGE_DIR + child_path + '.' + rev['id'] + '.pdf'
+                with open_atomic(old_pdf_path, binary=True) as f:
+                    await write_chunks(f, bandwidth_limiter.athrottle(r.content.iter_chunked(CHUNK_SIZE)))
+            print(msg_header, '    Revision %s of [[%s]] saved.' % (rev['id'], task.title))
+    await asyncio.to_thread(journal_record, 'pdf', task.title)
@@ -0,0 +1,114 @@
+import dataclasses
+import multiprocessing
+import os
+import signal
+import sys
+from dataclasses import dataclass
+from typing import List
+
+from dokuWikiDumper.utils.config import runtime_config
+from dokuWikiDumper.utils.journal import ProgressJournal
+from dokuWikiDumper.utils.leases import LEASES_FILE, LeaseLog
+from dokuWikiDumper.utils.rate_limit import BANDWIDTH_FILE, SharedTokenBucket, bandwidth_limiter
+from dokuWikiDumper.utils.shutdown import EXIT_INTERRUPTED, ShutdownRequested, shutdown
+from dokuWikiDumper.utils.state_db import StateDB
+from dokuWikiDumper.utils.util import print_with_lock as print
+from dokuWikiDumper.utils.write_behind import write_behind
+
+
+@dataclass
+class ProcessWorker:
+    """ What a worker process of `--processes` gets from its parent """
+    index: int
+    stages: List[str]
+    dump_dir: str
+    doku_url: str
+    base_url: str
+    cookies: dict
+    """ incl. the login cookies of the parent """
+    rate_limiter: SharedTokenBucket
+    bandwidth_bucket: SharedTokenBucket
+    """ of `--bandwidth`, one cap for all the workers """
+    runtime_config: dict
+
+
+def _worker_main(args, worker: ProcessWorker):
+    from dokuWikiDumper.dump.doku_dumper import build_stages, hijack_session, new_session, released, run_stages
+
+    for key, value in worker.runtime_config.items():
+        setattr(runtime_config, key, value)
+    runtime_config.leases = LeaseLog(os.path.join(worker.dump_dir, LEASES_FILE))
+    runtime_config.state_db = StateDB(worker.dump_dir) if args.state_db else None
+    runtime_config.journal = runtime_config.state_db or ProgressJournal(worker.dump_dir)
+    print(f'Worker {worker.index} (pid {os.getpid()}) started')
+
+    session = new_session(args)
+    session.cookies.update(worker.cookies)
+    session_monkey = hijack_session(args, session, worker.rate_limiter)
+    bandwidth_limiter.configure(args.bandwidth, control_file=os.path.join(worker.dump_dir, BANDWIDTH_FILE),
+                                bucket=worker.bandwidth_bucket)
+    write_behind.configure(args.io_threads, args.io_queue)
+    # Ctrl-C reaches the whole process group: the parent forwards it as SIGTERM, once for a graceful stop,
+    # twice to abort
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    shutdown.install(args.shutdown_timeout, signals=(signal.SIGTERM,))
+    interrupted = False
+    with released(args, session_monkey, prefix=f'Worker {worker.index} '):
+        try:
+            stages = build_stages(args, doku_url=worker.doku_url, base_url=worker.base_url,
+                                  dump_dir=worker.dump_dir, session=session, rate_limiter=worker.rate_limiter)
+            run_stages(args, [stage for stage in stages if stage[0] in worker.stages], dump_dir=worker.dump_dir,
+                       marks=False)
+        except ShutdownRequested as e:
+            print(f'Worker {worker.index}: {e}')
+            interrupted = True
+    if interrupted:
+        sys.exit(EXIT_INTERRUPTED)
+
+
+def run_worker_processes(args, stages: List[str], *, dump_dir: str, doku_url: str, base_url: str,
+                         cookies: dict) -> bool:
+    """ Run `stages` on `args.processes` worker processes sharing `dump_dir`, return whether all of them succeeded.
+
+    The caller holds the `DumpLock` of the dump: the workers coordinate through per-item leases instead.
+    """
+    LeaseLog.reset(os.path.join(dump_dir, LEASES_FILE))
+    rate_limiter = SharedTokenBucket(1 / args.delay if args.delay > 0 else 0.0, burst=args.burst)
+    bandwidth_bucket = SharedTokenBucket()  # rate set by the workers, they follow the same control file
+    config = {field.name: getattr(runtime_config, field.name)
+              for field in dataclasses.fields(runtime_config) if field.name not in ('leases', 'journal', 'state_db')}
+
+    ctx = multiprocessing.get_context('spawn')
+    processes = []
+    for index in range(args.processes):
+        worker = ProcessWorker(index=index, stages=stages, dump_dir=dump_dir, doku_url=doku_url, base_url=base_url,
+                               cookies=cookies, rate_limiter=rate_limiter, bandwidth_bucket=bandwidth_bucket,
+                               runtime_config=config)
+        process = ctx.Process(target=_worker_main, args=(args, worker), name=f'dump-worker-{index}')
+        process.start()
+        processes.append(process)
+    print(f'Started {len(processes)} worker processes ({args.threads} threads each) for: {", ".join(stages)}')
+
+    forwarded = False
+    try:
+        while any(process.is_alive() for process in processes):
+            if shutdown.requested and not forwarded:
+                forwarded = True
+                for process in processes:
+                    process.terminate()  # SIGTERM: the workers finish their items in progress
+            for process in processes:
+                process.join(timeout=0.5)
+    except KeyboardInterrupt:
+        # signal received twice: so do the workers
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+        raise
+    if shutdown.requested:
+        raise ShutdownRequested(f'{shutdown.reason}: worker processes stopped')
+    failed = [process.name for process in processes if process.exitcode != 0]
+    if failed:
+        print(f'Worker processes failed: {", ".join(failed)}')
+    return not failed
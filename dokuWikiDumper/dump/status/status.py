@@ -0,0 +1,33 @@
+import argparse
+import os
+import sys
+from typing import List
+
+from dokuWikiDumper.utils.state_db import STATE_DB_FILE, StateDB
+from dokuWikiDumper.utils.util import print_with_lock as print
+
+
+def getArgumentParser():
+    parser = argparse.ArgumentParser(
+        prog='dokuWikiDumper status',
+        description='Progress of a dump made with --state-db: pages, revisions and media files done and left.')
+    parser.add_argument('dump_dir', help='dump directory')
+    return parser
+
+
+def status(params: List[str]):
+    args = getArgumentParser().parse_args(params)
+    if not os.path.exists(os.path.join(args.dump_dir, STATE_DB_FILE)):
+        print(f'{args.dump_dir}: no {STATE_DB_FILE} (dumped without --state-db)')
+        sys.exit(1)
+
+    db = StateDB(args.dump_dir)
+    try:
+        failed = db.failed()
+        for stage, counts in db.progress().items():
+            parts = [f'{kind} {done}/{total} ({total - done} left)' for kind, (done, total) in counts.items()]
+            if failed.get(stage):
+                parts.append(f'{failed[stage]} failing')
+            print(f'{stage}: ' + ', '.join(parts))
+    finally:
+        db.close()
@@ -0,0 +1,286 @@
+import asyncio
+import importlib.util
+import time
+from contextlib import asynccontextmanager
+from email.utils import mktime_tz, parsedate_tz
+from typing import IO, AsyncIterable, Awaitable, Callable, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+import requests.structures
+import requests.utils
+
+from dokuWikiDumper.utils.concurrency import BACKOFF_STATUS, host_controllers, is_timeout, retry_budget
+from dokuWikiDumper.utils.dead_letters import DEAD_LETTERS_FILE, DeadLetters
+from dokuWikiDumper.utils.rate_limit import TokenBucket
+from dokuWikiDumper.utils.shutdown import ShutdownRequested, shutdown
+from dokuWikiDumper.utils.util import print_with_lock as print
+from dokuWikiDumper.utils.watchdog import watchdog
+from dokuWikiDumper.utils.write_behind import write_behind
+
+# keep in sync with `create_session()`
+RETRY_STATUS = (500, 502, 503, 504, 429)
+BACKOFF_FACTOR = 1.5
+BACKOFF_MAX = 120
+CHUNK_SIZE = 64 * 1024
+""" of the downloads written to disk, each write is a hop to a thread """
+
+
+def aiohttp_available() -> bool:
+    return importlib.util.find_spec('aiohttp') is not None
+
+
+def aiohttp_accept_encoding() -> str:
+    """ The session's `Accept-Encoding` can list encodings only urllib3 can decode """
+    from aiohttp import compression_utils
+
+    encodings = ['gzip', 'deflate']
+    if getattr(compression_utils, 'HAS_BROTLI', False):
+        encodings.append('br')
+    if getattr(compression_utils, 'HAS_ZSTD', False):
+        encodings.append('zstd')
+    return ', '.join(encodings)
+
+
+class AsyncSession:
+    """ asyncio counterpart of `create_session()` + `SessionMonkeyPatch`, built on `aiohttp`.
+
+    Same semantics as the threaded engine:
+    - `retries`: retries on connection errors and `RETRY_STATUS` with exponential backoff (or `Retry-After`)
+    - `hard_retries`: retries the whole request again if it still fails
+    - `rate_limiter` and `Retry-After` pauses are shared with the threaded workers
+    - `to_requests_response()` goes through the patched `requests.Response.text` (encoding fallback, PHP warnings trimming)
+
+    Headers, cookies, proxies and `verify` are copied from the `requests.Session`.
+    """
+    def __init__(self, session: requests.Session, *, retries: int = 5, hard_retries: int = 3,
+                 connections_per_host: int = 32, rate_limiter: Optional[TokenBucket] = None):
+        if not aiohttp_available():
+            raise ModuleNotFoundError('--engine asyncio requires aiohttp: pip install aiohttp')
+
+        self.session = session
+        self.retries = retries
+        self.hard_retries = hard_retries
+        self.connections_per_host = connections_per_host
+        self.rate_limiter = rate_limiter
+        self.client = None
+
+    async def __aenter__(self):
+        import aiohttp
+
+        connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.connections_per_host,
+                                         ssl=None if self.session.verify else False)
+        self.client = aiohttp.ClientSession(connector=connector,
+                                            headers={**self.session.headers,
+                                                     'Accept-Encoding': aiohttp_accept_encoding()},
+                                            cookies=self.session.cookies.get_dict(),
+                                            auto_decompress=True, trust_env=True)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self.client is not None:
+            await self.client.close()
+
+    def _proxy(self, url: str) -> Optional[str]:
+        return self.session.proxies.get(urlparse(url).scheme) if self.session.proxies else None
+
+    async def _wait_courtesy(self, host: str):
+        controller = host_controllers.get(host)
+        while (remaining := controller.pause_until - time.monotonic()) > 0:
+            watchdog.waiting()
+            await asyncio.sleep(min(remaining, 1.0))
+        while (delay := controller.breaker.admit()) > 0:
+            watchdog.waiting()
+            await asyncio.sleep(min(delay, 1.0))
+        if self.rate_limiter is not None:
+            wait = self.rate_limiter.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+    async def _send(self, method: str, url: str, **kwargs):
+        """ One request with urllib3-like retries, returns an unread `aiohttp.ClientResponse` """
+        import aiohttp
+
+        host = urlparse(url).netloc
+        controller = host_controllers.get(host)
+        errors = 0
+        while True:
+            shutdown.check()
+            await self._wait_courtesy(host)
+            response = None
+            timeouts = controller.timeouts.get()
+            # aiohttp's default is a 5 minutes total, which large media files can exceed while still downloading
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeouts[0] if timeouts else None,
+                                            sock_read=timeouts[1] if timeouts else None)
+            start = time.monotonic()
+            try:
+                response = await self.client.request(method, url, proxy=self._proxy(url),
+                                                     **{'timeout': timeout, **kwargs})
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if is_timeout(e):
+                    controller.timeouts.on_timeout()
+                controller.breaker.on_failure(type(e).__name__)
+                if errors >= self.retries or not retry_budget.try_retry():
+                    raise
+                controller.decrease('connection error')
+            else:
+                if response.status >= 500:
+                    controller.breaker.on_failure(f'HTTP {response.status}')
+                else:
+                    controller.breaker.on_success()
+                watchdog.beat()
+                if response.status < 400 and errors == 0:
+                    controller.timeouts.observe_read(time.monotonic() - start)
+                if response.status not in RETRY_STATUS or errors >= self.retries or not retry_budget.try_retry():
+                    return response
+
+            errors += 1
+            retry_after = None
+            if response is not None:
+                retry_after = self._parse_retry_after(response.headers.get('Retry-After'))
+                response.release()
+            backoff = 0.0 if errors <= 1 else min(BACKOFF_MAX, BACKOFF_FACTOR * (2 ** (errors - 1)))
+            delay_sec = retry_after if retry_after is not None else backoff
+            if response is None:
+                print('req retry in %.2fs' % delay_sec)
+            else:
+                print('req retry (%s, %s) in %.2fs' % (response.status, response.reason, delay_sec))
+                controller = host_controllers.get(host)
+                if retry_after is not None:
+                    controller.pause(retry_after, reason='(Retry-After)')
+                    controller.decrease('Retry-After')
+                elif response.status in BACKOFF_STATUS:
+                    controller.decrease(f'HTTP {response.status}')
+            await asyncio.sleep(delay_sec)
+
+    @staticmethod
+    def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            parsed = parsedate_tz(value)  # HTTP-date
+            if parsed is None:
+                return None
+            return max(0.0, mktime_tz(parsed) - time.time())
+
+    @asynccontextmanager
+    async def get(self, url: str, **kwargs):
+        """ `async with asession.get(url, params=...) as resp:`, with hard retries """
+        import aiohttp
+
+        hard_retries = self.hard_retries + 1
+        retry_budget.on_request()
+        while True:
+            try:
+                response = await self._send('GET', url, **kwargs)
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                hard_retries -= 1
+                if hard_retries <= 0 or not retry_budget.try_retry():
+                    raise
+                print('Hard retry... (%d), due to: %s' % (hard_retries, e))
+        try:
+            yield response
+        finally:
+            response.release()
+
+    @staticmethod
+    async def to_requests_response(response) -> requests.Response:
+        """ Read the body into a `requests.Response`, so `.text` has the same semantics as the threaded engine """
+        body = await response.read()
+        r = requests.Response()
+        r.status_code = response.status
+        r.reason = response.reason or ''
+        r.url = str(response.url)
+        r.headers = requests.structures.CaseInsensitiveDict(response.headers)
+        r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+        r._content = body
+        return r
+
+
+async def write_chunks(f: IO[bytes], chunks: AsyncIterable[bytes], sha1=None):
+    """ Write a download to `f` from a thread (`asyncio.to_thread()`), the event loop is not blocked by the disk """
+    async for chunk in chunks:
+        await asyncio.to_thread(f.write, chunk)
+        if sha1 is not None:
+            sha1.update(chunk)
+
+
+async def run_bounded(items: List[str], action: Callable[[int, str], Awaitable], *,
+                      label: str, limit: int, ignore_errors: bool = False,
+                      dead_letters: Optional[DeadLetters] = None):
+    """ Run `await action(index, item)` for every item, at most `limit` at once.
+
+    Coroutines are created lazily (bounded look-ahead), so a million-file wiki doesn't create a million tasks upfront.
+    `dead_letters`: like `Scheduler`, the failed items are recorded and tried once more at the end, one at a time.
+    On SIGINT/SIGTERM (`shutdown`), like `Scheduler`: the in-flight items get until the deadline, then are cancelled.
+
+    `action` runs its blocking calls (file writes, journal) on `asyncio.to_thread()`, each item is a
+    `write_behind.item()`: its write errors are its own.
+    """
+    in_flight = asyncio.Semaphore(limit)
+    pending = set()
+    dead: List[Tuple[int, str]] = []
+    previously_dead = dead_letters.missing() if dead_letters is not None else {}
+    retry_pass = False
+    failed = 0
+
+    async def _action(index: int, item: str):
+        nonlocal failed
+        try:
+            with write_behind.item():
+                await action(index, item)
+            if dead_letters is not None and (retry_pass or previously_dead.pop(item, None) is not None):
+                dead_letters.resolve(item)
+        except Exception as e:
+            if shutdown.requested:
+                print('[', index + 1, '] interrupted: (', e, ')')
+                return
+            if dead_letters is not None:
+                dead_letters.add(item, e)
+                if not retry_pass:
+                    dead.append((index, item))
+                    print('[', index + 1, '] failed, will be retried at the end of the stage: (', e, ')')
+                    return
+            elif not ignore_errors:
+                raise e
+            failed += 1
+            print('[', index + 1, '] Error in coroutine: (', e, ') ignored')
+        finally:
+            in_flight.release()
+
+    for index, item in enumerate(items):
+        await in_flight.acquire()
+        if shutdown.requested:
+            break
+        print('%s: (%d/%d): [[%s]] ...' % (label, index+1, len(items), item))
+        pending.add(asyncio.create_task(_action(index, item)))
+        # raise early if an item failed and errors are not ignored (a task leaves `pending` here only)
+        for done in [t for t in pending if t.done()]:
+            pending.discard(done)
+            done.result()
+    while pending:
+        # poll: the signal handler doesn't wake up the event loop
+        done, pending = await asyncio.wait(pending, timeout=0.5)
+        for task in done:
+            task.result()
+        if shutdown.expired and pending:
+            print(f'{label}: cancelling {len(pending)} items in progress')
+            for task in pending:
+                task.cancel()  # their files are written atomically, nothing is left behind
+            await asyncio.gather(*pending, return_exceptions=True)
+            pending = set()
+    if shutdown.requested:
+        raise ShutdownRequested(f'{label}: stopped by {shutdown.reason}')
+
+    if dead:
+        print(f'{label}: retrying {len(dead)} failed items one at a time...')
+        retry_pass = True
+        for index, item in dead:
+            await in_flight.acquire()
+            print('%s: (%d/%d): [[%s]] ...' % (label, index+1, len(items), item))
+            await _action(index, item)
+        if failed and not ignore_errors:
+            raise RuntimeError(f'{label}: {failed} items still failing after the retry pass, see {DEAD_LETTERS_FILE}')
@@ -0,0 +1,65 @@
+import importlib.util
+import os
+import zlib
+from typing import Iterable, Iterator, List, Optional
+
+from dokuWikiDumper.utils.config import runtime_config
+from dokuWikiDumper.utils.write_behind import write_behind
+
+HISTORY_COMPRESSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+""" --compress-history: suffix added to the files """
+COMPRESSED_SUFFIXES = tuple(HISTORY_COMPRESSIONS.values())
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3}
+LEVEL_RANGES = {'gzip': (0, 9), 'zstd': (1, 22)}
+
+
+def zstd_available() -> bool:
+    return importlib.util.find_spec('zstandard') is not None
+
+
+def compress_chunks(chunks: Iterable[bytes], method: str, level: Optional[int] = None) -> Iterator[bytes]:
+    """ Compress `chunks` as they come (gzip or zstd frame), nothing is buffered beyond the compressor's window """
+    level = DEFAULT_LEVELS[method] if level is None else level
+    if method == 'gzip':
+        # wbits 16+: gzip header and trailer, what `gzopen()` (DokuWiki) and `gzip -d` read
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif method == 'zstd':
+        import zstandard
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    else:
+        raise ValueError(f'unknown compression: {method}')
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def history_files(path: str) -> List[str]:
+    """ The forms an old revision can have on disk: plain, `.gz`, `.zst` """
+    return [path] + [path + suffix for suffix in COMPRESSED_SUFFIXES]
+
+
+def history_exists(path: str) -> bool:
+    return any(os.path.exists(p) for p in history_files(path))
+
+
+def write_history(path: str, chunks: Iterable[str]) -> int:
+    """ Write an old revision (`attic/`, `html/attic/`) to `path`, or to `path.gz`/`path.zst` with
+    --compress-history. Returns the size written (compressed).
+
+    After a change of --compress-history, the other forms of the file left by the earlier runs are removed.
+    """
+    method = runtime_config.compress_history
+    if method in HISTORY_COMPRESSIONS:
+        target = path + HISTORY_COMPRESSIONS[method]
+        size = write_behind.write(target, compress_chunks((chunk.encode('utf-8') for chunk in chunks),
+                                                          method, runtime_config.compress_level), binary=True)
+    else:
+        target = path
+        size = write_behind.write(path, chunks)
+    if runtime_config.compress_changed:
+        for other in history_files(path):
+            if other != target and os.path.exists(other):
+                os.remove(other)
+    return size
@@ -0,0 +1,430 @@
+import collections
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+import urllib3.exceptions
+
+from dokuWikiDumper.utils.scheduler import current_stage
+from dokuWikiDumper.utils.util import print_with_lock as print
+from dokuWikiDumper.utils.watchdog import watchdog
+
+BACKOFF_STATUS = (429, 503)
+""" status codes that make the controller halve the concurrency """
+DEFAULT_TIMEOUT = 120.0
+""" `--timeout`: ceiling of the read timeout, the connect timeout's is a quarter of it """
+
+
+class RetryBudget:
+    """ Caps the retries of every layer (urllib3 `CustomRetry`, the hard retries of `SessionMonkeyPatch`,
+    the asyncio engine) to `ratio` of the requests, plus `min_retries`, over a sliding window.
+
+    Without it, a dead host costs `(retry+1)*(hard_retry+1)` attempts per request and per thread.
+    `ratio=0` disables the budget. `verbose=False`: denials aren't printed (hedging).
+    """
+    def __init__(self, ratio: float = 0.2, min_retries: int = 10, window: float = 60.0, verbose: bool = True):
+        self.lock = threading.Lock()
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self.verbose = verbose
+        self.window_start = time.monotonic()
+        self.requests = self.retries = 0
+        self.previous = (0, 0)
+        """ (requests, retries) of the previous window, weighted by how much of it still overlaps """
+        self.denied = 0
+
+    def configure(self, ratio: float):
+        with self.lock:
+            self.ratio = ratio
+            self.window_start = time.monotonic()
+            self.requests = self.retries = self.denied = 0
+            self.previous = (0, 0)
+
+    def _roll(self, now: float):
+        elapsed = now - self.window_start
+        if elapsed >= self.window:
+            self.previous = (self.requests, self.retries) if elapsed < 2 * self.window else (0, 0)
+            self.requests = self.retries = 0
+            self.window_start = now
+
+    def on_request(self):
+        with self.lock:
+            self._roll(time.monotonic())
+            self.requests += 1
+
+    def try_retry(self) -> bool:
+        """ Spend one retry, `False` if the budget is exhausted (the caller gives up) """
+        with self.lock:
+            if self.ratio <= 0:
+                return True
+            now = time.monotonic()
+            self._roll(now)
+            overlap = 1 - (now - self.window_start) / self.window
+            requests = self.requests + self.previous[0] * overlap
+            retries = self.retries + self.previous[1] * overlap
+            if retries < self.min_retries + self.ratio * requests:
+                self.retries += 1
+                return True
+            self.denied += 1
+            denied = self.denied
+        if self.verbose and (denied == 1 or denied % 100 == 0):
+            print(f'Retry budget exhausted ({denied} retries denied): failing fast instead of retrying')
+        return False
+
+
+retry_budget = RetryBudget()
+
+
+def is_timeout(e: BaseException) -> bool:
+    """ `requests`, urllib3 (wrapped in a `ConnectionError` once its retries are exhausted), asyncio/aiohttp """
+    if isinstance(e, (requests.Timeout, TimeoutError)):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(reason, urllib3.exceptions.TimeoutError)
+
+
+class AdaptiveTimeout:
+    """ (connect, read) timeouts of one host, derived from its latency percentiles.
+
+    The read timeout is `factor` x the p99 time to the response headers of the last `window` responses of the
+    stage (`current_stage()`, exporting a PDF takes longer than a raw page), the connect timeout `factor` x the
+    p99 of the host's connection setups. Both start at their ceiling until `warmup` samples are in.
+    Every timeout doubles them (up to the ceiling), successes bring them back down slowly.
+
+    `requests`/urllib3 read timeouts, like aiohttp's `sock_read`, apply to each read of the socket, not to the
+    whole response: a large download only times out if it stalls.
+    `max_timeout=0` disables the timeouts.
+    """
+    factor = 4.0
+    min_connect = 5.0
+    min_read = 15.0
+
+    def __init__(self, max_timeout: float = DEFAULT_TIMEOUT, window: int = 200, warmup: int = 20):
+        self.lock = threading.Lock()
+        self.max_read = max_timeout
+        self.max_connect = max_timeout / 4
+        self.window = window
+        self.warmup = warmup
+        self.read_samples: Dict[Optional[str], Deque[float]] = {}
+        self.connect_samples: Deque[float] = collections.deque(maxlen=window)
+        self.boost = 1.0
+
+    def _percentile(self, samples: Deque[float], q: float) -> Optional[float]:
+        if len(samples) < self.warmup:
+            return None
+        return sorted(samples)[int(q * (len(samples) - 1))]
+
+    def percentile(self, q: float) -> Optional[float]:
+        """ of the time to the response headers in the calling thread's stage, `None` until `warmup` samples """
+        with self.lock:
+            return self._percentile(self.read_samples.get(current_stage(), ()), q)
+
+    def observe_read(self, latency: float):
+        with self.lock:
+            stage = current_stage()
+            if stage not in self.read_samples:
+                self.read_samples[stage] = collections.deque(maxlen=self.window)
+            self.read_samples[stage].append(latency)
+            self.boost = max(1.0, self.boost * 0.95)
+
+    def observe_connect(self, seconds: float):
+        with self.lock:
+            self.connect_samples.append(seconds)
+
+    def on_timeout(self):
+        with self.lock:
+            self.boost = min(self.boost * 2, self.max_read / self.min_read)
+
+    def get(self) -> Optional[Tuple[float, float]]:
+        """ (connect, read) for the calling thread's stage, `None`: no timeout """
+        if self.max_read <= 0:
+            return None
+        with self.lock:
+            read_p99 = self._percentile(self.read_samples.get(current_stage(), ()), 0.99)
+            connect_p99 = self._percentile(self.connect_samples, 0.99)
+            boost = self.boost
+        connect = self.max_connect if connect_p99 is None else min(
+            self.max_connect, max(self.min_connect, connect_p99 * self.factor) * boost)
+        read = self.max_read if read_p99 is None else min(
+            self.max_read, max(self.min_read, read_p99 * self.factor) * boost)
+        return connect, read
+
+
+class CircuitBreaker:
+    """ Stops the requests to a failing host, probes it from time to time, resumes when it answers.
+
+    - closed: requests go through, `threshold` failures (connection errors, timeouts, HTTP 5xx) in a row open it
+    - open: every request waits `cooldown` seconds, then one of them goes through as a probe (half-open)
+    - the probe succeeds: closed again; it fails: open again for twice as long (up to `max_cooldown`)
+
+    `threshold=0` disables the breaker.
+    """
+    def __init__(self, host: str, threshold: int = 10, cooldown: float = 30.0, max_cooldown: float = 600.0,
+                 probe_timeout: float = 300.0):
+        self.host = host
+        self.lock = threading.Lock()
+        self.threshold = threshold
+        self.base_cooldown = self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.probe_timeout = probe_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.open_until = 0.0
+        self.probe_started = 0.0
+        self.probe_dispatched = 0.0
+
+    @property
+    def closed(self) -> bool:
+        return self.state == 'closed'
+
+    def dispatchable(self) -> bool:
+        """ For the dispatch gate: closed, or once the cooldown is over, `True` for one task (its request is
+        the probe, `admit()` turns the breaker half-open), then `False` again until the probe times out.
+
+        Not `closed`: the breaker can open with no request in flight (5xx returned to the caller), only
+        `admit()` moves it on, so a gate waiting for `closed` would wait forever.
+        """
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            now = time.monotonic()
+            if self.state == 'open' and now < self.open_until:
+                return False
+            if now - self.probe_dispatched < self.probe_timeout:
+                return False  # the probe is on its way
+            self.probe_dispatched = now
+            return True
+
+    def admit(self) -> float:
+        """ 0: the request can go, otherwise how long to wait before asking again """
+        with self.lock:
+            if self.state == 'closed':
+                return 0.0
+            now = time.monotonic()
+            if self.state == 'open':
+                if now < self.open_until:
+                    return self.open_until - now
+                self.state = 'half-open'
+            elif now - self.probe_started < self.probe_timeout:
+                return 1.0  # a probe is in flight
+            self.probe_started = now
+        print(f'{self.host}: probing...')
+        return 0.0
+
+    def wait(self):
+        while (delay := self.admit()) > 0:
+            watchdog.waiting()
+            time.sleep(min(delay, 1.0))
+
+    def on_success(self):
+        with self.lock:
+            self.failures = 0
+            if self.state == 'closed':
+                return
+            self.state = 'closed'
+            self.cooldown = self.base_cooldown
+            self.probe_dispatched = 0.0
+        print(f'{self.host}: responding again, resuming')
+
+    def on_failure(self, reason: str):
+        if self.threshold <= 0:
+            return
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half-open':
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            elif self.state != 'closed' or self.failures < self.threshold:
+                return
+            self.state = 'open'
+            self.open_until = time.monotonic() + self.cooldown
+            self.probe_dispatched = 0.0
+            failures, cooldown = self.failures, self.cooldown
+        print(f'{self.host}: {failures} failures in a row ({reason}), pausing requests for {cooldown:.0f}s')
+
+
+class AdaptiveConcurrency:
+    """ AIMD (additive increase, multiplicative decrease) concurrency limiter of one host.
+
+    - every `limit` healthy responses in a row raise the limit by one
+    - `429`/`503`/timeouts/connection errors or latency spikes halve it
+    - `pause()` (e.g. `Retry-After`) blocks every worker of the host, not only the one that got it
+
+    With `adaptive=False` only the global pause is honoured and the concurrency is left to `--threads`.
+    """
+    def __init__(self, host: str, initial: int = 1, min_limit: int = 1, max_limit: int = 1,
+                 adaptive: bool = False, latency_spike: float = 3.0, warmup: int = 10, breaker_threshold: int = 0,
+                 max_timeout: float = DEFAULT_TIMEOUT):
+        self.host = host
+        self.breaker = CircuitBreaker(host, threshold=breaker_threshold)
+        self.timeouts = AdaptiveTimeout(max_timeout)
+        self.cond = threading.Condition()
+        self.adaptive = adaptive
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, initial)
+        self.limit = initial
+        self.in_flight = 0
+        self.pause_until = 0.0
+
+        self.latency_spike = latency_spike
+        self.warmup = warmup
+        self.latency_avg: Optional[float] = None
+        self.samples = 0
+        self.healthy_streak = 0
+        self.last_decrease = 0.0
+
+    def wait_pause(self):
+        while (remaining := self.pause_until - time.monotonic()) > 0:
+            watchdog.waiting()
+            time.sleep(min(remaining, 1.0))
+
+    def acquire(self):
+        self.wait_pause()
+        self.breaker.wait()
+        if not self.adaptive:
+            return
+        with self.cond:
+            while self.in_flight >= self.limit:
+                self.cond.wait()
+            self.in_flight += 1
+
+    def try_acquire(self) -> bool:
+        """ `acquire()` without waiting: `False` if the host is paused, its breaker open or its limit reached """
+        if self.pause_until > time.monotonic() or not self.breaker.closed:
+            return False
+        if not self.adaptive:
+            return True
+        with self.cond:
+            if self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        if not self.adaptive:
+            return
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify()
+
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def pause(self, seconds: float, reason: str = ''):
+        """ Pause every worker of this host for `seconds` """
+        with self.cond:
+            until = time.monotonic() + seconds
+            if until <= self.pause_until:
+                return
+            self.pause_until = until
+        print(f'{self.host}: all workers paused for {seconds:.1f}s {reason}')
+
+    def on_success(self, latency: float):
+        self.timeouts.observe_read(latency)
+        with self.cond:
+            self.samples += 1
+            if self.latency_avg is None:
+                self.latency_avg = latency
+            spike = (self.samples > self.warmup and latency > 1.0
+                     and latency > self.latency_avg * self.latency_spike)
+            # slow-moving average, so a spike doesn't immediately become the new normal
+            self.latency_avg = self.latency_avg * 0.9 + latency * 0.1
+        if spike:
+            self.decrease(f'latency spike: {latency:.2f}s')
+            return
+        if not self.adaptive:
+            return
+        with self.cond:
+            self.healthy_streak += 1
+            if self.healthy_streak >= self.limit and self.limit < self.max_limit:
+                self.limit += 1
+                self.healthy_streak = 0
+                self.cond.notify()
+
+    def decrease(self, reason: str):
+        if not self.adaptive:
+            return
+        with self.cond:
+            now = time.monotonic()
+            # in-flight requests of the same congestion event should only halve the limit once
+            if now - self.last_decrease < max(1.0, 2 * (self.latency_avg or 0)):
+                return
+            self.last_decrease = now
+            self.healthy_streak = 0
+            old_limit = self.limit
+            self.limit = max(self.min_limit, self.limit // 2)
+        if old_limit != self.limit:
+            print(f'{self.host}: concurrency {old_limit} -> {self.limit} ({reason})')
+
+    def on_response(self, status_code: int, latency: float, retried: bool = False):
+        """ `retried`: the latency includes the backoff, only the status is used """
+        if status_code >= 500:
+            self.breaker.on_failure(f'HTTP {status_code}')
+        else:
+            self.breaker.on_success()
+        if status_code in BACKOFF_STATUS:
+            self.decrease(f'HTTP {status_code}')
+        elif status_code < 500 and not retried:
+            self.on_success(latency)
+
+    def on_error(self, e: Exception):
+        if is_timeout(e):
+            self.timeouts.on_timeout()
+        self.breaker.on_failure(type(e).__name__)
+        self.decrease(f'{type(e).__name__}')
+
+
+class HostControllers:
+    """ Registry of `AdaptiveConcurrency`, one per host (netloc) """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.controllers: Dict[str, AdaptiveConcurrency] = {}
+        self.adaptive = False
+        self.initial = 1
+        self.max_limit = 1
+        self.breaker_threshold = 0
+        self.max_timeout = DEFAULT_TIMEOUT
+
+    def configure(self, initial: int, max_limit: int, adaptive: bool, breaker_threshold: int = 0,
+                  max_timeout: float = DEFAULT_TIMEOUT):
+        with self.lock:
+            self.adaptive = adaptive
+            self.initial = initial
+            self.max_limit = max_limit
+            self.breaker_threshold = breaker_threshold
+            self.max_timeout = max_timeout
+            self.controllers.clear()
+
+    def get(self, host: str) -> AdaptiveConcurrency:
+        with self.lock:
+            if host not in self.controllers:
+                self.controllers[host] = AdaptiveConcurrency(
+                    host, initial=self.initial, max_limit=self.max_limit, adaptive=self.adaptive,
+                    breaker_threshold=self.breaker_threshold, max_timeout=self.max_timeout)
+            return self.controllers[host]
+
+    def dispatch_gate(self, url: str) -> Callable[[], bool]:
+        """ For `Scheduler(gate=...)`: no new task while the circuit breaker of `url`'s host is open,
+        but the one carrying the probe """
+        host = urlparse(url).netloc
+        return lambda: self.get(host).breaker.dispatchable()
+
+    def status(self) -> str:
+        """ e.g. ' (concurrency: 4/20)', empty if not adaptive """
+        if not self.adaptive:
+            return ''
+        with self.lock:
+            levels = ', '.join(f'{c.limit}' if len(self.controllers) == 1 else f'{h}={c.limit}'
+                               for h, c in self.controllers.items())
+        return f' (concurrency: {levels or self.initial}/{self.max_limit})'
+
+
+host_controllers = HostControllers()
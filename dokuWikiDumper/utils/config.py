@@ -1,10 +1,16 @@
 import json
 import os
 from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional, Tuple, Union
 
 from dokuWikiDumper.utils.util import Singleton, uopen
 from dokuWikiDumper.utils.util import print_with_lock as print
 
+if TYPE_CHECKING:
+    from dokuWikiDumper.utils.journal import ProgressJournal
+    from dokuWikiDumper.utils.leases import LeaseLog
+    from dokuWikiDumper.utils.state_db import StateDB
+
 CONFIG_FILEPATH = 'dumpMeta/config.json'
 
 
@@ -31,4 +37,11 @@ def get_config(dumpDir: str) -> dict:
 class _Dumper_running_config(metaclass = Singleton):
     html_parser: str = 'lxml'
     export_xhtml_action: str = 'export_xhtml' # 'export_xhtml' or 'export_raw'
+    shard: Optional[Tuple[int, int]] = None # (index, count), see --shard
+    leases: Optional['LeaseLog'] = None # worker processes of --processes only
+    journal: Optional[Union['ProgressJournal', 'StateDB']] = None # of the dump in progress
+    state_db: Optional['StateDB'] = None # --state-db
+    compress_history: str = 'none' # 'none', 'gzip' or 'zstd', see --compress-history
+    compress_level: Optional[int] = None # None: default level of the method
+    compress_changed: bool = False # an earlier run used another --compress-history
 runtime_config = _Dumper_running_config() # runtime global config
\ No newline at end of file
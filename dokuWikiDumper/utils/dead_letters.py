@@ -0,0 +1,81 @@
+import os
+import threading
+from typing import Dict, List
+
+from dokuWikiDumper.utils.config import runtime_config
+from dokuWikiDumper.utils.util import uopen
+
+DEAD_LETTERS_FILE = 'dumpMeta/dead_letters.log'
+MISSING_FILE = 'dumpMeta/{stage}_missing.txt'
+
+
+class DeadLetters:
+    """ The items of a stage that failed after all their attempts, kept across runs.
+
+    An append-only log of `stage<TAB>item<TAB>error` lines, an empty error means the item has been
+    done since (retry pass, later run). Each record is a single `write()` in append mode, so the worker
+    processes of `--processes` can share the file.
+    """
+    def __init__(self, dump_dir: str, stage: str):
+        self.dump_dir = dump_dir
+        self.path = os.path.join(dump_dir, DEAD_LETTERS_FILE)
+        self.stage = stage
+        self.lock = threading.Lock()
+
+    def _torn(self) -> bool:
+        """ the last line is incomplete (a process killed while writing it) """
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                return f.read(1) != b'\n'
+        except OSError:  # missing or empty
+            return False
+
+    def _append(self, item: str, error: str):
+        line = f'{self.stage}\t{item}\t{error}\n'
+        with self.lock:
+            if self._torn():
+                line = '\n' + line
+            with uopen(self.path, 'a') as f:
+                f.write(line)
+
+    def add(self, item: str, e: BaseException):
+        message = ' '.join(str(e).split())
+        error = f'{type(e).__name__}: {message}' if message else type(e).__name__
+        self._append(item, error)
+        if runtime_config.state_db is not None:
+            runtime_config.state_db.set_status(self.stage, item, 'failed', error)
+
+    def resolve(self, item: str):
+        self._append(item, '')
+
+    def missing(self) -> Dict[str, str]:
+        """ item: last error, of the items still failing """
+        if not os.path.exists(self.path):
+            return {}
+        missing: Dict[str, str] = {}
+        with self.lock, uopen(self.path, 'r', errors='replace') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t', 2)
+                # skip the incomplete lines, like `ProgressJournal` does
+                if not line.endswith('\n') or len(fields) != 3:
+                    continue
+                stage, item, error = fields
+                if stage != self.stage:
+                    continue
+                if error:
+                    missing[item] = error
+                else:
+                    missing.pop(item, None)
+        return missing
+
+    def write_missing(self) -> List[str]:
+        """ `dumpMeta/<stage>_missing.txt`: the items still missing (removed when there are none), returns them """
+        missing = self.missing()
+        path = os.path.join(self.dump_dir, MISSING_FILE.format(stage=self.stage))
+        if missing:
+            with uopen(path, 'w') as f:
+                f.write(''.join(f'{item}\t{error}\n' for item, error in missing.items()))
+        elif os.path.exists(path):
+            os.remove(path)
+        return list(missing)
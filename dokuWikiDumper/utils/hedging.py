@@ -0,0 +1,141 @@
+import concurrent.futures
+import threading
+from contextlib import nullcontext
+from typing import Callable, Optional
+
+import requests
+
+from dokuWikiDumper.utils.concurrency import AdaptiveConcurrency, RetryBudget
+from dokuWikiDumper.utils.scheduler import current_stage, set_current_stage
+from dokuWikiDumper.utils.watchdog import watchdog
+
+HEDGE_PERCENTILE = 0.95
+
+
+class Hedging:
+    """ Opt-in hedged GETs (`--hedge RATIO`), against the slow tail of some shared hosts.
+
+    A GET that hasn't returned within the p95 latency of its host (and stage) gets one duplicate, whichever
+    returns first (headers, with `stream=True`) is used, the other one is discarded when it completes.
+    At most `ratio` of the GETs of the last minute are hedged (a `RetryBudget` without floor), the hosts
+    without enough latency samples yet are never hedged.
+
+    Both requests run on a small thread pool while the worker waits, so only the GETs of a hedging
+    session pay for the hand-off. The pool threads work for the worker's task in the `watchdog` (stalled
+    connections are cancelled there), the hedge takes its own slot of the host (`AdaptiveConcurrency`) and is
+    not sent if none is free.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ratio = 0.0
+        self.budget = RetryBudget(ratio=0.0, min_retries=0, verbose=False)
+        self.executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self.requests = self.hedged = self.won = self.wasted = 0
+
+    def configure(self, ratio: float, workers: int):
+        self.shutdown()
+        with self.lock:
+            self.ratio = ratio
+            self.requests = self.hedged = self.won = self.wasted = 0
+        self.budget.configure(ratio)
+        if ratio > 0:
+            # a primary and its hedge per worker
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2 * workers,
+                                                                  thread_name_prefix='hedge')
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.executor is not None
+
+    def delay(self, controller: AdaptiveConcurrency, request: requests.PreparedRequest) -> Optional[float]:
+        """ How long to wait before hedging `request`, `None`: not hedged """
+        if self.executor is None or request.method != 'GET':
+            return None
+        self.budget.on_request()
+        with self.lock:
+            self.requests += 1
+        return controller.timeouts.percentile(HEDGE_PERCENTILE)
+
+    def send(self, primary: Callable[[], requests.Response], hedge: Callable[[], requests.Response],
+             delay: float, controller: Optional[AdaptiveConcurrency] = None) -> requests.Response:
+        stage = current_stage()
+        state = watchdog.current()
+
+        def run(send: Callable[[], requests.Response]) -> requests.Response:
+            set_current_stage(stage)
+            try:
+                with watchdog.working(state.stage, state.label, state.task) if state else nullcontext():
+                    return send()
+            finally:
+                set_current_stage(None)
+
+        def run_hedge() -> requests.Response:
+            try:
+                return run(hedge)
+            finally:
+                if controller is not None:
+                    controller.release()
+
+        executor = self.executor
+        if executor is None:
+            return primary()
+        first = executor.submit(run, primary)
+        try:
+            return first.result(timeout=delay)
+        except concurrent.futures.TimeoutError:
+            pass
+        if controller is not None and not controller.try_acquire():
+            return self._result(first)
+        if not self.budget.try_retry():
+            if controller is not None:
+                controller.release()
+            return self._result(first)
+        with self.lock:
+            self.hedged += 1
+        second = executor.submit(run_hedge)
+
+        pending = {first, second}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, timeout=1.0,
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            watchdog.waiting()  # the pool threads are the ones watched
+            winner = next((f for f in (first, second) if f in done and f.exception() is None), None)
+            if winner is None:
+                continue
+            for loser in (first, second):
+                if loser is not winner:
+                    loser.add_done_callback(self._discard)
+            if winner is second:
+                with self.lock:
+                    self.won += 1
+            return winner.result()
+        raise first.exception()  # type: ignore  # both failed
+
+    @staticmethod
+    def _result(future: concurrent.futures.Future) -> requests.Response:
+        while True:
+            try:
+                return future.result(timeout=1.0)
+            except concurrent.futures.TimeoutError:
+                watchdog.waiting()  # the pool thread is the one watched
+
+    def _discard(self, future: concurrent.futures.Future):
+        if future.exception() is None:
+            future.result().close()
+            with self.lock:
+                self.wasted += 1
+
+    def summary(self) -> str:
+        with self.lock:
+            share = self.hedged / self.requests if self.requests else 0.0
+            return (f'{self.hedged} of {self.requests} GETs hedged ({share:.1%}), the hedge was faster '
+                    f'{self.won} times, {self.wasted} responses discarded')
+
+
+hedging = Hedging()
+""" process-wide, configured by `--hedge` """
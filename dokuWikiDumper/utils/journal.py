@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+from typing import Dict, List, Set
+
+from dokuWikiDumper.utils.config import runtime_config
+from dokuWikiDumper.utils.util import print_with_lock as print
+from dokuWikiDumper.utils.write_behind import WriteBehindError, write_behind
+
+JOURNAL_FILE = 'dumpMeta/progress.log'
+
+
+class ProgressJournal:
+    """ What has been done so far, per item: an append-only log of `stage<TAB>item` lines.
+
+    Items are titles, `title@rev` revisions and media names. The log is replayed into memory once, when the
+    dump (re)starts, so resuming doesn't re-request (or stat) what is already done.
+    Lines are buffered and written with a single `write()` + `fsync()` every `batch` items or `interval`
+    seconds: a crash loses at most the last batch, done again by the next run. The worker processes of
+    `--processes` append to the same file.
+
+    The `.mark` files still tell which stages are complete. Delete the journal to check every item again.
+    """
+    def __init__(self, dump_dir: str, batch: int = 256, interval: float = 5.0):
+        self.path = os.path.join(dump_dir, JOURNAL_FILE)
+        self.batch = batch
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.done: Dict[str, Set[str]] = {}
+        self.pending: List[str] = []
+        self.last_flush = time.monotonic()
+        self.synced = write_behind.seq
+        """ `write_behind.sync()` cursor, from the files handed over after opening """
+        self.torn = False
+        """ the last line is incomplete, ended before appending """
+        self._replay()
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        # the last line of a crashed run can be incomplete
+        self.torn = bool(data) and not data.endswith(b'\n')
+        for line in data.decode('utf-8', errors='replace').split('\n')[:-1]:
+            if line:
+                stage, _, item = line.partition('\t')
+                self.done.setdefault(stage, set()).add(item)
+
+    def is_done(self, stage: str, item: str) -> bool:
+        return item in self.done.get(stage, ())
+
+    def record(self, stage: str, item: str):
+        write_behind.check()  # a file of the item could not be written: not done
+        with self.lock:
+            self.done.setdefault(stage, set()).add(item)
+            self.pending.append(f'{stage}\t{item}\n')
+            if len(self.pending) < self.batch and time.monotonic() - self.last_flush < self.interval:
+                return
+            self._flush()
+
+    def _flush(self):
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+        # an item is done once its files are, not while they wait for an I/O thread
+        try:
+            self.synced = write_behind.sync(self.synced)
+        except WriteBehindError as e:
+            # which items the files were of is not known: the batch is done again by the next run
+            self.synced = e.upto
+            self.pending = []
+            raise
+        data = (('\n' if self.torn else '') + ''.join(self.pending)).encode('utf-8')
+        self.pending = []
+        self.torn = False
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+
+
+def journal_filter(stage: str, names: List[str]) -> List[str]:
+    """ The names not done yet according to the progress journal """
+    journal = runtime_config.journal
+    if journal is None:
+        return names
+    pending = [name for name in names if not journal.is_done(stage, name)]
+    if len(pending) < len(names):
+        print(f'{stage}: {len(names) - len(pending)} of {len(names)} items already done (progress journal)')
+    return pending
+
+
+def journal_done(stage: str, item: str) -> bool:
+    return runtime_config.journal is not None and runtime_config.journal.is_done(stage, item)
+
+
+def journal_record(stage: str, item: str):
+    if runtime_config.journal is not None:
+        runtime_config.journal.record(stage, item)
@@ -0,0 +1,112 @@
+import os
+import threading
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+from dokuWikiDumper.utils.config import runtime_config
+
+LEASES_FILE = 'dumpMeta/leases.log'
+
+
+class LeaseLog:
+    """ Per-item leases of the worker processes of one dump (`--processes`).
+
+    An append-only log of `pid<TAB>stage<TAB>item` lines, guarded by `fcntl.lockf()`.
+    A process only works on the items it has leased, an item is leased again only if its owner died
+    before finishing the stage (`pid<TAB>stage<TAB>` line).
+    Every process reads the log incrementally, so a claim costs O(new lines), not O(items).
+    """
+    def __init__(self, path: str):
+        import fcntl
+        self.fcntl = fcntl
+        self.path = path
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        """ the stages of a process can claim at the same time (--parallel-stages) """
+        self.owners: Dict[Tuple[str, str], int] = {}
+        self.finished: Set[Tuple[str, int]] = set()
+        self.offset = 0
+        self.dead: Set[int] = set()
+
+    @staticmethod
+    def reset(path: str):
+        """ Called by the parent before starting the workers: leases never outlive a run """
+        with open(path, 'wb'):
+            pass
+
+    def _alive(self, pid: int) -> bool:
+        if pid in self.dead:
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            self.dead.add(pid)
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def _read_new(self, f):
+        f.seek(self.offset)
+        data = f.read()
+        for line in data.decode('utf-8').splitlines():
+            pid, stage, item = line.split('\t', 2)
+            if item:
+                self.owners[(stage, item)] = int(pid)
+            else:
+                self.finished.add((stage, int(pid)))
+        self.offset += len(data)
+
+    def _available(self, stage: str, item: str) -> bool:
+        owner = self.owners.get((stage, item))
+        if owner is None:
+            return True
+        return owner != self.pid and (stage, owner) not in self.finished and not self._alive(owner)
+
+    def _append(self, f, lines: List[str]):
+        f.write(''.join(lines).encode('utf-8'))
+        f.flush()
+        self.offset = f.tell()
+
+    def claim(self, stage: str, items: List[str]) -> List[str]:
+        """ Lease the available items, return them """
+        with self.lock, open(self.path, 'ab+') as f:
+            self.fcntl.lockf(f, self.fcntl.LOCK_EX)
+            try:
+                self._read_new(f)
+                claimed = [item for item in items if self._available(stage, item)]
+                if claimed:
+                    self._append(f, [f'{self.pid}\t{stage}\t{item}\n' for item in claimed])
+                    for item in claimed:
+                        self.owners[(stage, item)] = self.pid
+            finally:
+                self.fcntl.lockf(f, self.fcntl.LOCK_UN)
+        return claimed
+
+    def finish(self, stage: str):
+        """ Every item this process leased in `stage` is done, they stay leased after it exits """
+        with self.lock, open(self.path, 'ab+') as f:
+            self.fcntl.lockf(f, self.fcntl.LOCK_EX)
+            try:
+                self._read_new(f)
+                self._append(f, [f'{self.pid}\t{stage}\t\n'])
+                self.finished.add((stage, self.pid))
+            finally:
+                self.fcntl.lockf(f, self.fcntl.LOCK_UN)
+
+    def leased(self, stage: str, items: Iterable[str], chunk: int = 8) -> Iterator[str]:
+        """ Lazily lease `items` a few at a time, so the faster processes get more of them """
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= chunk:
+                yield from self.claim(stage, batch)
+                batch = []
+        if batch:
+            yield from self.claim(stage, batch)
+
+
+def lease_filter(stage: str, names: Iterable[str]) -> Iterator[str]:
+    """ The names this worker process has leased (`--processes`), all of them otherwise """
+    if runtime_config.leases is None:
+        return iter(names)
+    return runtime_config.leases.leased(stage, names)
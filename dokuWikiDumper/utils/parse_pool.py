@@ -0,0 +1,48 @@
+import concurrent.futures
+import multiprocessing
+import threading
+from typing import Callable, Optional, TypeVar
+
+from dokuWikiDumper.utils.config import runtime_config
+
+T = TypeVar('T')
+
+
+def _init_worker(html_parser: str):
+    runtime_config.html_parser = html_parser
+
+
+class ParsePool:
+    """ Optional process pool for the CPU-heavy HTML parsing (`--parse-processes`).
+
+    The network I/O stays in the worker threads, only the response text goes to the pool and
+    compact results (lists, tuples, strings) come back, so the GIL isn't held by BeautifulSoup.
+    Disabled (`processes=0`), `run()` simply calls the function.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+    def configure(self, processes: int):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+            if processes > 0:
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker, initargs=(runtime_config.html_parser,))
+
+    def run(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """ `fn` must be a module-level function, its arguments and result picklable """
+        executor = self.executor
+        if executor is None:
+            return fn(*args, **kwargs)
+        return executor.submit(fn, *args, **kwargs).result()
+
+    def shutdown(self):
+        self.configure(0)
+
+
+parse_pool = ParsePool()
+""" process-wide, configured by `--parse-processes` """
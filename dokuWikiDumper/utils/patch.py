@@ -1,25 +1,88 @@
+import codecs
+import threading
+from typing import Dict, Iterator, Optional, Tuple
+from urllib.parse import urlparse
+
 import requests
+from requests.compat import chardet
 
-from dokuWikiDumper.utils.delay import Delay
+from dokuWikiDumper.utils.concurrency import HostControllers, retry_budget
+from dokuWikiDumper.utils.hedging import hedging
+from dokuWikiDumper.utils.rate_limit import TokenBucket
+from dokuWikiDumper.utils.shutdown import shutdown
 from dokuWikiDumper.utils.util import trim_PHP_warnings
+from dokuWikiDumper.utils.watchdog import watchdog
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_HEAD_SIZE = 64 * 1024
+""" `iter_text()` looks for the PHP warnings and the charset in the first 64 KiB (at least a full line) """
+MAX_BREAKER_WAITS = 5
+""" failures of a request on an open circuit breaker (~15 min of cooldowns) before they count as hard retries:
+a request that always fails must not probe the host forever """
+
+
+class CharsetCache:
+    """ Charset of the responses without one, per host.
+
+    `apparent_encoding` runs chardet over the whole body, once a host has given the same answer `confirmations`
+    times it is trusted (as long as the bodies decode with it).
+    """
+    def __init__(self, confirmations: int = 3):
+        self.confirmations = confirmations
+        self.lock = threading.Lock()
+        self.detected: Dict[str, Tuple[str, int]] = {}
+
+    def get(self, host: str) -> Optional[str]:
+        with self.lock:
+            encoding, count = self.detected.get(host, (None, 0))
+            return encoding if count >= self.confirmations else None
+
+    def add(self, host: str, encoding: str):
+        with self.lock:
+            previous, count = self.detected.get(host, (None, 0))
+            self.detected[host] = (encoding, count + 1 if previous == encoding else 1)
+
+    def forget(self, host: str):
+        with self.lock:
+            self.detected.pop(host, None)
 
 
 class SessionMonkeyPatch:
-    """ Monkey patch `requests.Session.send` to add delay and hard retries
+    """ Monkey patch `requests.Session.send` to add rate limiting and hard retries
         Monkey patch `requests.Response.text` to trim PHP warnings and handle incorrect encoding
+
+    `rate_limiter`: shared by all threads, so `--delay` means the same thing regardless of `--threads`
+    `controllers`: per-host (adaptive) concurrency limits and global `Retry-After` pauses
     """
-    def __init__(self, session: requests.Session, 
-                 msg=None, delay: float=0.0, hard_retries=3,
+    def __init__(self, session: requests.Session,
+                 rate_limiter: Optional[TokenBucket] = None, controllers: Optional[HostControllers] = None,
+                 hard_retries=3,
                  trim_PHP_warnings: bool = False, remove_PHP_warnings_strict_mode: bool = False):
 
         self.session = session
-        self.msg = msg
-        self.delay = delay
+        self.rate_limiter = rate_limiter
+        self.controllers = controllers
         self.old_send_method = None
         self.old_text_method = None
         self.hard_retries = hard_retries
         self.trim_PHP_warnings = trim_PHP_warnings
         self.trim_PHP_warnings_strict_mode = remove_PHP_warnings_strict_mode
+        self.charsets = CharsetCache()
+
+    def _send(self, controller, request: requests.PreparedRequest, kwargs: dict) -> requests.Response:
+        """ `old_send_method()`, hedged (`--hedge`) if the request is slower than usual """
+        delay = hedging.delay(controller, request)
+        if delay is None:
+            return self.old_send_method(request, **kwargs)
+        kwargs = dict(kwargs)
+
+        def hedge():
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            return self.old_send_method(request.copy(), **kwargs)
+
+        return hedging.send(lambda: self.old_send_method(request, **kwargs), hedge, delay, controller)
 
     def hijack(self):
         ''' Don't forget to call `release()` '''
@@ -32,15 +95,44 @@ class SessionMonkeyPatch:
             if hard_retries <= 0:
                 raise ValueError('hard_retries must be positive')
 
+            controller = self.controllers.get(urlparse(request.url).netloc) if self.controllers else None
+            retry_budget.on_request()
+            adaptive_timeout = controller is not None and kwargs.get('timeout') is None
+            breaker_waits = 0
+
             while hard_retries > 0:
+                shutdown.check()  # past the shutdown deadline, no new request
+                if adaptive_timeout:
+                    kwargs['timeout'] = controller.timeouts.get()
                 try:
-                    Delay(msg=self.msg, delay=self.delay)
-                    return self.old_send_method(request, **kwargs)
+                    if controller is None:
+                        if self.rate_limiter is not None:
+                            self.rate_limiter.acquire()
+                        return self.old_send_method(request, **kwargs)
+
+                    with controller.slot():
+                        if self.rate_limiter is not None:
+                            self.rate_limiter.acquire()
+                        r = self._send(controller, request, kwargs)
+                        watchdog.beat()
+                        retries = getattr(r.raw, 'retries', None)
+                        # elapsed of a retried request includes the backoff, not a useful latency sample
+                        controller.on_response(r.status_code, r.elapsed.total_seconds(),
+                                               retried=bool(retries and retries.history))
+                        return r
                 except KeyboardInterrupt:
                     raise
                 except Exception as e:
+                    if controller is not None and isinstance(e, (requests.Timeout, requests.ConnectionError,
+                                                                 requests.exceptions.RetryError)):
+                        controller.on_error(e)
+                        if not controller.breaker.closed and breaker_waits < MAX_BREAKER_WAITS:
+                            # the host is down: wait for it in `slot()` instead of giving up on the request
+                            breaker_waits += 1
+                            print('Waiting for %s to come back, due to: %s' % (controller.host, e))
+                            continue
                     hard_retries -= 1
-                    if hard_retries <= 0:
+                    if hard_retries <= 0 or not retry_budget.try_retry():
                         raise e
                     print('Hard retry... (%d), due to: %s' % (hard_retries, e))
 
@@ -49,20 +141,80 @@ class SessionMonkeyPatch:
         # Monkey patch `requests.Response.text`
         self.old_text_method = requests.Response.text
         def new_text(_self):
-            # Handle incorrect encoding
-            if _self.encoding is None or _self.encoding == 'ISO-8859-1':
-                _self.encoding = _self.apparent_encoding
-                if _self.encoding is None:
-                    _self.encoding = 'utf-8'
-
-            text = self.old_text_method.fget(_self)
-            if self.trim_PHP_warnings:
-                text = trim_PHP_warnings(text, strict=self.trim_PHP_warnings_strict_mode)
+            # decoded once per response (callers often read `r.text` several times)
+            cached = getattr(_self, '_dumper_text', None)
+            if cached is not None and cached[0] == _self.encoding:
+                return cached[1]
+            text = self.decode(_self)
+            _self._dumper_text = (_self.encoding, text)
             return text
 
         requests.Response.text = property(new_text)
 
+        # `r.iter_text()`: `r.text` in pieces, for the responses opened with `stream=True`
+        requests.Response.iter_text = lambda _self, chunk_size=STREAM_CHUNK_SIZE: self.iter_text(_self, chunk_size)
+
+    def iter_text(self, r: requests.Response, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[str]:
+        """ Decode incrementally, the PHP warnings (and a missing charset) are looked for in the head of the body """
+        chunks = r.iter_content(chunk_size)
+        head = b''
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= STREAM_HEAD_SIZE and b'\n' in head:
+                break
+        if not head:
+            return
+
+        encoding = r.encoding
+        if encoding is None or encoding == 'ISO-8859-1':
+            encoding = self.charsets.get(urlparse(r.url).netloc) or chardet.detect(head)['encoding'] or 'utf-8'
+            r.encoding = encoding
+        try:
+            decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        except LookupError: # unknown encoding, like `requests` does
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+        text = decoder.decode(head)
+        if self.trim_PHP_warnings:
+            text = trim_PHP_warnings(text, strict=self.trim_PHP_warnings_strict_mode)
+        yield text
+        for chunk in chunks:
+            yield decoder.decode(chunk)
+        yield decoder.decode(b'', final=True)
+
+    def decode(self, r: requests.Response) -> str:
+        content = r.content
+        if not content:
+            return ''
+
+        # Handle incorrect encoding
+        if r.encoding is None or r.encoding == 'ISO-8859-1':
+            host = urlparse(r.url).netloc
+            encoding = self.charsets.get(host)
+            if encoding is not None:
+                try:
+                    text = self._decode(content, encoding, errors='strict')
+                    r.encoding = encoding
+                    return text
+                except (UnicodeDecodeError, LookupError):
+                    self.charsets.forget(host)
+            r.encoding = r.apparent_encoding or 'utf-8'
+            self.charsets.add(host, r.encoding)
+
+        try:
+            return self._decode(content, r.encoding, errors='replace')
+        except LookupError: # unknown encoding, like `requests` does
+            return self._decode(content, 'utf-8', errors='replace')
+
+    def _decode(self, content: bytes, encoding: str, errors: str) -> str:
+        if not self.trim_PHP_warnings:
+            return str(content, encoding, errors=errors)
+        if '<html\n'.encode(encoding) == b'<html\n': # ASCII-compatible: trim before decoding
+            return str(trim_PHP_warnings(content, strict=self.trim_PHP_warnings_strict_mode), encoding, errors=errors)
+        return trim_PHP_warnings(str(content, encoding, errors=errors), strict=self.trim_PHP_warnings_strict_mode)
+
     def release(self):
         ''' Undo monkey patch '''
         self.session.send = self.old_send_method
         requests.Response.text = self.old_text_method
+        del requests.Response.iter_text
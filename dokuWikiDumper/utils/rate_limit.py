@@ -0,0 +1,205 @@
+import asyncio
+import multiprocessing
+import os
+import re
+import threading
+import time
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, Optional
+
+from dokuWikiDumper.utils.util import print_with_lock as print
+
+
+class TokenBucket:
+    """ Thread-safe token bucket, shared by all workers of the process.
+
+    `rate`: tokens refilled per second, `<= 0` means unlimited.
+    `burst`: capacity of the bucket (max tokens that can be taken without waiting).
+
+    Callers reserve tokens under the lock and sleep *outside* of it, so the
+    pacing stays accurate no matter how many threads are waiting.
+    """
+    def __init__(self, rate: float = 0.0, burst: float = 1.0):
+        self.lock = threading.Lock()
+        self.rate = 0.0
+        self.burst = 1.0
+        self.tokens = 1.0
+        self.last_refill = time.monotonic()
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate: float, burst: float = 1.0):
+        """ (Re)configure the bucket, can be called at any time """
+        if burst <= 0:
+            raise ValueError('burst must be > 0')
+        with self.lock:
+            self._refill(time.monotonic())
+            was_unlimited = self.rate <= 0
+            self.rate = rate
+            self.burst = burst
+            # start with a full bucket, keep the debt (if any) otherwise
+            self.tokens = burst if was_unlimited else min(self.tokens, burst)
+
+    @property
+    def unlimited(self) -> bool:
+        return self.rate <= 0
+
+    def _refill(self, now: float):
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """ Take `tokens` from the bucket (may go into debt),
+        return how many seconds the caller has to wait before using them. """
+        if self.unlimited:
+            return 0.0
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self, tokens: float = 1.0) -> float:
+        """ Block until `tokens` are available, return seconds waited """
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class SharedTokenBucket(TokenBucket):
+    """ `TokenBucket` whose state lives in shared memory: one limit for several processes (`--processes`).
+
+    Create it in the parent and pass it to the `multiprocessing` children as an argument.
+    The rate can't be changed once the children are started.
+    """
+    def __init__(self, rate: float = 0.0, burst: float = 1.0):
+        self.state = multiprocessing.get_context('spawn').Array('d', [1.0, time.monotonic()])
+        super().__init__(rate, burst)
+        self.lock = self.state.get_lock()
+
+    @property
+    def tokens(self) -> float:
+        return self.state[0]
+
+    @tokens.setter
+    def tokens(self, value: float):
+        self.state[0] = value
+
+    @property
+    def last_refill(self) -> float:
+        return self.state[1]
+
+    @last_refill.setter
+    def last_refill(self, value: float):
+        self.state[1] = value
+
+
+request_limiter = TokenBucket()
+""" process-wide requests/sec limiter, configured by `--delay` and `--burst` """
+
+
+BANDWIDTH_FILE = 'dumpMeta/bandwidth'
+""" in the dump dir: overrides `--bandwidth` while it exists, e.g. `echo 500K > dumpMeta/bandwidth` """
+
+
+def parse_bandwidth(value: str) -> float:
+    """ bytes per second: `2M`, `500K`, `1.5MB`, `100000`... (binary units), `0` means unlimited """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?\s*', value, re.I)
+    if match is None:
+        raise ValueError(f'invalid bandwidth: {value!r}')
+    return float(match.group(1)) * 1024 ** ' kmg'.index(match.group(2).lower() or ' ')
+
+
+def format_bandwidth(rate: float) -> str:
+    return 'unlimited' if rate <= 0 else f'{rate / 1024:.0f} KiB/s'
+
+
+class BandwidthLimiter:
+    """ Bytes/s cap of the media and PDF downloads (`--bandwidth`), shared by all the threads (and the
+    processes of `--processes`, with a `SharedTokenBucket`).
+
+    Every chunk reserves its size in the bucket, in arrival order, so the threads get a fair share.
+    `control_file` is checked every `check_interval` seconds: while it exists its content overrides the cap,
+    so a running dump can be slowed down during business hours.
+    """
+    check_interval = 2.0
+
+    def __init__(self, bucket: Optional[TokenBucket] = None):
+        self.bucket = bucket or TokenBucket()
+        self.lock = threading.Lock()
+        self.default = 0.0
+        self.rate = 0.0
+        self.control_file: Optional[str] = None
+        self.control_mtime: Optional[float] = None
+        self.next_check = 0.0
+
+    def configure(self, rate: float, control_file: Optional[str] = None, bucket: Optional[TokenBucket] = None):
+        with self.lock:
+            if bucket is not None:
+                self.bucket = bucket
+            self.default = rate
+            self.control_file = control_file
+            self.control_mtime = None
+            self.next_check = 0.0
+        self._set_rate(rate)
+        self._check_control_file()
+
+    def _set_rate(self, rate: float, source: str = '--bandwidth'):
+        if rate == self.rate:
+            return
+        self.rate = rate
+        # a quarter of a second of transfer (at least one PDF chunk) can go back-to-back
+        self.bucket.set_rate(rate, burst=max(rate / 4, 64 * 1024))
+        print(f'Bandwidth limit: {format_bandwidth(rate)} ({source})')
+
+    def _check_control_file(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.control_file is None or now < self.next_check:
+                return
+            self.next_check = now + self.check_interval
+            try:
+                mtime = os.stat(self.control_file).st_mtime
+            except FileNotFoundError:
+                mtime = None
+            if mtime == self.control_mtime:
+                return
+            self.control_mtime = mtime
+            rate = self.default
+            source = '--bandwidth'
+            if mtime is not None:
+                try:
+                    with open(self.control_file, encoding='utf-8') as f:
+                        rate = parse_bandwidth(f.read())
+                    source = self.control_file
+                except (OSError, ValueError) as e:
+                    print(f'Ignoring {self.control_file}: {e}')
+                    return
+            self._set_rate(rate, source)
+
+    def reserve(self, nbytes: int) -> float:
+        """ seconds to wait before using `nbytes` """
+        self._check_control_file()
+        return self.bucket.reserve(nbytes)
+
+    def throttle(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """ `chunks` at no more than the limit """
+        for chunk in chunks:
+            wait = self.reserve(len(chunk))
+            if wait > 0:
+                time.sleep(wait)
+            yield chunk
+
+    async def athrottle(self, chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+        """ `throttle()` for `--engine asyncio` """
+        async for chunk in chunks:
+            wait = self.reserve(len(chunk))
+            if wait > 0:
+                await asyncio.sleep(wait)
+            yield chunk
+
+
+bandwidth_limiter = BandwidthLimiter()
+""" process-wide bytes/sec limiter of the downloads, configured by `--bandwidth` """
@@ -0,0 +1,344 @@
+import concurrent.futures
+import heapq
+import itertools
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from dokuWikiDumper.utils.dead_letters import DEAD_LETTERS_FILE, DeadLetters
+from dokuWikiDumper.utils.shutdown import ShutdownRequested, shutdown
+from dokuWikiDumper.utils.util import print_with_lock as print
+from dokuWikiDumper.utils.watchdog import watchdog
+
+
+_local = threading.local()
+
+
+def current_stage() -> Optional[str]:
+    """ The stage the calling thread works for (`set_current_stage()`, the `Scheduler` sets it on its workers) """
+    return getattr(_local, 'stage', None)
+
+
+def set_current_stage(stage: Optional[str]):
+    _local.stage = stage
+
+
+@dataclass(order=True)
+class Task:
+    priority: int
+    """ lower runs first """
+    seq: int
+    """ FIFO among tasks with the same priority """
+    index: int = field(compare=False)
+    payload: Any = field(compare=False)
+    attempts: int = field(default=0, compare=False)
+    stalls: int = field(default=0, compare=False)
+    """ times the `watchdog` found the task stuck, a stalled task is requeued once (on top of `attempts`) """
+    requeued: bool = field(default=False, compare=False)
+
+
+@dataclass
+class StageStats:
+    stage: str
+    total: int = 0
+    dispatched: int = 0
+    done: int = 0
+    failed: int = 0
+    """ failed after all attempts (and ignored) """
+    retried: int = 0
+    deferred: int = 0
+    """ failed in the main pass, left to the retry pass (`dead_letters`) """
+    interrupted: int = 0
+    """ in flight when the dump was stopped (`shutdown`), and not done """
+    started: float = field(default_factory=time.monotonic)
+    finished: Optional[float] = None
+    failed_indexes: List[int] = field(default_factory=list)
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    def summary(self) -> str:
+        rate = self.done / self.elapsed if self.elapsed > 0 else 0.0
+        return (f'{self.stage}: {self.done}/{self.total} done, {self.failed} failed, {self.retried} retried, '
+                f'{self.deferred} deferred' + (f', {self.interrupted} interrupted' if self.interrupted else '')
+                + f' in {self.elapsed:.1f}s ({rate:.2f} items/s)')
+
+
+class SharedBudget:
+    """ Concurrency budget shared by stages running at the same time (`--parallel-stages`).
+
+    Each active stage is entitled to `total * weight / sum(weights of active stages)` slots (at least one).
+    Idle slots can be borrowed by a stage beyond its share while no other stage is waiting for its own.
+    `cancel()` stops every stage sharing it (one of them failed), including the ones registering later.
+    """
+    def __init__(self, total: int, weights: Optional[Dict[str, float]] = None):
+        self.total = total
+        self.weights = weights or {}
+        self.cond = threading.Condition()
+        self.in_flight: Dict[str, int] = {}
+        self.waiting: Dict[str, bool] = {}
+        self.cancel_events: Dict[str, threading.Event] = {}
+        self.cancelled = False
+
+    def register(self, stage: str, cancel_event: Optional[threading.Event] = None):
+        with self.cond:
+            self.in_flight.setdefault(stage, 0)
+            self.waiting[stage] = False
+            if cancel_event is not None:
+                self.cancel_events[stage] = cancel_event
+                if self.cancelled:
+                    cancel_event.set()
+            self.cond.notify_all()
+
+    def unregister(self, stage: str):
+        with self.cond:
+            self.in_flight.pop(stage, None)
+            self.waiting.pop(stage, None)
+            self.cancel_events.pop(stage, None)
+            self.cond.notify_all()
+
+    def cancel(self):
+        """ Cancel the schedulers of every stage (`Scheduler.cancel()`) """
+        with self.cond:
+            self.cancelled = True
+            for event in self.cancel_events.values():
+                event.set()
+            self.cond.notify_all()
+
+    def share(self, stage: str) -> int:
+        total_weight = sum(self.weights.get(s, 1.0) for s in self.in_flight) or 1.0
+        return max(1, int(self.total * self.weights.get(stage, 1.0) / total_weight))
+
+    def try_acquire(self, stage: str) -> bool:
+        with self.cond:
+            used = sum(self.in_flight.values())
+            if used < self.total:
+                within_share = self.in_flight[stage] < self.share(stage)
+                others_waiting = any(w for s, w in self.waiting.items() if s != stage)
+                if within_share or not others_waiting:
+                    self.in_flight[stage] += 1
+                    self.waiting[stage] = False
+                    return True
+            self.waiting[stage] = True
+            return False
+
+    def stop_waiting(self, stage: str):
+        """ the stage has nothing ready to dispatch, let others borrow its share """
+        with self.cond:
+            if self.waiting.get(stage):
+                self.waiting[stage] = False
+                self.cond.notify_all()
+
+    def release(self, stage: str):
+        with self.cond:
+            self.in_flight[stage] -= 1
+            self.cond.notify_all()
+
+    def wait(self, timeout: float):
+        with self.cond:
+            self.cond.wait(timeout)
+
+
+class Scheduler:
+    """ Runs the items of one stage on a thread pool.
+
+    - `action(task)`: does the work, raises on failure
+    - `describe(task)`: progress line printed when a task is dispatched
+    - `priority(payload)`: optional, lower runs first (default: input order)
+    - `lookahead`: how many items are pulled from `items` ahead of the workers (bounded, `items` can be a generator)
+    - `retries`: per-task retries (on top of the session retries)
+    - `ignore_errors`: count and print failed tasks instead of stopping the stage
+    - `budget`: optional `SharedBudget`, when several stages run at the same time
+    - `gate()`: optional, no new task is dispatched while it returns `False` (e.g. an open circuit breaker)
+    - `dead_letters`: optional, the tasks failing after all their attempts are recorded there (by `key(payload)`)
+      instead of stopping the stage, and tried once more at the end of the stage on `retry_threads` threads.
+      Those still failing are ignored with `ignore_errors`, otherwise the stage raises after the retry pass.
+
+    Every `Scheduler` has its own cancel event, so running a stage twice in one process works.
+    On SIGINT/SIGTERM (`shutdown`) no new task is dispatched, the in-flight ones are waited for until the deadline
+    and `run()` raises `ShutdownRequested`, the failures of that time are neither retried nor recorded.
+    """
+    def __init__(self, stage: str, action: Callable[[Task], Any], *, threads: int = 1,
+                 describe: Optional[Callable[[Task], str]] = None,
+                 priority: Optional[Callable[[Any], int]] = None,
+                 lookahead: Optional[int] = None, retries: int = 0, ignore_errors: bool = False,
+                 budget: Optional[SharedBudget] = None, gate: Optional[Callable[[], bool]] = None,
+                 dead_letters: Optional[DeadLetters] = None, key: Callable[[Any], str] = str,
+                 retry_threads: int = 1):
+        if threads < 1:
+            raise ValueError('threads must be >= 1')
+        self.stage = stage
+        self.action = action
+        self.threads = threads
+        self.describe = describe
+        self.priority = priority
+        self.lookahead = lookahead or threads * 4
+        self.retries = retries
+        self.ignore_errors = ignore_errors
+        self.budget = budget
+        self.gate = gate
+        self.dead_letters = dead_letters
+        self.key = key
+        self.retry_threads = max(1, min(retry_threads, threads))
+
+        self.dead: List[Task] = []
+        """ failed in the main pass """
+        self.previously_dead: Dict[str, str] = {}
+        """ still missing from an earlier run, resolved when done """
+        self.retry_pass = False
+        self.cancel_event = threading.Event()
+        self.stats = StageStats(stage)
+        self._seq = itertools.count()
+
+    def cancel(self):
+        """ Stop dispatching new tasks, in-flight tasks are left to finish """
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def _new_task(self, index: int, payload: Any) -> Task:
+        priority = self.priority(payload) if self.priority else 0
+        return Task(priority=priority, seq=next(self._seq), index=index, payload=payload)
+
+    def _can_dispatch(self, in_flight: int, threads: int) -> bool:
+        if in_flight >= threads:
+            return False
+        if self.gate is not None and not self.gate():
+            return False
+        return self.budget is None or self.budget.try_acquire(self.stage)
+
+    def _call(self, task: Task):
+        with watchdog.working(self.stage, str(self.key(task.payload)), task):
+            return self.action(task)
+
+    def _on_failure(self, task: Task, e: BaseException, ready: List[Task]):
+        if shutdown.requested:
+            self.stats.interrupted += 1
+            print(f'[{task.index + 1}] interrupted: {e}')
+            return
+        if task.stalls and not task.requeued and not isinstance(e, KeyboardInterrupt):
+            task.requeued = True
+            print(f'[{task.index + 1}] requeued after a stall: {e}')
+            heapq.heappush(ready, task)
+            return
+        if task.attempts < self.retries and not isinstance(e, KeyboardInterrupt):
+            task.attempts += 1
+            self.stats.retried += 1
+            print(f'[{task.index + 1}] retrying ({task.attempts}/{self.retries}) due to: {e}')
+            heapq.heappush(ready, task)
+            return
+        if self.dead_letters is not None and not isinstance(e, KeyboardInterrupt):
+            self.dead_letters.add(self.key(task.payload), e)
+            if not self.retry_pass:
+                self.stats.deferred += 1
+                self.dead.append(task)
+                print(f'[{task.index + 1}] failed, will be retried at the end of the stage: {e}')
+                return
+        elif not self.ignore_errors:
+            self.cancel()
+            raise e
+        self.stats.failed += 1
+        self.stats.failed_indexes.append(task.index)
+        print('[', task.index + 1, '] Error in sub thread: (', e, ') ignored')
+
+    def _on_success(self, task: Task):
+        self.stats.done += 1
+        if self.dead_letters is None:
+            return
+        key = self.key(task.payload)
+        if self.retry_pass or self.previously_dead.pop(key, None) is not None:
+            self.dead_letters.resolve(key)
+
+    def run(self, items: Iterable[Any], total: Optional[int] = None) -> StageStats:
+        """ Blocks until every item is done (or the scheduler is cancelled) """
+        if total is None and hasattr(items, '__len__'):
+            total = len(items)  # type: ignore
+        self.stats.total = total or 0
+        if self.dead_letters is not None:
+            self.previously_dead = self.dead_letters.missing()
+
+        if self.budget is not None:
+            self.budget.register(self.stage, self.cancel_event)
+        try:
+            self._run_pass(enumerate(items), self.threads)
+            if self.dead and not self.cancelled and not shutdown.requested:
+                print(f'{self.stage}: retrying {len(self.dead)} failed items on {self.retry_threads} thread(s)...')
+                self.retry_pass = True
+                self._run_pass(((task.index, task.payload) for task in self.dead), self.retry_threads)
+        finally:
+            if self.budget is not None:
+                self.budget.unregister(self.stage)
+        self.stats.finished = time.monotonic()
+        print(self.stats.summary())
+        if shutdown.requested:
+            raise ShutdownRequested(f'{self.stage}: stopped by {shutdown.reason} after {self.stats.done} items')
+        if self.retry_pass and self.stats.failed and not self.ignore_errors:
+            raise RuntimeError(f'{self.stage}: {self.stats.failed} items still failing after the retry pass, '
+                               f'see {DEAD_LETTERS_FILE}')
+        return self.stats
+
+    def _run_pass(self, source: Iterator[Tuple[int, Any]], threads: int):
+        source_exhausted = False
+        ready: List[Task] = []
+        in_flight = {}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads,
+                                                   thread_name_prefix=f'{self.stage}-worker',
+                                                   initializer=set_current_stage, initargs=(self.stage,)) as executor:
+            try:
+                while True:
+                    # bounded look-ahead
+                    while not source_exhausted and len(ready) < self.lookahead:
+                        try:
+                            index, payload = next(source)
+                        except StopIteration:
+                            source_exhausted = True
+                            break
+                        heapq.heappush(ready, self._new_task(index, payload))
+
+                    while ready and not self.cancelled and not shutdown.requested \
+                            and self._can_dispatch(len(in_flight), threads):
+                        task = heapq.heappop(ready)
+                        if task.attempts == 0:
+                            if not self.retry_pass:
+                                self.stats.dispatched += 1
+                            if self.describe:
+                                print(self.describe(task))
+                        in_flight[executor.submit(self._call, task)] = task
+                    if self.budget is not None and not ready:
+                        self.budget.stop_waiting(self.stage)
+
+                    if not in_flight:
+                        if self.cancelled or shutdown.requested:
+                            print(f'{self.stage}: cancelled' if self.cancelled else f'{self.stage}: stopped')
+                            break
+                        if source_exhausted and not ready:
+                            break
+                        if self.budget is not None:
+                            self.budget.wait(timeout=0.5)  # other stages hold the whole budget
+                        elif self.gate is not None:
+                            time.sleep(0.5)  # gate closed
+                        continue
+
+                    # with a shared budget, wake up regularly: slots can also be freed by other stages
+                    timeout = 0.5 if self.budget or self.gate or shutdown.requested else None
+                    if shutdown.expired:
+                        shutdown.cancel_connections()
+                    done, _ = concurrent.futures.wait(in_flight, timeout=timeout,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED)
+                    for f in done:
+                        task = in_flight.pop(f)
+                        if self.budget is not None:
+                            self.budget.release(self.stage)
+                        try:
+                            f.result()
+                            self._on_success(task)
+                        except BaseException as e:
+                            self._on_failure(task, e, ready)
+            finally:
+                for f in in_flight:
+                    f.cancel()
@@ -6,45 +6,47 @@ import time
 import requests
 import requests.utils
 
+from dokuWikiDumper.utils.concurrency import BACKOFF_STATUS, host_controllers, retry_budget
+from dokuWikiDumper.utils.shutdown import shutdown
+from dokuWikiDumper.utils.transport import DEFAULT_POOL_MAXSIZE, HTTP2Adapter
 from dokuWikiDumper.utils.util import uopen
 
 
-def create_session(retries=5, user_agent=None) -> requests.Session:
+def create_session(retries=5, user_agent=None, pool_maxsize=DEFAULT_POOL_MAXSIZE, http2=False) -> requests.Session:
+    """ `pool_maxsize`: connections kept alive per host, should be >= the number of workers,
+    otherwise the extra connections are thrown away after each request (and the TLS handshake redone).
+    `http2`: use `HTTP2Adapter` (requires httpx[http2]) """
     session = requests.Session()
     try:
         from requests.adapters import HTTPAdapter
+        from urllib3.exceptions import MaxRetryError, ResponseError
         from urllib3.util.retry import Retry
 
         # Courtesy datashaman https://stackoverflow.com/a/35504626
         class CustomRetry(Retry):
+            last_host = None
+            """ netloc of the last failed request, used to pause the whole host on `Retry-After` """
+
             def increment(self, method=None, url=None, *args, **kwargs):
+                host = None
                 if '_pool' in kwargs:
                     # type: urllib3.connectionpool.HTTPSConnectionPool
                     conn = kwargs['_pool']
-                    if 'response' in kwargs:
-                        try:
-                            # drain conn in advance so that it won't be put back into conn.pool
-                            kwargs['response'].drain_conn()
-                        except Exception:
-                            pass
-                    # Useless, retry happens inside urllib3
-                    # for adapters in session.adapters.values():
-                    #     adapters: HTTPAdapter
-                    #     adapters.poolmanager.clear()
-
-                    # Close existing connection so that a new connection will be used
-                    if hasattr(conn, 'pool'):
-                        pool = conn.pool  # type: queue.Queue
-                        try:
-                            # Don't directly use this, This closes connection pool by making conn.pool = None
-                            conn.close()
-                        except Exception:
-                            pass
-                        conn.pool = pool
-                return super(CustomRetry, self).increment(method=method, url=url, *args, **kwargs)
+                    # Don't close the pool here: urllib3 already discards a connection that errored, and a
+                    # response that is retried is drained and put back, still usable (keep-alive).
+                    # Closing the whole pool also broke the other threads' requests ("Pool is closed").
+                    host = conn.host if conn.port in (None, 80, 443) else f'{conn.host}:{conn.port}'
+                new_retry = super(CustomRetry, self).increment(method=method, url=url, *args, **kwargs)
+                if not retry_budget.try_retry():
+                    error = kwargs.get('error') or ResponseError('retry budget exhausted')
+                    raise MaxRetryError(kwargs.get('_pool'), url, error)
+                new_retry.last_host = host
+                return new_retry
 
             def sleep(self, response=None):
-                retry_after = self.get_retry_after(response)
+                shutdown.check()
+                # no response on connection errors
+                retry_after = self.get_retry_after(response) if response is not None else None
                 backoff = self.get_backoff_time()
                 delay_sec = retry_after if retry_after is not None else backoff
                 if response is None:
@@ -52,6 +54,16 @@ def create_session(retries=5, user_agent=None) -> requests.Session:
                 else:
                     msg = 'req retry (%s, %s) in %.2fs' % (response.status, response.reason, delay_sec)
                 print(msg)
+                if self.last_host is not None:
+                    controller = host_controllers.get(self.last_host)
+                    if retry_after is not None:
+                        # every worker of the host waits, instead of each one hammering the server until it gets its own 429
+                        controller.pause(retry_after, reason='(Retry-After)')
+                        controller.decrease('Retry-After')
+                    elif response is None:
+                        controller.decrease('connection error')
+                    elif response.status in BACKOFF_STATUS:
+                        controller.decrease(f'HTTP {response.status}')
                 super(CustomRetry, self).sleep(response=response)
 
         __retries__ = CustomRetry(
@@ -60,8 +72,12 @@ def create_session(retries=5, user_agent=None) -> requests.Session:
             allowed_methods=['DELETE', 'PUT', 'GET',
                              'OPTIONS', 'TRACE', 'HEAD', 'POST']
         )
-        session.mount("https://", HTTPAdapter(max_retries=__retries__))
-        session.mount("http://", HTTPAdapter(max_retries=__retries__))
+        if http2:
+            session.mount("https://", HTTP2Adapter(max_retries=__retries__, pool_maxsize=pool_maxsize))
+            session.mount("http://", HTTP2Adapter(max_retries=__retries__, pool_maxsize=pool_maxsize))
+        else:
+            session.mount("https://", HTTPAdapter(max_retries=__retries__, pool_maxsize=pool_maxsize))
+            session.mount("http://", HTTPAdapter(max_retries=__retries__, pool_maxsize=pool_maxsize))
     except Exception as e:
         print('Error: Could not set up retry adapter:', e)
 
@@ -0,0 +1,37 @@
+import argparse
+import hashlib
+from typing import List, Tuple
+
+from dokuWikiDumper.utils.config import runtime_config
+from dokuWikiDumper.utils.util import print_with_lock as print
+
+
+def shard_of(name: str, count: int) -> int:
+    """ Shard (0..count-1) of a title or media name.
+
+    Stable across processes, machines and Python versions (unlike `hash()`), every node computes the same split.
+    """
+    digest = hashlib.sha1(name.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """ '2/8' -> (2, 8), shards are numbered from 0 """
+    index, _, count = value.partition('/')
+    try:
+        shard = int(index), int(count)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid shard: {value!r} (expected INDEX/COUNT, e.g. 0/4)')
+    if not 0 <= shard[0] < shard[1]:
+        raise argparse.ArgumentTypeError(f'invalid shard: {value!r} (0 <= INDEX < COUNT)')
+    return shard
+
+
+def shard_filter(names: List[str]) -> List[str]:
+    """ The names of this node's shard (`--shard`), all of them when the dump is not sharded """
+    if runtime_config.shard is None:
+        return names
+    index, count = runtime_config.shard
+    selected = [name for name in names if shard_of(name, count) == index]
+    print(f'Shard {index}/{count}: {len(selected)} of {len(names)} items')
+    return selected
@@ -0,0 +1,108 @@
+import signal
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+from dokuWikiDumper.utils.util import print_with_lock as print
+from dokuWikiDumper.utils.watchdog import watchdog
+
+DEFAULT_SHUTDOWN_TIMEOUT = 60.0
+EXIT_INTERRUPTED = 130
+""" exit code of a dump stopped by a signal, like a shell """
+
+
+class ShutdownRequested(KeyboardInterrupt):
+    """ Raised once the in-flight items are done (or the deadline passed) after SIGINT/SIGTERM.
+
+    A `KeyboardInterrupt`: the retry layers and the dead letters already leave those alone.
+    """
+
+
+class Shutdown:
+    """ Graceful stop on SIGINT/SIGTERM.
+
+    The first signal stops the dispatch of new items, the in-flight ones get `timeout` seconds to finish
+    (their files are written atomically, an unfinished one leaves nothing behind), then the stage raises
+    `ShutdownRequested` without marking itself as dumped: the next run resumes from the files on disk.
+    Past the deadline, the connections of the in-flight requests are cancelled and no new request is sent.
+    A second signal aborts at once, like before.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.timeout = DEFAULT_SHUTDOWN_TIMEOUT
+        self.deadline = 0.0
+        self.reason = ''
+        self.connections_cancelled = False
+        self.previous: Dict[int, object] = {}
+
+    def install(self, timeout: float, signals: Iterable[int] = (signal.SIGINT, signal.SIGTERM)):
+        """ Handle `signals` until `uninstall()`, a no-op outside of the main thread """
+        self.reset()
+        self.timeout = timeout
+        if threading.current_thread() is not threading.main_thread():
+            return
+        for signum in signals:
+            self.previous[signum] = signal.signal(signum, self._handle)
+
+    def uninstall(self):
+        for signum, handler in self.previous.items():
+            signal.signal(signum, handler)  # type: ignore
+        self.previous = {}
+
+    def reset(self):
+        with self.lock:
+            self.event = threading.Event()
+            self.reason = ''
+            self.connections_cancelled = False
+
+    def _handle(self, signum: int, frame):
+        name = signal.Signals(signum).name
+        if self.requested:
+            print(f'{name} again, aborting')
+            self.cancel_connections()
+            raise KeyboardInterrupt
+        self.request(name)
+
+    def request(self, reason: str):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.reason = reason
+            self.deadline = time.monotonic() + self.timeout
+            self.event.set()
+        print(f'{reason}: finishing the items in progress (at most {self.timeout:.0f}s), '
+              'send it again to abort now...')
+
+    @property
+    def requested(self) -> bool:
+        return self.event.is_set()
+
+    @property
+    def expired(self) -> bool:
+        return self.requested and time.monotonic() >= self.deadline
+
+    def remaining(self) -> Optional[float]:
+        """ seconds left to the in-flight items, `None` while no shutdown is requested """
+        if not self.requested:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def cancel_connections(self):
+        """ past the deadline: the blocked reads of the workers fail (once) """
+        with self.lock:
+            if self.connections_cancelled:
+                return
+            self.connections_cancelled = True
+        cancelled = watchdog.cancel_connections()
+        if cancelled:
+            print(f'Shutdown: {cancelled} connections in progress cancelled')
+
+    def check(self):
+        """ raise `ShutdownRequested` past the deadline: nothing new is started then """
+        if self.expired:
+            raise ShutdownRequested(f'{self.reason}: stopped')
+
+
+shutdown = Shutdown()
+""" process-wide, installed by `dump()` (and the worker processes of `--processes`), see `--shutdown-timeout` """
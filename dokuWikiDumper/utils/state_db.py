@@ -0,0 +1,175 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from dokuWikiDumper.utils.journal import JOURNAL_FILE, ProgressJournal
+from dokuWikiDumper.utils.util import load_titles
+from dokuWikiDumper.utils.write_behind import WriteBehindError, write_behind
+
+STATE_DB_FILE = 'dumpMeta/state.sqlite3'
+TITLES_FILE = 'dumpMeta/titles.txt'
+FILES_FILE = 'dumpMeta/files.txt'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS titles (title TEXT PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS media (name TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha1 TEXT) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS revisions (
+    title TEXT NOT NULL, rev TEXT NOT NULL, current INTEGER NOT NULL,
+    ip TEXT, type TEXT, user TEXT, summary TEXT, sizechange TEXT,
+    PRIMARY KEY (title, rev)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS status (
+    stage TEXT NOT NULL, item TEXT NOT NULL, status TEXT NOT NULL, error TEXT, updated REAL,
+    PRIMARY KEY (stage, item)
+) WITHOUT ROWID;
+'''
+
+PAGE_STAGES = ('content', 'html', 'pdf')
+
+
+class StateDB:
+    """ Optional state of a dump in SQLite (`--state-db`): titles, media files (size, mtime, sha1),
+    the parsed revisions of the pages and a status per item (`done`/`failed`, same items as `ProgressJournal`).
+
+    Used as the progress journal when enabled: nothing is kept in memory, lookups go through the primary keys.
+    `titles.txt`, `files.txt` and the `.changes` files are still written. Writes are committed every `batch`
+    changes or `interval` seconds (WAL mode: the worker processes of `--processes` share the database).
+    """
+    def __init__(self, dump_dir: str, batch: int = 256, interval: float = 5.0):
+        self.path = os.path.join(dump_dir, STATE_DB_FILE)
+        self.batch = batch
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.changes = 0
+        self.last_commit = time.monotonic()
+        self.synced = write_behind.seq
+        """ `write_behind.sync()` cursor, from the files handed over after opening """
+        new = not os.path.exists(self.path)
+        self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        if new:
+            self._import(dump_dir)
+        self.conn.commit()
+
+    def _import(self, dump_dir: str):
+        """ a dump resumed with `--state-db` keeps the lists and the progress of its earlier runs """
+        titles = load_titles(os.path.join(dump_dir, TITLES_FILE))
+        if titles is not None:
+            self.set_titles(titles)
+        files = load_titles(os.path.join(dump_dir, FILES_FILE))
+        if files is not None:
+            self.set_files(files)
+        if os.path.exists(os.path.join(dump_dir, JOURNAL_FILE)):
+            journal = ProgressJournal(dump_dir)
+            now = time.time()
+            self.conn.executemany('INSERT OR REPLACE INTO status VALUES (?, ?, ?, NULL, ?)',
+                                  ((stage, item, 'done', now) for stage, items in journal.done.items()
+                                   for item in items))
+
+    def _changed(self, count: int = 1):
+        self.changes += count
+        if self.changes >= self.batch or time.monotonic() - self.last_commit >= self.interval:
+            self._commit()
+
+    def _commit(self):
+        try:
+            self.synced = write_behind.sync(self.synced)  # see `ProgressJournal._flush()`
+        except WriteBehindError as e:
+            self.synced = e.upto
+            self.conn.rollback()
+            self.changes = 0
+            raise
+        self.conn.commit()
+        self.changes = 0
+        self.last_commit = time.monotonic()
+
+    def flush(self):
+        with self.lock:
+            self._commit()
+
+    def close(self):
+        with self.lock:
+            try:
+                self._commit()
+            finally:
+                self.conn.close()
+
+    # `ProgressJournal` interface
+
+    def is_done(self, stage: str, item: str) -> bool:
+        with self.lock:
+            row = self.conn.execute('SELECT status FROM status WHERE stage = ? AND item = ?', (stage, item)).fetchone()
+        return row is not None and row[0] == 'done'
+
+    def record(self, stage: str, item: str):
+        write_behind.check()
+        self.set_status(stage, item, 'done')
+
+    # state
+
+    def set_status(self, stage: str, item: str, status: str, error: Optional[str] = None):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO status VALUES (?, ?, ?, ?, ?)',
+                              (stage, item, status, error, time.time()))
+            self._changed()
+
+    def set_titles(self, titles: List[str]):
+        with self.lock:
+            self.conn.execute('DELETE FROM titles')
+            self.conn.executemany('INSERT OR IGNORE INTO titles VALUES (?)', ((title,) for title in titles))
+            self._commit()
+
+    def set_files(self, names: List[str]):
+        """ the media files of the wiki, their size/mtime/sha1 are kept if already known """
+        with self.lock:
+            self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS listed (name TEXT PRIMARY KEY)')
+            self.conn.execute('DELETE FROM listed')
+            self.conn.executemany('INSERT OR IGNORE INTO listed VALUES (?)', ((name,) for name in names))
+            self.conn.execute('DELETE FROM media WHERE name NOT IN (SELECT name FROM listed)')
+            self.conn.execute('INSERT OR IGNORE INTO media (name) SELECT name FROM listed')
+            self._commit()
+
+    def set_media(self, name: str, size: int, mtime: float, sha1: Optional[str]):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?)', (name, size, mtime, sha1))
+            self._changed()
+
+    def add_revisions(self, title: str, rows: Iterable[Tuple[str, str, str, str, str, str]]):
+        """ `rows`: (rev, ip, type, user, summary, sizechange) of `title`, newest (current) first """
+        with self.lock:
+            self.conn.execute('DELETE FROM revisions WHERE title = ?', (title,))
+            self.conn.executemany('INSERT OR REPLACE INTO revisions VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                  ((title, rev, int(i == 0), ip, type_, user, summary, sizechange)
+                                   for i, (rev, ip, type_, user, summary, sizechange) in enumerate(rows)))
+            self._changed()
+
+    def progress(self) -> Dict[str, Dict[str, Tuple[int, int]]]:
+        """ {stage: {'pages'|'files'|'revisions': (done, total)}} """
+        with self.lock:
+            def count(sql: str, *params) -> int:
+                return self.conn.execute(sql, params).fetchone()[0]
+
+            titles = count('SELECT COUNT(*) FROM titles')
+            old_revisions = count('SELECT COUNT(*) FROM revisions WHERE current = 0')
+            progress: Dict[str, Dict[str, Tuple[int, int]]] = {}
+            for stage in PAGE_STAGES:
+                pages = count("SELECT COUNT(*) FROM status WHERE stage = ? AND status = 'done' AND instr(item, '@') = 0",
+                              stage)
+                progress[stage] = {'pages': (pages, titles)}
+                if stage != 'pdf':
+                    revisions = count("SELECT COUNT(*) FROM revisions r JOIN status s ON s.stage = ? AND "
+                                      "s.item = r.title || '@' || r.rev AND s.status = 'done' WHERE r.current = 0",
+                                      stage)
+                    progress[stage]['revisions'] = (revisions, old_revisions)
+            files = count("SELECT COUNT(*) FROM status WHERE stage = 'media' AND status = 'done'")
+            progress['media'] = {'files': (files, count('SELECT COUNT(*) FROM media'))}
+        return progress
+
+    def failed(self) -> Dict[str, int]:
+        """ {stage: items failing} """
+        with self.lock:
+            return dict(self.conn.execute("SELECT stage, COUNT(*) FROM status WHERE status = 'failed' GROUP BY stage"))
@@ -0,0 +1,41 @@
+import asyncio
+
+import pytest
+
+from dokuWikiDumper.utils.async_session import run_bounded
+from dokuWikiDumper.utils.write_behind import write_behind
+
+
+def test_run_bounded_raises_early():
+    started = []
+
+    async def action(index, item):
+        started.append(index)
+        if index == 0:
+            raise ValueError(item)
+        await asyncio.sleep(0.01)
+
+    with pytest.raises(ValueError):
+        asyncio.run(run_bounded([str(i) for i in range(100)], action, label='test', limit=2))
+    assert len(started) < 100
+
+
+def test_run_bounded_write_errors_are_the_items(tmp_path):
+    (tmp_path / 'file').write_text('not a directory')
+    errors = {}
+
+    async def action(index, item):
+        path = str(tmp_path / ('file' if item == 'bad' else '') / f'{item}.txt')
+        await asyncio.to_thread(write_behind.write, path, ['x'])  # handed over from another thread
+        await asyncio.to_thread(write_behind.sync, write_behind.seq)  # written, its errors left to the owners
+        try:
+            write_behind.check()
+        except OSError as e:
+            errors[item] = e
+
+    write_behind.configure(2)
+    try:
+        asyncio.run(run_bounded(['good', 'bad', 'other'], action, label='test', limit=3))
+    finally:
+        write_behind.shutdown()
+    assert list(errors) == ['bad']
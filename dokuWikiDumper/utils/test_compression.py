@@ -0,0 +1,20 @@
+import gzip
+
+from dokuWikiDumper.utils.compression import history_exists, write_history
+from dokuWikiDumper.utils.config import runtime_config
+
+
+def test_write_history_compresses_and_replaces_the_other_form(tmp_path, monkeypatch):
+    path = str(tmp_path / 'page.1700000000.txt')
+    write_history(path, ['plain'])
+    assert open(path).read() == 'plain'
+
+    monkeypatch.setattr(runtime_config, 'compress_history', 'gzip')
+    monkeypatch.setattr(runtime_config, 'compress_level', 9)
+    monkeypatch.setattr(runtime_config, 'compress_changed', True)
+    size = write_history(path, ['wiki', 'text ' * 100, 'é'])
+    with gzip.open(path + '.gz', 'rt', encoding='utf-8') as f:
+        assert f.read() == 'wiki' + 'text ' * 100 + 'é'
+    assert size < 100
+    assert not (tmp_path / 'page.1700000000.txt').exists()
+    assert history_exists(path)
@@ -0,0 +1,89 @@
+import time
+
+import requests
+
+from dokuWikiDumper.utils.concurrency import (
+    AdaptiveConcurrency,
+    AdaptiveTimeout,
+    CircuitBreaker,
+    RetryBudget,
+    is_timeout,
+)
+from dokuWikiDumper.utils.scheduler import Scheduler
+
+
+def test_aimd_increase_and_halve():
+    c = AdaptiveConcurrency('example.com', initial=2, max_limit=8, adaptive=True)
+    for _ in range(2 + 3):
+        c.on_success(0.1)
+    assert c.limit == 4
+    c.on_response(429, 0.1)
+    assert c.limit == 2
+    # the same congestion event doesn't halve twice
+    c.on_response(503, 0.1)
+    assert c.limit == 2
+
+
+def test_not_adaptive_keeps_limit():
+    c = AdaptiveConcurrency('example.com', initial=3, max_limit=3, adaptive=False)
+    c.on_response(429, 0.1)
+    for _ in range(10):
+        c.on_success(0.1)
+    assert c.limit == 3
+
+
+def test_circuit_breaker_opens_probes_and_closes():
+    b = CircuitBreaker('example.com', threshold=3, cooldown=0.05)
+    for _ in range(3):
+        assert b.admit() == 0
+        b.on_failure('ConnectionError')
+    assert not b.closed and b.admit() > 0
+    time.sleep(0.06)
+    assert b.admit() == 0  # the probe
+    assert b.admit() > 0  # the others wait for its result
+    b.on_failure('ConnectionError')
+    assert b.cooldown == 0.1
+    time.sleep(0.11)
+    assert b.admit() == 0
+    b.on_success()
+    assert b.closed and b.admit() == 0
+
+
+def test_retry_budget():
+    budget = RetryBudget(ratio=0.1, min_retries=2)
+    for _ in range(10):
+        budget.on_request()
+    assert [budget.try_retry() for _ in range(4)] == [True, True, True, False]
+
+
+def test_adaptive_timeout():
+    timeouts = AdaptiveTimeout(max_timeout=120, warmup=20)
+    assert timeouts.get() == (30, 120)  # no samples yet: the ceilings
+    for _ in range(30):
+        timeouts.observe_read(0.5)
+        timeouts.observe_connect(0.01)
+    assert timeouts.get() == (5, 15)  # 4x p99 is below the floors
+    for _ in range(30):
+        timeouts.observe_read(10.0)
+    assert timeouts.get() == (5, 40)
+    timeouts.on_timeout()
+    assert timeouts.get() == (10, 80)
+    assert is_timeout(requests.ReadTimeout()) and not is_timeout(requests.ConnectionError())
+    assert AdaptiveTimeout(max_timeout=0).get() is None
+
+
+def test_breaker_gate_lets_the_probe_through():
+    # the breaker opens with no request in flight (5xx returned to the caller): the stage must still finish
+    b = CircuitBreaker('example.com', threshold=2, cooldown=0.05)
+    done = []
+
+    def action(task):
+        b.wait()
+        if task.index < 2:
+            b.on_failure('HTTP 520')
+        else:
+            b.on_success()
+        done.append(task.index)
+
+    Scheduler('content', action, threads=1, gate=b.dispatchable).run(range(5))
+    assert done == [0, 1, 2, 3, 4] and b.closed
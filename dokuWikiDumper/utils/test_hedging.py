@@ -0,0 +1,61 @@
+import time
+
+import requests
+
+from dokuWikiDumper.utils.concurrency import AdaptiveConcurrency
+from dokuWikiDumper.utils.hedging import Hedging
+from dokuWikiDumper.utils.watchdog import watchdog
+
+
+def _response(name: str) -> requests.Response:
+    r = requests.Response()
+    r.reason = name
+    r._content_consumed = True
+    return r
+
+
+def test_hedging_takes_the_fastest_within_its_share():
+    hedging = Hedging()
+    hedging.configure(0.25, workers=2)
+    controller = AdaptiveConcurrency('example.com')
+    request = requests.Request('GET', 'http://example.com/').prepare()
+    assert hedging.delay(controller, request) is None  # no latency samples yet
+    for _ in range(20):
+        controller.timeouts.observe_read(0.01)
+
+    def slow():
+        time.sleep(0.3)
+        return _response('slow')
+
+    delay = hedging.delay(controller, request)
+    assert delay == 0.01
+    assert hedging.send(slow, lambda: _response('hedge'), delay).reason == 'hedge'
+    # a second hedge for 3 GETs would exceed a quarter of them
+    assert hedging.send(slow, lambda: _response('hedge'), hedging.delay(controller, request)).reason == 'slow'
+
+    hedging.executor.shutdown(wait=True)
+    assert (hedging.requests, hedging.hedged, hedging.won, hedging.wasted) == (3, 1, 1, 1)
+
+
+def test_hedge_needs_a_free_slot_and_runs_watched():
+    hedging = Hedging()
+    hedging.configure(1.0, workers=1)
+    controller = AdaptiveConcurrency('example.com', initial=1, max_limit=2, adaptive=True)
+    controller.acquire()  # the primary's slot
+    watched = []
+
+    def slow():
+        watched.append(watchdog.current())
+        time.sleep(0.1)
+        return _response('slow')
+
+    for _ in range(2):
+        hedging.budget.on_request()  # done by `delay()`
+    with watchdog.working('HTML', 'page'):
+        # limit reached: no hedge
+        assert hedging.send(slow, lambda: _response('hedge'), 0.01, controller).reason == 'slow'
+        controller.limit = 2
+        assert hedging.send(slow, lambda: _response('hedge'), 0.01, controller).reason == 'hedge'
+    hedging.executor.shutdown(wait=True)
+    assert hedging.hedged == 1 and controller.in_flight == 1  # the hedge gave its slot back
+    assert all(state is not None and state.label == 'page' for state in watched)
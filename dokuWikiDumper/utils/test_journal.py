@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+from dokuWikiDumper.utils.journal import JOURNAL_FILE, ProgressJournal
+from dokuWikiDumper.utils.write_behind import WriteBehindError, write_behind
+
+
+def test_journal_replays_flushed_batches(tmp_path):
+    os.mkdir(tmp_path / 'dumpMeta')
+    journal = ProgressJournal(str(tmp_path), batch=2)
+    journal.record('content', 'ns:page')
+    assert journal.is_done('content', 'ns:page') and not journal.is_done('html', 'ns:page')
+    assert not os.path.exists(tmp_path / JOURNAL_FILE)  # buffered
+    journal.record('content', 'ns:page@1700000000')
+    journal.record('media', 'ns:a.png')  # lost with a crash
+
+    # a crash in the middle of a write
+    with open(tmp_path / JOURNAL_FILE, 'a') as f:
+        f.write('content\tns:hal')
+    replayed = ProgressJournal(str(tmp_path))
+    assert replayed.is_done('content', 'ns:page') and replayed.is_done('content', 'ns:page@1700000000')
+    assert not replayed.is_done('media', 'ns:a.png') and not replayed.is_done('content', 'ns:hal')
+    replayed.record('media', 'ns:b.png')
+    replayed.flush()
+    assert ProgressJournal(str(tmp_path)).is_done('media', 'ns:b.png')
+
+
+def test_journal_drops_the_batch_of_a_failed_write(tmp_path):
+    os.mkdir(tmp_path / 'dumpMeta')
+    journal = ProgressJournal(str(tmp_path), batch=100)
+    write_behind.configure(1)
+    try:
+        (tmp_path / 'file').write_text('not a directory')
+        write_behind.write(str(tmp_path / 'file' / 'page.txt'), ['x'])
+        journal.record('content', 'other')  # its files may be the failed ones: not recorded
+        with pytest.raises(WriteBehindError):
+            journal.flush()
+        with pytest.raises(OSError):
+            journal.record('content', 'page')  # the thread that wrote the file
+        journal.record('content', 'next')
+        journal.close()  # the later flushes aren't poisoned
+    finally:
+        write_behind.shutdown()
+    replayed = ProgressJournal(str(tmp_path))
+    assert replayed.is_done('content', 'next')
+    assert not replayed.is_done('content', 'other') and not replayed.is_done('content', 'page')
@@ -0,0 +1,39 @@
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('fcntl')
+
+from dokuWikiDumper.utils.leases import LeaseLog  # noqa: E402
+
+
+def _dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def test_leases_are_exclusive(tmp_path):
+    path = str(tmp_path / 'leases.log')
+    LeaseLog.reset(path)
+    a, b = LeaseLog(path), LeaseLog(path)
+    b.pid = a.pid + 1  # another worker, `a` (this process) is alive
+
+    assert list(a.leased('content', ['p1', 'p2', 'p3'], chunk=2)) == ['p1', 'p2', 'p3']
+    assert b.claim('content', ['p1', 'p2', 'p3', 'p4']) == ['p4']
+    # leases are per stage
+    assert b.claim('html', ['p1']) == ['p1']
+
+
+def test_leases_of_dead_owner_are_reclaimed(tmp_path):
+    path = str(tmp_path / 'leases.log')
+    LeaseLog.reset(path)
+    dead, finished, alive = LeaseLog(path), LeaseLog(path), LeaseLog(path)
+    dead.pid, finished.pid = _dead_pid(), _dead_pid()
+
+    dead.claim('media', ['a.png'])
+    finished.claim('media', ['b.png'])
+    finished.finish('media')
+    # the items of a process that died before finishing the stage are leased again, not the finished ones
+    assert alive.claim('media', ['a.png', 'b.png']) == ['a.png']
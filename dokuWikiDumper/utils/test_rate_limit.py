@@ -0,0 +1,63 @@
+import multiprocessing
+import os
+import threading
+import time
+
+from dokuWikiDumper.utils.rate_limit import BandwidthLimiter, SharedTokenBucket, TokenBucket, parse_bandwidth
+
+
+def test_token_bucket_unlimited():
+    bucket = TokenBucket()
+    assert bucket.unlimited
+    assert bucket.acquire() == 0.0
+
+
+def test_token_bucket_burst_then_pace():
+    bucket = TokenBucket(rate=100, burst=3)
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert 0.005 < bucket.reserve() <= 0.01
+
+
+def test_token_bucket_shared_by_threads():
+    bucket = TokenBucket(rate=50, burst=1)
+    start = time.monotonic()
+    threads = [threading.Thread(target=lambda: [bucket.acquire() for _ in range(5)]) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # 20 requests at 50 req/s with a burst of 1: ~0.38s, regardless of the thread count
+    assert time.monotonic() - start >= 0.36
+
+
+def _reserve(bucket: SharedTokenBucket, waits):
+    waits.put(bucket.reserve())
+
+
+def test_shared_token_bucket_across_processes():
+    bucket = SharedTokenBucket(rate=0.1, burst=1)
+    assert bucket.reserve() == 0.0
+    ctx = multiprocessing.get_context('spawn')
+    waits = ctx.Queue()
+    child = ctx.Process(target=_reserve, args=(bucket, waits))
+    child.start()
+    child.join()
+    # the token taken by the parent is gone in the child too
+    assert waits.get(timeout=5) > 0.0
+
+
+def test_bandwidth_limiter_follows_its_control_file(tmp_path):
+    assert (parse_bandwidth('0'), parse_bandwidth('500K'), parse_bandwidth('2MB')) == (0, 500 * 1024, 2 * 1024 ** 2)
+    control_file = str(tmp_path / 'bandwidth')
+    limiter = BandwidthLimiter()
+    limiter.check_interval = 0
+    limiter.configure(0, control_file=control_file)
+    assert list(limiter.throttle([b'x' * 8192] * 100)) and limiter.reserve(10 ** 9) == 0.0
+
+    with open(control_file, 'w') as f:
+        f.write('64K\n')
+    assert limiter.reserve(64 * 1024) == 0.0  # the burst
+    assert 0.9 < limiter.reserve(64 * 1024) <= 1.0
+
+    os.remove(control_file)
+    assert limiter.reserve(10 ** 9) == 0.0 and limiter.rate == 0
@@ -0,0 +1,137 @@
+import threading
+import time
+
+import pytest
+
+from dokuWikiDumper.utils.dead_letters import DeadLetters
+from dokuWikiDumper.utils.scheduler import Scheduler, SharedBudget
+from dokuWikiDumper.utils.shutdown import ShutdownRequested, shutdown
+
+
+def test_scheduler_runs_all_items_and_can_run_twice():
+    for _ in range(2):
+        seen = []
+        lock = threading.Lock()
+
+        def action(task):
+            with lock:
+                seen.append(task.payload)
+
+        stats = Scheduler('test', action, threads=3).run(iter(range(20)), total=20)
+        assert sorted(seen) == list(range(20))
+        assert stats.done == 20 and stats.failed == 0
+
+
+def test_scheduler_priority():
+    seen = []
+    Scheduler('test', lambda task: seen.append(task.payload), threads=1, lookahead=10,
+              priority=lambda payload: -payload).run(range(5))
+    assert seen == [4, 3, 2, 1, 0]
+
+
+def test_scheduler_retry_and_ignore_errors():
+    attempts = {}
+
+    def action(task):
+        attempts[task.payload] = attempts.get(task.payload, 0) + 1
+        if task.payload == 'bad' or attempts[task.payload] < 2:
+            raise RuntimeError(task.payload)
+
+    stats = Scheduler('test', action, threads=2, retries=1, ignore_errors=True).run(['ok', 'bad'])
+    assert stats.done == 1 and stats.failed == 1 and stats.retried == 2
+    assert stats.failed_indexes == [1]
+
+    with pytest.raises(RuntimeError):
+        Scheduler('test', action, threads=2).run(['bad'])
+
+
+def test_scheduler_dead_letters_retry_pass(tmp_path):
+    (tmp_path / 'dumpMeta').mkdir()
+    dead_letters = DeadLetters(str(tmp_path), 'test')
+    dead_letters.add('old', RuntimeError('from an earlier run'))
+    calls = {}
+
+    def action(task):
+        calls[task.payload] = calls.get(task.payload, 0) + 1
+        if task.payload == 'bad' or (task.payload == 'flaky' and calls['flaky'] == 1):
+            raise RuntimeError(task.payload)
+
+    scheduler = Scheduler('test', action, threads=2, dead_letters=dead_letters)
+    with pytest.raises(RuntimeError):
+        scheduler.run(['ok', 'flaky', 'bad', 'old'])
+    assert calls == {'ok': 1, 'flaky': 2, 'bad': 2, 'old': 1}
+    assert scheduler.stats.deferred == 2 and scheduler.stats.failed == 1
+    assert dead_letters.missing() == {'bad': 'RuntimeError: bad'}
+
+    stats = Scheduler('test', action, threads=2, ignore_errors=True, dead_letters=dead_letters).run(['bad'])
+    assert stats.failed == 1
+    assert dead_letters.write_missing() == ['bad']
+    assert (tmp_path / 'dumpMeta' / 'test_missing.txt').read_text() == 'bad\tRuntimeError: bad\n'
+
+
+def test_scheduler_drains_in_flight_tasks_on_shutdown():
+    done = []
+
+    def action(task):
+        if task.payload == 3:
+            shutdown.request('TEST')
+        time.sleep(0.05)
+        done.append(task.payload)
+
+    scheduler = Scheduler('test', action, threads=2)
+    try:
+        with pytest.raises(ShutdownRequested):
+            scheduler.run(iter(range(100)), total=100)
+    finally:
+        shutdown.reset()
+    # the task running next to the one that saw the signal finished too, nothing new was started
+    assert sorted(done) == [0, 1, 2, 3] and scheduler.stats.done == 4
+
+
+def test_dead_letters_skip_a_torn_line(tmp_path):
+    (tmp_path / 'dumpMeta').mkdir()
+    dead_letters = DeadLetters(str(tmp_path), 'content')
+    dead_letters.add('ns:page', RuntimeError('boom'))
+    with open(dead_letters.path, 'a') as f:
+        f.write('content\tns:ot')  # a worker killed while writing
+    assert dead_letters.write_missing() == ['ns:page']
+    dead_letters.add('ns:other', RuntimeError('boom'))
+    dead_letters.resolve('ns:page')
+    assert dead_letters.missing() == {'ns:other': 'RuntimeError: boom'}
+
+
+def test_shared_budget_weights_and_borrowing():
+    budget = SharedBudget(6, weights={'media': 2})
+    budget.register('media')
+    budget.register('content')
+    assert budget.share('media') == 4 and budget.share('content') == 2
+
+    # content is idle: media may borrow beyond its share
+    assert all(budget.try_acquire('media') for _ in range(5))
+    # content waits for its share, media can no longer borrow
+    assert budget.try_acquire('content')
+    assert not budget.try_acquire('content')
+    budget.release('media')
+    assert not budget.try_acquire('media')
+    assert budget.try_acquire('content')
+
+
+def test_shared_budget_cancels_every_stage():
+    budget = SharedBudget(4)
+    started = threading.Event()
+
+    def slow(task):
+        started.set()
+        time.sleep(0.01)
+
+    scheduler = Scheduler('media', slow, threads=2, budget=budget)
+    runner = threading.Thread(target=scheduler.run, args=(range(10_000),))
+    runner.start()
+    started.wait(5)
+    budget.cancel()  # e.g. the content stage failed
+    runner.join(5)
+    assert not runner.is_alive() and scheduler.cancelled
+    assert scheduler.stats.done < 10_000
+    late = Scheduler('html', slow, budget=budget)
+    late.run(range(5))
+    assert late.stats.done == 0
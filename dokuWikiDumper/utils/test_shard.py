@@ -0,0 +1,24 @@
+import argparse
+
+import pytest
+
+from dokuWikiDumper.utils.shard import parse_shard, shard_of
+
+
+def test_shard_of_is_stable():
+    # must not depend on PYTHONHASHSEED, every node has to compute the same split
+    assert shard_of('wiki:start', 4) == shard_of('wiki:start', 4) == 3
+
+
+def test_shards_partition_the_names():
+    names = [f'ns{i % 7}:page{i}' for i in range(1000)]
+    shards = [[n for n in names if shard_of(n, 4) == index] for index in range(4)]
+    assert sorted(sum(shards, [])) == sorted(names)
+    assert all(150 < len(shard) < 350 for shard in shards)
+
+
+def test_parse_shard():
+    assert parse_shard('2/8') == (2, 8)
+    for value in ('8/8', '-1/8', '2', 'a/b'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            parse_shard(value)
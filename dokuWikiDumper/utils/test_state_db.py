@@ -0,0 +1,29 @@
+import os
+
+from dokuWikiDumper.utils.journal import ProgressJournal
+from dokuWikiDumper.utils.state_db import StateDB
+
+
+def test_state_db_progress_and_journal_import(tmp_path):
+    os.mkdir(tmp_path / 'dumpMeta')
+    journal = ProgressJournal(str(tmp_path))
+    journal.record('media', 'a.png')
+    journal.flush()
+
+    db = StateDB(str(tmp_path))
+    assert db.is_done('media', 'a.png')  # imported from the journal
+    db.set_titles(['p1', 'p2'])
+    db.set_files(['a.png', 'b.png'])
+    db.add_revisions('p1', [('300', '', 'E', 'u', 'now', ''), ('200', '', 'E', 'u', '', ''),
+                            ('100', '', 'E', 'u', '', '')])
+    db.record('content', 'p1@200')
+    db.record('content', 'p1')
+    db.set_status('content', 'p2', 'failed', 'HTTPError: 500')
+    db.close()
+
+    db = StateDB(str(tmp_path))
+    progress = db.progress()
+    assert progress['content'] == {'pages': (1, 2), 'revisions': (1, 2)}
+    assert progress['media'] == {'files': (1, 2)}
+    assert db.failed() == {'content': 1} and not db.is_done('content', 'p2')
+    db.close()
@@ -0,0 +1,48 @@
+import io
+import socket
+
+import requests
+import requests.structures
+
+from dokuWikiDumper.utils.transport import DNSCache, TransferStats, connection_stats
+
+
+def test_dns_cache(monkeypatch):
+    lookups = []
+
+    def getaddrinfo(host, port, *args):
+        lookups.append(host)
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('192.0.2.1', port))]
+
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    cache = DNSCache()
+    cache.configure(ttl=60)
+    try:
+        counted = connection_stats.lookups
+        for _ in range(3):
+            assert socket.getaddrinfo('wiki.example', 443)[0][4] == ('192.0.2.1', 443)
+        socket.getaddrinfo('other.example', 443)
+        assert lookups == ['wiki.example', 'other.example']
+        assert connection_stats.lookups - counted == 4
+
+        cache.configure(ttl=0)
+        socket.getaddrinfo('wiki.example', 443)
+        assert lookups[-1] == 'wiki.example'
+    finally:
+        cache.uninstall()
+    assert socket.getaddrinfo is getaddrinfo
+
+
+def test_transfer_stats_streamed_response():
+    r = requests.Response()
+    r.status_code = 200
+    r.url = 'https://wiki.example/doku.php?do=export_xhtml'
+    r.headers = requests.structures.CaseInsensitiveDict({'Content-Type': 'text/html; charset=utf-8'})
+    r.raw = io.BytesIO(b'x' * 100_000)
+
+    stats = TransferStats()
+    stats.on_response(r)
+    assert stats.stages == {}  # not read yet
+    assert len(r.content) == 100_000
+    assert stats.stages == {'other': [1, 0, 100_000, 100_000]}
+    assert stats.warned_hosts == {'wiki.example'}
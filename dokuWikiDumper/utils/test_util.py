@@ -1,4 +1,6 @@
-from dokuWikiDumper.utils.util import check_int
+import os
+
+from dokuWikiDumper.utils.util import check_int, open_atomic, trim_PHP_warnings
 
 
 def test_check_int():
@@ -8,3 +10,25 @@ def test_check_int():
     assert 1.1 == check_int(1.1)
     assert None is check_int(None)
     
+
+
+def test_trim_PHP_warnings():
+    html = '<b>Warning</b>: x in y.php\n<br />\n<!DOCTYPE html>\n<html>\n<br />\n</html>\n'
+    assert trim_PHP_warnings(html) == '<!DOCTYPE html>\n<html>\n<br />\n</html>\n'
+    assert trim_PHP_warnings(html.encode()) == '<!DOCTYPE html>\n<html>\n<br />\n</html>\n'.encode()
+
+    wikitext = '<br />\n<b>Notice</b>: z\n====== Title ======\n<br />\n'
+    assert trim_PHP_warnings(wikitext) == '====== Title ======\n<br />\n'
+    assert trim_PHP_warnings(wikitext, strict=True) == wikitext
+    assert trim_PHP_warnings('<html>\n\n') == '<html>\n\n'
+
+
+def test_open_atomic_writers_of_the_same_file(tmp_path):
+    path = str(tmp_path / 'page.txt')
+    with open_atomic(path) as first:
+        first.write('first')
+        with open_atomic(path) as second:  # e.g. a requeued item, still written by the stuck worker
+            second.write('second')
+        assert open(path).read() == 'second'
+    assert open(path).read() == 'first'
+    assert os.listdir(tmp_path) == ['page.txt']
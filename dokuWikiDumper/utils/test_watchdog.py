@@ -0,0 +1,70 @@
+import socket
+import threading
+import time
+
+from dokuWikiDumper.utils.scheduler import Task
+from dokuWikiDumper.utils.watchdog import Watchdog
+
+
+def test_watchdog_cancels_the_connection_of_a_stuck_worker():
+    dog = Watchdog()
+    dog.stall_timeout = 0.2
+    local, remote = socket.socketpair()
+    task = Task(priority=0, seq=0, index=0, payload='page')
+    received = []
+    started = threading.Event()
+
+    def worker():
+        with dog.working('HTML', 'page', task):
+            dog.workers[threading.get_ident()].connection = type('Connection', (), {'sock': local})()
+            started.set()
+            received.append(local.recv(1))  # nothing ever comes
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    started.wait()
+    dog.check()
+    assert thread.is_alive() and task.stalls == 0
+    time.sleep(0.3)
+    dog.check()
+    thread.join(timeout=5)
+    assert not thread.is_alive() and received == [b'']
+    assert task.stalls == 1 and not dog.workers
+    local.close()
+    remote.close()
+
+
+def test_watchdog_forgets_the_connection_once_back_in_the_pool():
+    import http.server
+
+    import requests
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', '5')
+            self.end_headers()
+            self.wfile.write(b'hello')
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}/'
+    dog = Watchdog()
+    dog._install()
+    try:
+        with requests.Session() as session, dog.working('HTML', 'page'):
+            state = dog.workers[threading.get_ident()]
+            session.get(url)
+            assert state.socket() is None  # another worker may be using it now
+            with session.get(url, stream=True) as r:
+                assert state.socket() is not None  # still reading the body
+                r.content
+            assert state.socket() is None
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from dokuWikiDumper.utils.write_behind import WriteBehind, WriteBehindError
+
+
+def test_write_behind_writes_atomically_and_reports_errors(tmp_path):
+    writer = WriteBehind()
+    writer.configure(2, queue_size=2, fsync_batch=3)
+    try:
+        for i in range(10):
+            assert writer.write(str(tmp_path / 'pages' / f'{i}.txt'), ['page ', str(i)]) == 6
+        writer.write(str(tmp_path / 'media.bin'), [b'\x00\x01'], binary=True)
+        writer.sync()
+        assert sorted(os.listdir(tmp_path / 'pages')) == sorted(f'{i}.txt' for i in range(10))
+        assert (tmp_path / 'pages' / '7.txt').read_text() == 'page 7'
+        assert (tmp_path / 'media.bin').read_bytes() == b'\x00\x01'
+
+        (tmp_path / 'file').write_text('not a directory')
+        writer.write(str(tmp_path / 'file' / 'page.txt'), ['x'])
+        with pytest.raises(OSError):
+            writer.sync()
+        with pytest.raises(OSError):
+            writer.write(str(tmp_path / 'other.txt'), ['x'])
+    finally:
+        writer.shutdown()
+    assert writer.files == 11
+    assert not [name for name in os.listdir(tmp_path / 'pages') if name.endswith('.tmp')]
+
+
+def test_write_behind_bounds_the_queue_by_bytes(tmp_path, monkeypatch):
+    monkeypatch.setattr('dokuWikiDumper.utils.write_behind.INLINE_SIZE', 100)
+    writer = WriteBehind()
+    writer.configure(1, max_bytes=20)
+    try:
+        for i in range(5):
+            assert writer.write(str(tmp_path / f'{i}.txt'), ['x' * 15]) == 15
+        assert writer.write(str(tmp_path / 'large.txt'), ['y' * 60, 'y' * 60]) == 120
+        writer.sync()
+        assert (tmp_path / '4.txt').read_text() == 'x' * 15
+        assert (tmp_path / 'large.txt').read_text() == 'y' * 120
+        assert writer.queued_files == writer.queued_bytes == 0
+
+        synced = writer.sync()
+        writer.write(str(tmp_path / 'broken.txt'), ['\ud800'])  # f.write() fails after open()
+        with pytest.raises(WriteBehindError) as e:
+            writer.sync(synced)
+        assert e.value.paths == [str(tmp_path / 'broken.txt')]
+        assert writer.sync(e.value.upto) == e.value.upto  # reported once
+        with pytest.raises(UnicodeEncodeError):
+            writer.check()  # to the thread that handed the file over, once too
+        writer.write(str(tmp_path / 'after.txt'), ['z'])
+        writer.sync(e.value.upto)
+    finally:
+        writer.shutdown()
+    assert writer.files == 6
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
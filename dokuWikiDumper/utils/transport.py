@@ -0,0 +1,403 @@
+import http.client
+import importlib.util
+import socket
+import threading
+import time
+from typing import Dict, List, Set, Tuple
+from urllib.parse import urlparse
+
+import requests
+import requests.adapters
+import requests.structures
+import requests.utils
+
+from dokuWikiDumper.utils.concurrency import host_controllers
+from dokuWikiDumper.utils.scheduler import current_stage
+from dokuWikiDumper.utils.util import print_with_lock as print
+from dokuWikiDumper.utils.watchdog import watchdog
+
+DEFAULT_POOL_MAXSIZE = 10
+""" `requests` default, the pools grow to the worker count above it """
+DEFAULT_DNS_TTL = 300
+
+
+class ConnectionStats:
+    """ Keep-alive reuse: `requests - connections` requests went over a reused (or multiplexed) connection.
+
+    The connections are those urllib3 opens (see `ConnectTimer`). `httpx` (`--http2`) opens its own: they are
+    estimated from the DNS lookups then, every new connection resolves its host once (see `DNSCache`).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.lookups = 0
+        self.dns_hits = 0
+
+    def on_response(self, r: requests.Response, *args, **kwargs):
+        with self.lock:
+            self.requests += 1
+
+    def on_connect(self):
+        with self.lock:
+            self.connections += 1
+
+    def on_lookup(self, cached: bool):
+        with self.lock:
+            self.lookups += 1
+            self.dns_hits += cached
+
+    def summary(self) -> str:
+        with self.lock:
+            connections = self.connections or self.lookups
+            reused = max(self.requests - connections, 0)
+            ratio = reused / self.requests if self.requests else 0.0
+            label = 'connections' if self.connections else 'connections (estimated from the DNS lookups)'
+            return (f'{self.requests} requests over {connections} {label} ({ratio:.0%} reused), '
+                    f'DNS cache: {self.dns_hits}/{self.lookups} hits')
+
+
+connection_stats = ConnectionStats()
+
+
+class DNSCache:
+    """ Process-wide `socket.getaddrinfo()` cache, used by urllib3 and httpx alike.
+
+    Every new connection otherwise re-resolves the host, which is slow on some resolvers
+    and gets rate limited on others. Failed lookups aren't cached.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ttl = 0.0
+        self.cache: Dict[tuple, Tuple[float, list]] = {}
+        self.original = None
+
+    def configure(self, ttl: float):
+        """ (re)install the cache, `ttl=0` only counts the connections """
+        with self.lock:
+            self.ttl = ttl
+            self.cache.clear()
+            if self.original is None:
+                self.original = socket.getaddrinfo
+                socket.getaddrinfo = self.getaddrinfo
+
+    def uninstall(self):
+        with self.lock:
+            if self.original is not None:
+                socket.getaddrinfo = self.original
+                self.original = None
+            self.cache.clear()
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        key = (host, port, family, type, proto, flags)
+        now = time.monotonic()
+        with self.lock:
+            original = self.original or socket.getaddrinfo
+            entry = self.cache.get(key) if self.ttl > 0 else None
+        if entry is not None and entry[0] > now:
+            connection_stats.on_lookup(cached=True)
+            return list(entry[1])
+        result = original(host, port, family, type, proto, flags)
+        with self.lock:
+            if self.ttl > 0:
+                self.cache[key] = (now + self.ttl, list(result))
+        connection_stats.on_lookup(cached=False)
+        return result
+
+
+dns_cache = DNSCache()
+
+
+class ConnectTimer:
+    """ Times the TCP connection setups of urllib3 (not the TLS handshake), for `AdaptiveTimeout`,
+    and counts them for `ConnectionStats` """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.original = None
+
+    def install(self):
+        import urllib3.util.connection
+
+        with self.lock:
+            if self.original is None:
+                self.original = urllib3.util.connection.create_connection
+                urllib3.util.connection.create_connection = self.create_connection
+
+    def uninstall(self):
+        import urllib3.util.connection
+
+        with self.lock:
+            if self.original is not None:
+                urllib3.util.connection.create_connection = self.original
+                self.original = None
+
+    def create_connection(self, address, *args, **kwargs):
+        start = time.monotonic()
+        sock = self.original(address, *args, **kwargs)
+        connection_stats.on_connect()
+        host, port = address
+        netloc = host if port in (None, 80, 443) else f'{host}:{port}'
+        host_controllers.get(netloc).timeouts.observe_connect(time.monotonic() - start)
+        return sock
+
+
+connect_timer = ConnectTimer()
+
+
+def http2_available() -> bool:
+    return importlib.util.find_spec('httpx') is not None and importlib.util.find_spec('h2') is not None
+
+
+class _RetryResponse:
+    """ The part of `urllib3.HTTPResponse` that `Retry.increment()` and `Retry.sleep()` look at """
+    def __init__(self, status: int, reason: str, headers):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+    def get_redirect_location(self):
+        return False
+
+
+class _HTTPXRaw:
+    """ `requests.Response.raw` backed by an `httpx.Response` (already decoded, like `decode_content=True`) """
+    def __init__(self, response, retries):
+        import httpx
+
+        self.httpx = httpx
+        self.response = response
+        self.retries = retries
+        msg = http.client.HTTPMessage()
+        for name, value in response.headers.multi_items():
+            msg[name] = value
+        # for `requests.cookies.extract_cookies_to_jar()`
+        self._original_response = type('OriginalResponse', (), {'msg': msg})()
+        self._connection = None
+        self._buffer = b''
+        self._chunks = None
+
+    def stream(self, chunk_size=None, decode_content=True):
+        try:
+            yield from self.response.iter_bytes(chunk_size)
+        except self.httpx.TimeoutException as e:
+            raise requests.exceptions.ConnectionError(e)
+        except self.httpx.TransportError as e:
+            raise requests.exceptions.ChunkedEncodingError(e)
+
+    def read(self, amt=None, decode_content=True):
+        if amt is None:
+            data = self._buffer + b''.join(self.stream())
+            self._buffer = b''
+            return data
+        if self._chunks is None:
+            self._chunks = self.stream()
+        while len(self._buffer) < amt:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def tell(self) -> int:
+        """ bytes received so far, before decoding """
+        return self.response.num_bytes_downloaded
+
+    def close(self):
+        self.response.close()
+
+    def release_conn(self):
+        self.response.close()
+
+
+class HTTP2Adapter(requests.adapters.BaseAdapter):
+    """ `requests` transport adapter on top of `httpx` (`--http2`).
+
+    Hosts that offer HTTP/2 in the TLS handshake get all the requests multiplexed over one connection,
+    the others (and plain http://) fall back to HTTP/1.1 keep-alive.
+    Redirects and cookies are still handled by the `requests.Session`, `max_retries` (the `CustomRetry` of
+    `create_session()`) by the adapter. Proxies aren't supported.
+    """
+    def __init__(self, max_retries=None, pool_maxsize: int = DEFAULT_POOL_MAXSIZE):
+        import httpx
+        from urllib3.util.retry import Retry
+
+        super().__init__()
+        self.httpx = httpx
+        self.max_retries = Retry.from_int(max_retries) if max_retries is not None else None
+        self.limits = httpx.Limits(max_connections=pool_maxsize, max_keepalive_connections=pool_maxsize)
+        self.lock = threading.Lock()
+        self.transports: Dict[object, object] = {}
+        """ one per `verify` value """
+
+    def _transport(self, verify):
+        key = verify if isinstance(verify, (bool, str)) else True
+        with self.lock:
+            if key not in self.transports:
+                self.transports[key] = self.httpx.HTTPTransport(http2=True, verify=key, limits=self.limits)
+            return self.transports[key]
+
+    def _timeout(self, timeout) -> dict:
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            return self.httpx.Timeout(read, connect=connect).as_dict()
+        return self.httpx.Timeout(timeout).as_dict()
+
+    def send(self, request: requests.PreparedRequest, stream=False, timeout=None, verify=True, cert=None,
+             proxies=None):
+        httpx = self.httpx
+        retries = self.max_retries
+        while True:
+            body = request.body
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            httpx_request = httpx.Request(request.method, request.url, headers=list(request.headers.items()),
+                                          content=body, extensions={'timeout': self._timeout(timeout)})
+            try:
+                response = self._transport(verify).handle_request(httpx_request)
+            except httpx.ConnectTimeout as e:
+                raise requests.exceptions.ConnectTimeout(e, request=request)
+            except httpx.TimeoutException as e:
+                raise requests.exceptions.ReadTimeout(e, request=request)
+            except httpx.TransportError as e:
+                raise requests.exceptions.ConnectionError(e, request=request)
+
+            if retries is not None and retries.is_retry(request.method, response.status_code,
+                                                        'Retry-After' in response.headers):
+                retry_response = _RetryResponse(response.status_code, response.reason_phrase, response.headers)
+                try:
+                    response.read()  # drained, the connection stays usable
+                except httpx.TransportError:
+                    pass
+                response.close()
+                try:
+                    retries = retries.increment(method=request.method, url=request.url, response=retry_response)
+                except Exception as e:  # MaxRetryError
+                    raise requests.exceptions.RetryError(e, request=request)
+                retries.last_host = httpx_request.url.netloc.decode('ascii')
+                retries.sleep(retry_response)
+                continue
+            break
+
+        r = requests.Response()
+        r.status_code = response.status_code
+        r.headers = requests.structures.CaseInsensitiveDict(response.headers.multi_items())
+        r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+        r.reason = response.reason_phrase
+        r.url = request.url
+        r.request = request
+        r.connection = self
+        r.raw = _HTTPXRaw(response, retries)
+        return r
+
+    def close(self):
+        with self.lock:
+            for transport in self.transports.values():
+                transport.close()
+            self.transports.clear()
+
+
+TEXT_TYPES = ('text/', 'application/xhtml', 'application/xml', 'application/json')
+UNCOMPRESSED_WARNING_SIZE = 64 * 1024
+""" text responses above this size served without `Content-Encoding` get a warning (once per host) """
+
+
+def httpx_accept_encoding() -> str:
+    """ Every encoding `httpx` can decode: gzip and deflate, br and zstd when their decoders are installed.
+
+    The urllib3 transport needs none: the default `Accept-Encoding` of `requests` already is urllib3's own list.
+    """
+    encodings = ['gzip', 'deflate']
+    if importlib.util.find_spec('brotli') or importlib.util.find_spec('brotlicffi'):
+        encodings.append('br')
+    if importlib.util.find_spec('zstandard'):
+        encodings.append('zstd')
+    return ', '.join(encodings)
+
+
+class TransferStats:
+    """ Bytes on the wire vs. decoded bytes, per stage (`current_stage()` of the requesting thread) """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages: Dict[str, List[int]] = {}
+        """ stage: [responses, compressed responses, wire bytes, decoded bytes] """
+        self.warned_hosts: Set[str] = set()
+
+    def on_response(self, r: requests.Response, *args, **kwargs):
+        stage = current_stage() or 'other'
+        if r._content_consumed:
+            self.record(r, stage, len(r._content or b''))
+            return
+        # stream=True: counted once the body has been read, `r.content` goes through `iter_content()` too
+        iter_content = r.iter_content
+        recorded = False
+
+        def counting_iter_content(*args, **kwargs):
+            nonlocal recorded
+            decoded = 0
+            try:
+                for chunk in iter_content(*args, **kwargs):
+                    decoded += len(chunk)
+                    watchdog.beat()
+                    yield chunk
+            finally:
+                if not recorded:
+                    recorded = True
+                    self.record(r, stage, decoded)
+
+        r.iter_content = counting_iter_content
+
+    def record(self, r: requests.Response, stage: str, decoded: int):
+        tell = getattr(r.raw, 'tell', None)
+        wire = tell() if callable(tell) else decoded
+        compressed = r.headers.get('Content-Encoding', 'identity').strip().lower() not in ('', 'identity')
+        with self.lock:
+            counters = self.stages.setdefault(stage, [0, 0, 0, 0])
+            counters[0] += 1
+            counters[1] += compressed
+            counters[2] += wire
+            counters[3] += decoded
+            content_type = r.headers.get('Content-Type', '')
+            host = urlparse(r.url).netloc
+            warn = (not compressed and decoded >= UNCOMPRESSED_WARNING_SIZE and content_type.startswith(TEXT_TYPES)
+                    and host not in self.warned_hosts)
+            if warn:
+                self.warned_hosts.add(host)
+        if warn:
+            print(f'Warning: {host} serves {content_type.split(";")[0]} uncompressed ({decoded / 1024:.0f} KiB), '
+                  'enabling gzip on the server would save most of the bandwidth.')
+
+    def summary(self) -> List[str]:
+        with self.lock:
+            lines = []
+            for stage, (responses, compressed, wire, decoded) in self.stages.items():
+                ratio = wire / decoded if decoded else 1.0
+                lines.append(f'{stage}: {responses} responses ({compressed} compressed), '
+                             f'{wire / 1024 / 1024:.2f} MB received for {decoded / 1024 / 1024:.2f} MB ({ratio:.0%})')
+            return lines
+
+
+transfer_stats = TransferStats()
+
+
+def track_transfers(session: requests.Session, http2: bool = False):
+    """ Negotiate the best `Accept-Encoding` (`--http2`) and count the compressed/decoded bytes of `session` """
+    if http2:
+        session.headers['Accept-Encoding'] = httpx_accept_encoding()
+    if transfer_stats.on_response not in session.hooks['response']:
+        session.hooks['response'].append(transfer_stats.on_response)
+
+
+def track_connections(session: requests.Session, dns_ttl: float = DEFAULT_DNS_TTL):
+    """ Cache DNS for `dns_ttl` seconds (0: off), count the keep-alive reuse of `session` and time the connections.
+
+    Both patches are process-wide, `untrack_connections()` removes them. """
+    dns_cache.configure(dns_ttl)
+    connect_timer.install()
+    if connection_stats.on_response not in session.hooks['response']:
+        session.hooks['response'].append(connection_stats.on_response)
+
+
+def untrack_connections():
+    dns_cache.uninstall()
+    connect_timer.uninstall()
@@ -1,10 +1,12 @@
 import builtins
+import itertools
 import os
 import re
 import sys
 import threading
 import time
-from typing import Any, List, Optional, Union, overload
+from contextlib import contextmanager
+from typing import IO, Any, AnyStr, Iterable, Iterator, List, Optional, Set, Union, overload
 from urllib.parse import unquote, urljoin, urlparse
 
 import requests
@@ -54,6 +56,14 @@ def print_with_lock(*args, **kwargs):
     printLock.release()
 
 
+def press_enter_to_continue():
+    """ `input('Press Enter to continue...')` that doesn't block unattended runs (stdin is not a TTY) """
+    if sys.stdin is None or not sys.stdin.isatty():
+        print('(non-interactive, continuing)')
+        return
+    input('Press Enter to continue...')
+
+
 def _is_disallow_in_robots_txt(robots_txt: str, user_agent: str) -> bool:
     robots_txt = robots_txt.lower()
     user_agent = user_agent.lower()
@@ -104,6 +114,11 @@ def avoidSites(url: str, session: requests.Session):
         time.sleep(3)
 
 
+KNOWN_DIRS_MAX = 65536
+_known_dirs: Set[str] = set()
+""" dirs `smkdirs()` created or found, nothing removes them while dumping """
+
+
 def smkdirs(parent: str, *child: str)-> Optional[str]:
     """ safe mkdir, return: True->created, False->existed """
     if parent is None:
@@ -114,14 +129,17 @@ def smkdirs(parent: str, *child: str)-> Optional[str]:
 
     dir = os.path.join(parent, *_child)
     # print(dir)
-    fileLock.acquire()
-    if not os.path.exists(dir):
-        os.makedirs(dir)
-        fileLock.release()
-        return dir
-
-    fileLock.release()
-    return None
+    if dir in _known_dirs:
+        # every write of a page calls it, skip the lock and the stat() (slow on NFS) after the first one
+        return None
+    with fileLock:
+        created = not os.path.exists(dir)
+        if created:
+            os.makedirs(dir)
+        if len(_known_dirs) >= KNOWN_DIRS_MAX:
+            _known_dirs.clear()
+        _known_dirs.add(dir)
+    return dir if created else None
 
 
 def standardize_url(url: str):
@@ -259,6 +277,38 @@ def uopen(*args, **kwargs):
     return open(*args, encoding='UTF-8', **kwargs)
 
 
+_tmp_seq = itertools.count()
+
+
+@contextmanager
+def open_atomic(path: str, binary: bool = False) -> Iterator[IO]:
+    """ `open()` `path.<pid>.<n>.tmp` for writing, renamed to `path` if the block completes, removed otherwise
+    (failed download, interrupted dump).
+
+    Not `path.tmp`: the same file can be written twice at once (an item requeued by the watchdog, a hedged
+    request, another worker process), each writer renames its own complete file. """
+    tmp_path = f'{path}.{os.getpid()}.{next(_tmp_seq)}.tmp'
+    try:
+        with (open(tmp_path, 'wb') if binary else uopen(tmp_path, 'w')) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_atomic(path: str, chunks: Iterable[AnyStr], binary: bool = False) -> int:
+    """ Write `chunks` to a temporary file and rename it to `path` once complete,
+    a failed download never leaves a truncated file behind. Returns the number of characters (bytes) written. """
+    size = 0
+    with open_atomic(path, binary=binary) as f:
+        for chunk in chunks:
+            f.write(chunk)
+            size += len(chunk)
+    return size
+
+
 WARNINGS_TO_REMOVE = tuple([
     '<br>',
     '<br />',
@@ -277,61 +327,62 @@ WARNINGS_TO_REMOVE = tuple([
     '<error>'
     # add more if needed
 ])
+WARNINGS_TO_REMOVE_BYTES = tuple(warning.encode('ascii') for warning in WARNINGS_TO_REMOVE)
 
-def trim_PHP_warnings(html_or_text: str, strict: bool = False) -> str:
+def trim_PHP_warnings(html_or_text: AnyStr, strict: bool = False) -> AnyStr:
     """ Trim PHP warnings in HTML or wikitext (Cannot handle single line HTML)
-    
+
+    `html_or_text`: `str`, or `bytes` in an ASCII-compatible encoding (trimmed before decoding)
     param: `strict`: if `True`, only remove warnings when found `<html` 
     or `<!DOCTYPE html`(return original text if not found).
+
+    Single pass: only the leading lines are looked at, the document is sliced, never copied line by line.
     """
+    is_bytes = isinstance(html_or_text, bytes)
+    doctype, html, newline = (b'<!DOCTYPE html', b'<html', b'\n') if is_bytes else ('<!DOCTYPE html', '<html', '\n')
+    warnings = WARNINGS_TO_REMOVE_BYTES if is_bytes else WARNINGS_TO_REMOVE
 
-    doc_type_is_html_TAG = '<!DOCTYPE html' in html_or_text
-    html_TAG = '<html' in html_or_text
+    def as_str(line) -> str:
+        return line.decode('utf-8', 'replace').strip() if is_bytes else line.strip()
+
+    doc_type_is_html_TAG = doctype in html_or_text
+    html_TAG = html in html_or_text
 
     if strict and not (doc_type_is_html_TAG or html_TAG):
         return html_or_text
 
-    lines = html_or_text.splitlines(keepends=True) # keepends=True to keep \n
-
-    if len(lines) == 1 and (doc_type_is_html_TAG or html_TAG):
+    if html_or_text.find(newline) in (-1, len(html_or_text) - 1) and (doc_type_is_html_TAG or html_TAG):
         print('Warning: cannot remove dokuwiki warnings in single line text')
         return html_or_text # original text
 
-    new_text = ''
-    in_document = False
-    for line in lines:
-        if in_document:
-            new_text += line
-            continue
+    # offset of the first line of the document
+    start = 0
+    while start < len(html_or_text):
+        end = html_or_text.find(newline, start)
+        end = len(html_or_text) if end == -1 else end + 1
+        line = html_or_text[start:end]
 
-        if ((doc_type_is_html_TAG and '<!DOCTYPE html' in line) or
-            (html_TAG             and '<html'          in line)
+        if ((doc_type_is_html_TAG and doctype in line) or
+            (html_TAG             and html    in line)
         ):
-            in_document = True
-            new_text = line # first line
-            continue
+            break
         elif (doc_type_is_html_TAG or html_TAG):
             # remove anything before '<!DOCTYPE html' or '<html'
-            print('Removing PHP warning: ' + line.strip())
-            continue
-
-        # here: in_document == False, doc_type_is_html_TAG == False, html_TAG == False
-        if (line.startswith(WARNINGS_TO_REMOVE)):
-            print('(HTML header not found) removing PHP warning (unsafely): ' + line.strip())
-            continue
+            print('Removing PHP warning: ' + as_str(line))
+        elif line.startswith(warnings):
+            # here: doc_type_is_html_TAG == False, html_TAG == False
+            print('(HTML header not found) removing PHP warning (unsafely): ' + as_str(line))
         else:
-            in_document = True
             # print('The line is not PHP warning (if it is, please report an issue): ' + line.strip())
-            new_text = line # first line
-            continue
+            break
+        start = end
 
-    def help_wanted(msg: str = ''):
-        print_with_lock(msg) # with color
-    if html_or_text != new_text:
-        help_wanted("[yellow]Notice: trim_PHP_warnings() needs more sample sites to test. "
-                "Please feedback if you found some warnings are not removed.[/yellow]")
+    if start == 0:
+        return html_or_text
 
-    return new_text
+    print_with_lock("[yellow]Notice: trim_PHP_warnings() needs more sample sites to test. "
+                    "Please feedback if you found some warnings are not removed.[/yellow]")
+    return html_or_text[start:]
 
 
 class Singleton(type):
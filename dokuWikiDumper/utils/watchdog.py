@@ -0,0 +1,188 @@
+import socket
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from rich.markup import escape
+
+from dokuWikiDumper.utils.util import print_with_lock as print
+
+DEFAULT_STALL_TIMEOUT = 300.0
+
+
+@dataclass
+class WorkerState:
+    stage: str
+    label: str
+    task: Any
+    progress: float
+    """ last time the worker received bytes or completed a request """
+    connection: Any = None
+    """ the urllib3 connection of its request in progress """
+    response: Any = None
+    """ the streamed urllib3 response reading from `connection`, the connection is the worker's until released """
+
+    def socket(self) -> Optional[socket.socket]:
+        """ the socket the worker reads from, `None` if its connection went back to the pool (another worker's) """
+        conn, response = self.connection, self.response
+        if conn is None:
+            return None
+        if response is not None and getattr(response, '_connection', None) is not conn:
+            return None  # `release_conn()`
+        return getattr(conn, 'sock', None)
+
+
+class Watchdog:
+    """ Flags the worker threads that made no progress (bytes received, requests completed) for `stall_timeout`.
+
+    A stuck worker gets its stack dumped to the log and its connection shut down, so the blocked read fails,
+    the request is retried and the task requeued (`Task.stalls`). A thread can't be killed: a worker stuck
+    anywhere else is only reported. The whole dump making no progress is reported every `stall_timeout` too.
+
+    `stall_timeout=0` disables it. The timestamps are plain assignments, cheap enough for every chunk read.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.workers: Dict[int, WorkerState] = {}
+        self.stall_timeout = 0.0
+        self.last_progress = time.monotonic()
+        self.last_report = 0.0
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.original_make_request = None
+
+    def configure(self, stall_timeout: float):
+        self.stop()
+        self.stall_timeout = stall_timeout
+        self._install()  # also used by `cancel_connections()`
+        if stall_timeout <= 0:
+            return
+        self.last_progress = time.monotonic()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='watchdog', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join()
+            self.thread = None
+
+    def _install(self):
+        """ remember the connection of the urllib3 request in progress, per thread """
+        import urllib3.connectionpool
+
+        with self.lock:
+            if self.original_make_request is not None:
+                return
+            self.original_make_request = original = urllib3.connectionpool.HTTPConnectionPool._make_request
+
+        def _make_request(pool, conn, *args, **kwargs):
+            state = self.workers.get(threading.get_ident())
+            if state is None:
+                return original(pool, conn, *args, **kwargs)
+            state.connection, state.response = conn, None
+            try:
+                response = original(pool, conn, *args, **kwargs)
+            except BaseException:
+                state.connection = None
+                raise
+            if kwargs.get('response_conn') is None:
+                state.connection = None  # body already read, the connection goes back to the pool
+            else:
+                state.response = response  # streamed: the worker's until the response releases it
+            return response
+
+        urllib3.connectionpool.HTTPConnectionPool._make_request = _make_request
+
+    def beat(self):
+        """ the calling thread made progress """
+        now = time.monotonic()
+        self.last_progress = now
+        state = self.workers.get(threading.get_ident())
+        if state is not None:
+            state.progress = now
+
+    def waiting(self):
+        """ the calling thread waits on purpose (paused host, open circuit breaker), it isn't stuck """
+        state = self.workers.get(threading.get_ident())
+        if state is not None:
+            state.progress = time.monotonic()
+
+    def current(self) -> Optional[WorkerState]:
+        """ the state of the calling thread, `None` outside of `working()` """
+        return self.workers.get(threading.get_ident())
+
+    @contextmanager
+    def working(self, stage: str, label: str, task: Any = None):
+        """ the calling thread works on `task` until the block exits """
+        ident = threading.get_ident()
+        with self.lock:
+            self.workers[ident] = WorkerState(stage=stage, label=label, task=task, progress=time.monotonic())
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.workers.pop(ident, None)
+            self.beat()
+
+    def _run(self):
+        interval = min(30.0, self.stall_timeout / 4)
+        while not self.stop_event.wait(interval):
+            self.check()
+
+    def check(self):
+        now = time.monotonic()
+        with self.lock:
+            stuck = [(ident, state) for ident, state in self.workers.items()
+                     if now - state.progress > self.stall_timeout]
+            for _, state in stuck:
+                state.progress = now  # reported again if still stuck after another `stall_timeout`
+            stages = ', '.join(sorted({state.stage for state in self.workers.values()}))
+        frames = sys._current_frames()
+        for ident, state in stuck:
+            self._recycle(ident, state, frames.get(ident))
+
+        idle = now - self.last_progress
+        if idle > self.stall_timeout and now - self.last_report > self.stall_timeout:
+            self.last_report = now
+            print(f'Watchdog: no progress for {idle / 60:.0f} minutes' + (f' ({stages})' if stages else ''))
+
+    def cancel_connections(self) -> int:
+        """ shut down the connection of every worker, returns how many """
+        with self.lock:
+            socks = [state.socket() for state in self.workers.values()]
+        cancelled = 0
+        for sock in socks:
+            if sock is None:
+                continue
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+                cancelled += 1
+            except OSError:
+                pass
+        return cancelled
+
+    def _recycle(self, ident: int, state: WorkerState, frame):
+        print(f'Watchdog: {state.stage} worker stuck on {escape(state.label)} '
+              f'for more than {self.stall_timeout:.0f}s, stack:')
+        if frame is not None:
+            print(escape(''.join(traceback.format_stack(frame)).rstrip()))
+        if state.task is not None and hasattr(state.task, 'stalls'):
+            state.task.stalls += 1
+        sock = state.socket()
+        if sock is None:
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)  # the blocked read returns, the request fails and is retried
+            print(f'Watchdog: connection of the {state.stage} worker cancelled')
+        except OSError:
+            pass
+
+
+watchdog = Watchdog()
+""" process-wide, configured by `--stall-timeout` """
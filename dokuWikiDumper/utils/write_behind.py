@@ -0,0 +1,259 @@
+import contextvars
+import itertools
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import AnyStr, Dict, Iterable, List, Optional, Set, Tuple
+
+from dokuWikiDumper.utils.util import print_with_lock as print
+from dokuWikiDumper.utils.util import smkdirs, uopen, write_atomic
+from dokuWikiDumper.utils.watchdog import watchdog
+
+DEFAULT_IO_QUEUE = 256
+DEFAULT_IO_QUEUE_BYTES = 64 * 1024 * 1024
+INLINE_SIZE = 1024 * 1024
+""" a file larger than this is streamed to disk by the worker itself """
+
+
+_owner: contextvars.ContextVar[Optional[object]] = contextvars.ContextVar('write_behind_owner', default=None)
+
+
+class WriteBehindError(OSError):
+    """ Files handed over to the I/O threads could not be written. `upto`: the `sync()` that saw it """
+    def __init__(self, paths: List[str], upto: int):
+        super().__init__(f'{len(paths)} files could not be written: {", ".join(paths[:5])}'
+                         + (', ...' if len(paths) > 5 else ''))
+        self.paths = paths
+        self.upto = upto
+
+
+class WriteBehind:
+    """ Writes the pages, revisions, HTML and `.changes` files on dedicated I/O threads (`--io-threads`),
+    so the network workers don't wait on slow storage (NFS, HDD).
+
+    A worker hands over the whole file and goes on, unless `queue_size` files or `max_bytes` are already
+    waiting: then it blocks, the network side slows down to what the storage can take. Files larger than
+    `INLINE_SIZE` (and media files, PDFs) are still streamed to disk by the worker, so the memory stays bounded.
+    The I/O threads write a temporary file, `fsync()` a batch of files at once, then rename them into place: a file
+    is either complete or absent. `sync()` waits for the files handed over so far, the progress journal calls
+    it before recording their items as done.
+
+    A write error is reported once to each side: the thread that handed the file over gets it from its next
+    `write()`/`check()` (its item fails, like with `write_atomic()`), and every `sync(since)` covering the file
+    raises `WriteBehindError` (the journal doesn't record that batch). Later writes go on.
+    Within `item()`, the item is the owner instead of the thread (asyncio: the items share the event loop's
+    thread, and their blocking calls run on `asyncio.to_thread()`'s).
+
+    With `threads=0` (default), `write()` is `write_atomic()`.
+    """
+    def __init__(self):
+        self.queue: Optional[queue.Queue] = None
+        self.threads: List[threading.Thread] = []
+        self.queue_size = DEFAULT_IO_QUEUE
+        self.max_bytes = DEFAULT_IO_QUEUE_BYTES
+        self.queued_files = self.queued_bytes = 0
+        self.fsync_batch = 32
+        self.thread_count = 0
+        self.cond = threading.Condition()
+        self.seq = 0
+        self.pending: Set[int] = set()
+        self.failed: List[Tuple[int, str]] = []
+        """ (seq, path) of the files that could not be written """
+        self.thread_errors: Dict[object, BaseException] = {}
+        """ by owner (thread ident or `item()`): the first error of its files, not raised yet """
+        self.files = self.bytes = 0
+        self.blocked = 0.0
+        """ seconds the workers waited on a full queue """
+
+    def configure(self, threads: int, queue_size: int = DEFAULT_IO_QUEUE, fsync_batch: int = 32,
+                  max_bytes: int = DEFAULT_IO_QUEUE_BYTES):
+        self.shutdown()
+        with self.cond:
+            self.failed = []
+            self.thread_errors = {}
+            self.files = self.bytes = 0
+            self.blocked = 0.0
+            self.queued_files = self.queued_bytes = 0
+        self.queue_size = max(queue_size, 1)
+        self.max_bytes = max_bytes
+        self.fsync_batch = fsync_batch
+        self.thread_count = max(threads, 0)
+        if threads <= 0:
+            return
+        self.queue = queue.Queue()  # bounded by `_reserve()`
+        # daemon: a failed dump must not hang on them, `sync()` is what makes sure the files are written
+        self.threads = [threading.Thread(target=self._run, name=f'io-{i}', daemon=True) for i in range(threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def shutdown(self):
+        """ write what is queued, stop the I/O threads """
+        if self.queue is None:
+            return
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.queue = None
+        self.threads = []
+
+    @property
+    def enabled(self) -> bool:
+        return self.queue is not None
+
+    @staticmethod
+    def _owner() -> object:
+        owner = _owner.get()
+        return threading.get_ident() if owner is None else owner
+
+    @contextmanager
+    def item(self):
+        """ The files handed over in the block (and in the threads it starts with its context) are the item's """
+        owner = object()
+        token = _owner.set(owner)
+        try:
+            yield
+        finally:
+            _owner.reset(token)
+            with self.cond:
+                self.thread_errors.pop(owner, None)
+
+    def check(self):
+        """ Raise (once) the error of a file handed over by the calling thread (item) """
+        with self.cond:
+            error = self.thread_errors.pop(self._owner(), None)
+        if error is not None:
+            raise error
+
+    def write(self, path: str, chunks: Iterable[AnyStr], binary: bool = False) -> int:
+        """ `write_atomic()`, done later by an I/O thread. Returns the number of characters (bytes). """
+        if self.queue is None:
+            return write_atomic(path, chunks, binary=binary)
+        self.check()
+        chunks = iter(chunks)
+        buffered: List[AnyStr] = []
+        size = 0
+        for chunk in chunks:
+            buffered.append(chunk)
+            size += len(chunk)
+            if size > INLINE_SIZE:
+                return write_atomic(path, itertools.chain(buffered, chunks), binary=binary)
+        data = (b'' if binary else '').join(buffered)  # type: ignore
+        self._reserve(len(data))
+        with self.cond:
+            self.seq += 1
+            seq = self.seq
+            self.pending.add(seq)
+        self.queue.put((seq, path, data, binary, self._owner()))
+        return len(data)
+
+    def _reserve(self, size: int):
+        """ wait for room in the queue: the backpressure on the workers """
+        start = time.monotonic()
+        with self.cond:
+            while self.queued_files >= self.queue_size or \
+                    (self.queued_bytes and self.queued_bytes + size > self.max_bytes):
+                self.cond.wait(1.0)
+                watchdog.waiting()  # slow storage, not a stalled worker
+            self.queued_files += 1
+            self.queued_bytes += size
+            waited = time.monotonic() - start
+            if waited > 0.001:
+                self.blocked += waited
+
+    def sync(self, since: int = 0) -> int:
+        """ Block until the files handed over so far are on disk. Returns how far that is, the `since` of the next
+        call: `WriteBehindError` is raised if a file handed over after `since` could not be written. """
+        with self.cond:
+            upto = self.seq
+            while self.pending and min(self.pending) <= upto:
+                self.cond.wait()
+            failed = [path for seq, path in self.failed if since < seq <= upto]
+        if failed:
+            raise WriteBehindError(failed, upto)
+        return upto
+
+    def _run(self):
+        assert self.queue is not None
+        batch: List[Tuple[int, str, str, object, object]] = []
+        while True:
+            try:
+                # nothing else to do: make the batch durable now, someone may be waiting for it in `sync()`
+                job = self.queue.get(timeout=0.2) if batch else self.queue.get()
+            except queue.Empty:
+                self._flush(batch)
+                batch = []
+                continue
+            if job is None:
+                self._flush(batch)
+                return
+            seq, path, data, binary, owner = job
+            with self.cond:
+                self.queued_files -= 1
+                self.queued_bytes -= len(data)
+                self.cond.notify_all()
+            # not `path.tmp`: two writes of the same file (a retried item) may be in different batches
+            tmp_path = f'{path}.{seq}.tmp'
+            f = None
+            try:
+                smkdirs(os.path.dirname(path))
+                f = open(tmp_path, 'wb') if binary else uopen(tmp_path, 'w')
+                f.write(data)
+            except BaseException as e:
+                if f is not None:
+                    f.close()
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                self._failed([(seq, path, owner)], e)
+                continue
+            batch.append((seq, path, tmp_path, f, owner))
+            with self.cond:
+                self.files += 1
+                self.bytes += len(data)
+            if len(batch) >= self.fsync_batch:
+                self._flush(batch)
+                batch = []
+
+    def _flush(self, batch: List[Tuple[int, str, str, object, object]]):
+        if not batch:
+            return
+        try:
+            for _, _, _, f, _ in batch:
+                f.flush()  # type: ignore
+                os.fsync(f.fileno())  # type: ignore
+                f.close()  # type: ignore
+            for _, path, tmp_path, _, _ in batch:
+                os.replace(tmp_path, path)
+        except BaseException as e:
+            for _, _, tmp_path, f, _ in batch:
+                f.close()  # type: ignore
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            # the files already renamed are complete, but which ones is not worth sorting out
+            self._failed([(seq, path, owner) for seq, path, _, _, owner in batch], e)
+            return
+        with self.cond:
+            self.pending.difference_update(seq for seq, _, _, _, _ in batch)
+            self.cond.notify_all()
+
+    def _failed(self, jobs: List[Tuple[int, str, object]], e: BaseException):
+        for _, path, _ in jobs:
+            print(f'Write-behind: {path} could not be written: {type(e).__name__}: {e}')
+        with self.cond:
+            for seq, path, owner in jobs:
+                self.failed.append((seq, path))
+                self.thread_errors.setdefault(owner, e)
+                self.pending.discard(seq)
+            self.cond.notify_all()
+
+    def summary(self) -> str:
+        with self.cond:
+            return (f'{self.files} files, {self.bytes / 1024 / 1024:.2f} MB written by {self.thread_count} I/O threads, '
+                    f'workers blocked {self.blocked:.1f}s on a full queue'
+                    + (f', {len(self.failed)} files failed' if self.failed else ''))
+
+
+write_behind = WriteBehind()
+""" process-wide, configured by `--io-threads` """
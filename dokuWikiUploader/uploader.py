@@ -18,6 +18,7 @@ from dokuWikiDumper.dump.info.info import (
     INFO_WIKI_NAME,
     get_info,
 )
+from dokuWikiDumper.utils.compression import COMPRESSED_SUFFIXES
 from dokuWikiDumper.utils.config import get_config
 from dokuWikiDumper.utils.util import url2prefix
 
@@ -240,6 +241,9 @@ class IAUploader:
             print(f"File {output_file} already exists. Skip compressing.")
             return output_file
         
+        # Already compressed files (--compress-history, .gz media) are stored, not compressed again
+        compressed = [] if level == NO_COMPRESSION_LEVEL else self._find_compressed_files(dir_path)
+
         # Build command
         if level == NO_COMPRESSION_LEVEL:
             cmd = [
@@ -251,11 +255,40 @@ class IAUploader:
                 self.config.path7z, "a", "-t7z", "-m0=lzma2", f"-mx={level}",
                 "-scsUTF-8", "-md=64m", "-ms=off", temp_file, dir_path
             ]
+            cmd += [f"-xr!*{suffix}" for suffix in COMPRESSED_SUFFIXES] if compressed else []
         
         subprocess.run(cmd, check=True)
+        if compressed:
+            self._store_with_7z(temp_file, os.path.dirname(dir_path), compressed)
         os.rename(temp_file, output_file)
         return output_file
     
+    def _find_compressed_files(self, dir_path: str) -> List[str]:
+        """Compressed files in dir_path, relative to its parent (their path in the archive)."""
+        parent = os.path.dirname(dir_path)
+        found = []
+        for root, _, files in os.walk(dir_path):
+            for filename in files:
+                if filename.endswith(COMPRESSED_SUFFIXES):
+                    found.append(os.path.relpath(os.path.join(root, filename), parent))
+        return found
+    
+    def _store_with_7z(self, archive: str, parent: str, files: List[str]) -> None:
+        """Add files (relative to parent) to the archive with level 0 compression."""
+        list_file = f"{archive}.list"
+        with open(list_file, "w", encoding="utf-8") as f:
+            f.write("\n".join(files) + "\n")
+        # run from parent: a relative path to 7z would not resolve there
+        path7z = os.path.abspath(self.config.path7z) if os.path.dirname(self.config.path7z) else self.config.path7z
+        try:
+            cmd = [
+                path7z, "a", "-t7z", f"-mx={NO_COMPRESSION_LEVEL}",
+                "-scsUTF-8", "-ms=off", archive, f"@{list_file}"
+            ]
+            subprocess.run(cmd, check=True, cwd=parent)
+        finally:
+            os.remove(list_file)
+    
     def _create_item_metadata(self, wiki_meta: WikiMetadata) -> Dict[str, str]:
         """Create initial item metadata."""
         info = get_info(self.config.dump_dir)